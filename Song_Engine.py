@@ -1,266 +1,550 @@
-from music21 import *
 import random
 from datetime import datetime
+import json
 import os
- 
-# Prevent music21 from trying to use external programs
-us = environment.UserSettings()
-us['musicxmlPath'] = None
-us['musescoreDirectPNGPath'] = None
-us['ipythonShowFormat'] = None
+import subprocess
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
+
+from automation import Envelope, automate
+from batch import Manifest, with_retries
+from comping import comp_parts
+from dataset_export import export_dataset
+from drum_patterns import drum_events
+from export import SongExporter
+from fingerprint import LSHIndex, signature
+from form_engine import FORM_RULES, SECTION_TYPES, generate_form
+from groove import groove_pass
+from melody_voices import generate_voices
+from metrics import METRICS, PeriodicFlusher
+from midi_writer import assign_channels
+from modulation import key_signature, modulation_table
+from quality import LIMITS, QualityGate
+from song_cache import SongCache, make_key
+from song_events import Track, empty_events, make_events
+from song_model import SongModel, derive_seed
+from song_spec import chord_table, compile_spec
+from song_store import SongStore
+from tempo_map import TempoMap
 
 # Constants
-BPM = 120  # Constant tempo
-NUM_MEASURES = 64  # Total number of measures
-SECTION_MEASURES = 16  # Number of measures per section (e.g., verse, chorus)
-
-# Define keys and scales for sections
-keys_and_scales = {
-    'verse': (key.Key('C'), scale.MajorScale('C')),
-    'chorus': (key.Key('G'), scale.MajorScale('G')),
-    'bridge': (key.Key('A'), scale.MinorScale('A')),
-    'intro': (key.Key('D'), scale.MajorScale('D')),
-    'outro': (key.Key('E'), scale.MinorScale('E')),
-}
+ENGINE_VERSION = '1.9'  # Bump whenever the same settings produce different music
+
+# Song form from the grammar in form_engine.py (section types, lengths, repeats)
+FORM_VARIATION = 0.25  # Chance that a repeated section gets new material instead of a copy
+GENERATION_WORKERS = 0  # Worker processes for block generation, 0 generates in this process
 
-# Chord progressions for sections
-chord_progressions = {
-    'verse': ['C', 'Am', 'F', 'G'],
-    'chorus': ['G', 'D', 'Em', 'C'],
-    'bridge': ['Am', 'F', 'C', 'G'],
-    'intro': ['D', 'G', 'A', 'D'],
-    'outro': ['Em', 'C', 'G', 'D'],
+# Drum fills per section type from drum_patterns.FILLS, keyed by bar (negative = from the end)
+DRUM_FILLS = {
+    'chorus': {-1: 'tom_roll'},
+    'bridge': {-1: 'snare_8ths'},
+    'buildup': {-2: 'snare_roll'},
+    'outro': {-1: 'break'},
 }
 
-# Define bass notes for sections
-bass_notes_dict = {
-    'verse': ['C2', 'A1', 'F1', 'G1'],
-    'chorus': ['G2', 'D2', 'E2', 'C2'],
-    'bridge': ['A2', 'F2', 'C2', 'G2'],
-    'intro': ['D2', 'G1', 'A1', 'D2'],
-    'outro': ['E2', 'C2', 'G2', 'D2'],
+# Quality gate: lead melody and bass blocks failing quality.LIMITS are rerolled before encoding
+QUALITY_ATTEMPTS = 3  # Rerolls per block, 0 disables the gate
+QUALITY_BUDGET = 8  # Rerolls per song, keeps batch throughput predictable
+
+# Counters and latency histograms (metrics.py) written after every song, or every
+# METRICS_FLUSH_SECONDS during a batch; a '.prom' file gets Prometheus text, anything else JSON
+METRICS_PATH = None  # e.g. 'song_engine_metrics.json' or '/var/lib/node_exporter/song_engine.prom'
+METRICS_FLUSH_SECONDS = 10.0
+
+# Key changes: bars at the end of a section that lead through a pivot chord into the next key (0 = jump)
+MODULATION_BARS = 2
+
+# Comping pattern (comping.COMP_PATTERNS) of the chord parts: 'pad', 'pulse', 'stabs', 'gallop',
+# 'arp_up', 'arp_down', 'arp_updown' or 'arp_8ths'; both are rendered from the same chord voicings
+COMPING = {'Chords': 'pad', 'Strings': 'pad'}
+
+# Humanisation applied after generation: None, 'straight', 'shuffle', 'pop', 'techno', 'psy'
+GROOVE = 'pop'
+
+# Loudness automation: CC11 expression fade on every track over the last beats (0 = off)
+FADE_OUT_BEATS = 16.0
+
+# Tempo automation, written to a separate conductor track
+SECTION_TEMPOS = {}  # Per-section BPM overrides, e.g. {'chorus': 128, 'outro': 100}
+TEMPO_RAMP_BEATS = 0.0  # Beats to glide into a new section tempo (0 = jump)
+TEMPO_VARIANTS = []  # Extra BPMs written from the same note tracks, e.g. [100, 140]
+
+# Extra files written from the same generated tracks
+EXPORT_MIXES = ['full']  # Any of 'full', 'drums_only', 'no_melody', 'no_drums'
+EXPORT_STEMS = False  # One file per track for DAW import
+
+# Offline audio render of the first written mix to <basename>.wav with the fluidsynth program;
+# cached together with the MIDI files
+AUDIO_SOUNDFONT = None  # Path of a .sf2 file, None writes no audio
+AUDIO_SAMPLE_RATE = 44100
+
+# Channel routing (midi_writer.routing_table): 15 melodic tracks per MIDI port, more move to the next port
+MIDI_PORTS = None  # Most ports a song may use, None = as many as the tracks need
+EXPORT_PORT_FILES = False  # Also write one file per port when a song uses more than one
+
+# Content-addressed cache of generated files, None disables it
+SONG_CACHE_DIR = None  # e.g. os.path.join(os.getcwd(), '.song_cache')
+SONG_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Packed song store for large corpora; when set, songs go there instead of .mid files
+SONG_STORE_DIR = None  # e.g. os.path.join(os.getcwd(), 'corpus'); export later with SongStore.export_midi
+
+# Failure handling for batches (batch.py): a song that raises is retried with new seeds, every
+# failure is recorded, and finished seeds are logged so an interrupted batch resumes where it stopped
+BATCH_RETRIES = 2  # New seeds tried after a song fails
+BATCH_MANIFEST = 'batch_manifest.jsonl'  # Per-seed log inside the song store directory
+WORKER_STALL_SECONDS = 1800  # Worker pools finishing no task for this long are restarted, None waits forever
+
+# Near-duplicate filter for store batches (fingerprint.py), None disables it
+DEDUP_THRESHOLD = 0.8  # Estimated similarity of melody and bass lines that counts as a duplicate
+DEDUP_REROLLS = 2  # New seeds tried for a duplicate before it is dropped
+DEDUP_TRACKS = ('Melody', 'Bass')  # Track name prefixes that are fingerprinted
+
+# Musical settings: tempo, meter, instruments, patterns and per-section keys, chords and bass notes.
+# SONG_SPEC_PATH points to a TOML or JSON file in the same layout (see song_spec.py) and replaces them
+SONG_SPEC_PATH = None  # e.g. 'my_song.toml'
+DEFAULT_SONG_SPEC = {
+    'bpm': 120,  # Constant tempo
+    'time_signature': '4/4',
+    # Piano, acoustic guitar, violin, flute, clarinet; one melody track each
+    'melody_programs': [0, 24, 40, 73, 71],
+    # Volume levels for active and inactive melody tracks and the accompaniment
+    'velocities': {'active': 80, 'inactive': 30, 'chords': 90, 'strings': 60, 'bass': 70},
+    'melodic_patterns': [
+        [0, 2, 4, 5], [0, -2, -4, -5], [0, 2, 0, -2],
+        [0, 3, 5, 7], [0, -3, -5, -7],
+    ],
+    'rhythmic_patterns': [
+        [1.0, 1.0, 1.0, 1.0], [0.5, 0.5, 1.0, 2.0], [0.75, 0.75, 0.5, 2.0],
+        [1.5, 0.5, 1.5, 0.5], [0.5, 1.5, 0.5, 1.5],
+    ],
+    'sections': {
+        'verse': {'key': 'C', 'mode': 'major', 'chords': ['C', 'Am', 'F', 'G'],
+                  'bass': ['C2', 'A1', 'F1', 'G1']},
+        'chorus': {'key': 'G', 'mode': 'major', 'chords': ['G', 'D', 'Em', 'C'],
+                   'bass': ['G2', 'D2', 'E2', 'C2']},
+        'bridge': {'key': 'A', 'mode': 'minor', 'chords': ['Am', 'F', 'C', 'G'],
+                   'bass': ['A2', 'F2', 'C2', 'G2']},
+        'intro': {'key': 'D', 'mode': 'major', 'chords': ['D', 'G', 'A', 'D'],
+                  'bass': ['D2', 'G1', 'A1', 'D2']},
+        'outro': {'key': 'E', 'mode': 'minor', 'chords': ['Em', 'C', 'G', 'D'],
+                  'bass': ['E2', 'C2', 'G2', 'D2']},
+    },
 }
 
-# Fixed list of instruments for different melody tracks
-melody_instruments = [
-    instrument.Piano(),
-    instrument.AcousticGuitar(),
-    instrument.Violin(),
-    instrument.Flute(),
-    instrument.Clarinet(),
-]
-
-# Define volume levels for active and inactive melody tracks
-ACTIVE_VOLUME = 80
-INACTIVE_VOLUME = 30
-
-# Add melodic and rhythmic patterns
-melodic_patterns = [
-    [0, 2, 4, 5], [0, -2, -4, -5], [0, 2, 0, -2],
-    [0, 3, 5, 7], [0, -3, -5, -7],
-]
-rhythmic_patterns = [
-    [1.0, 1.0, 1.0, 1.0], [0.5, 0.5, 1.0, 2.0], [0.75, 0.75, 0.5, 2.0],
-    [1.5, 0.5, 1.5, 0.5], [0.5, 1.5, 0.5, 1.5],
-]
-
-# Generate melody section with specified scale and chord progression
-def generate_melody_section(num_measures, scale_obj, chord_progression):
-    melody_section = stream.Part()  # No instrument assigned here
-    pitch_range = scale_obj.getPitches('C4', 'C6')
-    current_note = note.Note(random.choice(pitch_range))
-
-    for measure in range(num_measures):
-        notes_in_measure = []
-        chord_symbol = harmony.ChordSymbol(chord_progression[measure % len(chord_progression)])
-        chord_pitches = [p.pitchClass for p in chord_symbol.pitches]
-        melodic_pattern = random.choice(melodic_patterns)
-        rhythmic_pattern = random.choice(rhythmic_patterns)
-        pattern_length = min(len(melodic_pattern), len(rhythmic_pattern))
-        
-        for i in range(pattern_length):
-            interval_steps = melodic_pattern[i]
-            new_pitch = current_note.pitch.transpose(interval_steps)
-            if new_pitch not in pitch_range:
-                new_pitch = random.choice(pitch_range)
-            if new_pitch.pitchClass not in chord_pitches:
-                new_pitch = chord_symbol.root()
-            current_note = note.Note(new_pitch)
-            current_note.duration = duration.Duration(rhythmic_pattern[i])
-            current_note.volume.velocity = ACTIVE_VOLUME  # Set initial volume
-            notes_in_measure.append(current_note)
-        melody_section.append(notes_in_measure)
-    return melody_section
-
-# Generate chords for a section
-def generate_chords_section(num_measures, chord_progression):
-    chords_part = stream.Part()
-    chords_part.id = 'Chords'
-    for i in range(num_measures):
-        chord_symbol = harmony.ChordSymbol(chord_progression[i % len(chord_progression)])
-        chord_symbol.duration = duration.Duration(4.0)
-        chords_part.append(chord_symbol)
-    return chords_part
-
-# Generate bass for a section
-def generate_bass_section(num_measures, bass_notes):
-    bass = stream.Part()
-    bass.id = 'Bass'
-    pitch_range = [pitch.Pitch(p) for p in bass_notes]
-    for i in range(num_measures):
-        notes_in_measure = []
-        rhythm_choices = [1.0, 2.0]
-        total_duration = 0.0
-        while total_duration < 4.0:
-            duration_choice = random.choice(rhythm_choices)
-            if total_duration + duration_choice > 4.0:
-                duration_choice = 4.0 - total_duration
-            bass_note = note.Note(
-                random.choice(pitch_range)
-            )
-            bass_note.duration = duration.Duration(duration_choice)
-            bass_note.volume.velocity = 70
-            notes_in_measure.append(bass_note)
-            total_duration += duration_choice
-        bass.append(notes_in_measure)
-    return bass
-
-# Generate strings for a section
-def generate_strings_section(num_measures, scale_obj, chord_progression):
-    strings = stream.Part()
-    strings.id = 'Strings'
-    pitch_range = scale_obj.getPitches('C3', 'C5')
-    for i in range(num_measures):
-        chord_symbol = harmony.ChordSymbol(chord_progression[i % len(chord_progression)])
-        string_chord = chord.Chord(chord_symbol.pitches)
-        string_chord.duration = duration.Duration(4.0)
-        string_chord.volume.velocity = 60
-        strings.append(string_chord)
-    return strings
-
-# Generate techno beat with optional fills
-def generate_techno_beat_section(num_measures, start_measure):
-    drums = stream.Part()
-    drums.id = 'Drums'
-    drums.insert(0, instrument.Percussion())
-    drums.insert(0, clef.PercussionClef())
-    drums.insert(0, meter.TimeSignature('4/4'))
-
-    for measure in range(num_measures):
-        measure_offset = (start_measure + measure) * 4.0
-        for beat in range(4):
-            kick = note.Unpitched()
-            kick.ps = 35
-            kick.duration = duration.Duration(1.0)
-            kick.volume.velocity = 90
-            kick.offset = measure_offset + beat
-            drums.append(kick)
-            if beat == 3 and measure % 4 == 3:
-                extra_kick = note.Unpitched()
-                extra_kick.ps = 35
-                extra_kick.duration = duration.Duration(0.5)
-                extra_kick.volume.velocity = 90
-                extra_kick.offset = measure_offset + beat + 0.5
-                drums.append(extra_kick)
-        for beat in [1, 3]:
-            snare = note.Unpitched()
-            snare.ps = 38
-            snare.duration = duration.Duration(1.0)
-            snare.volume.velocity = 80
-            snare.offset = measure_offset + beat
-            drums.append(snare)
-        for beat in range(8):
-            hihat = note.Unpitched()
-            hihat.ps = 42
-            hihat.duration = duration.Duration(0.5)
-            hihat.volume.velocity = 70
-            hihat.offset = measure_offset + (beat * 0.5)
-            drums.append(hihat)
-        if (measure % 4) == 3:
-            crash = note.Unpitched()
-            crash.ps = 49
-            crash.duration = duration.Duration(1.0)
-            crash.volume.velocity = 85
-            crash.offset = measure_offset + 3
-            drums.append(crash)
-    for n in drums.recurse():
-        if 'Instrument' in n.classes:
-            n.midiChannel = 9
-        elif 'Note' in n.classes or 'Unpitched' in n.classes:
-            n.channel = 9
-    return drums
-
-# Generate the entire piece with different melody tracks for each instrument
-def generate_piece():
+# The compiled spec, validated and turned into integer tables once per process
+@lru_cache(maxsize=None)
+def load_song_spec(path=None):
+    materials = sorted({t['material'] for t in SECTION_TYPES.values()})
+    return compile_spec(path or DEFAULT_SONG_SPEC, materials)
+
+def song_spec():
+    return load_song_spec(SONG_SPEC_PATH)
+
+# Build the tempo map for a song from the per-section tempo settings
+def build_tempo_map(grid, bpm):
+    section_bpms = [SECTION_TEMPOS.get(name, bpm) for name in grid.section_names]
+    return TempoMap.from_sections(grid, section_bpms, ramp_beats=TEMPO_RAMP_BEATS)
+
+# Everything the blocks of one section share: the planned section, its distinct block number,
+# the compiled spec and the chords of every bar including the transition into the next key
+BlockContext = namedtuple('BlockContext', 'section block_index spec harmony transition_bars')
+
+# Chords of every bar of a section, the last bars replaced by the transition chords
+def section_harmony(spec, section, transition):
+    chords = spec[section.material].chords.names
+    bars = [chords[i % len(chords)] for i in range(section.measures)]
+    if transition and len(transition) < section.measures:
+        bars[-len(transition):] = transition
+    return chord_table(tuple(bars))
+
+# Block context of every section; planning a key change is a lookup in the spec's modulation table
+def plan_contexts(plan, spec):
+    table = modulation_table(tuple(m.key for m in spec.sections.values()), MODULATION_BARS)
+    contexts = []
+    for i, section in enumerate(plan.sections):
+        following = plan.sections[i + 1] if i + 1 < len(plan.sections) else None
+        transition = () if following is None else \
+            table.transition(spec[section.material].key, spec[following.material].key)
+        if len(transition) >= section.measures:
+            transition = ()
+        contexts.append(BlockContext(section, plan.block_index(i), spec,
+                                     section_harmony(spec, section, transition), len(transition)))
+    return contexts
+
+# Song model blocks: the events of one track for one planned section, onsets relative to the section.
+# They only read the compiled tables of the context. block_index counts distinct blocks, so a
+# repeated chorus keeps its lead instrument. All melody voices are written together, the active
+# instrument leads and the others harmonise
+def melody_block(context, rng):
+    section, spec = context.section, context.spec
+    voices_count = len(spec.melody_programs)
+    lead = context.block_index % voices_count
+    voices, _ = generate_voices(context.harmony.progression, spec[section.material].scale, section.measures,
+                                voices_count, lead=lead, beats_per_bar=spec.bar_length,
+                                rhythmic_patterns=spec.rhythmic_patterns,
+                                melodic_patterns=spec.melodic_patterns, rng=rng)
+    # Adjust volume based on active/inactive status
+    for i, events in enumerate(voices):
+        events['velocity'] = spec.velocities['active' if i == lead else 'inactive']
+    return voices
+
+# Chords and strings comped from the section's chord table in one pass
+def comping_block(context, rng):
+    spec = context.spec
+    bar_lengths = [spec.bar_length] * context.section.measures
+    return comp_parts(context.harmony, bar_lengths, [(COMPING['Chords'], spec.velocities['chords']),
+                                                     (COMPING['Strings'], spec.velocities['strings'])])
+
+# Bass notes of one or two beats picked from the section's bass notes, cut at the bar line.
+# Transition bars play the root of their chord instead
+def bass_block(context, rng):
+    section, spec = context.section, context.spec
+    per_bar = int(np.ceil(spec.bar_length))
+    lengths = rng.choice([1.0, 2.0], size=(section.measures, per_bar))
+    starts = np.cumsum(lengths, axis=1) - lengths
+    keep = starts < spec.bar_length
+    durations = np.minimum(lengths, spec.bar_length - starts)[keep]
+    bars = np.broadcast_to(np.arange(section.measures)[:, None], keep.shape)[keep]
+    onsets = starts[keep] + bars * spec.bar_length
+    pitches = rng.choice(spec[section.material].bass, size=len(onsets))
+    transition = bars >= section.measures - context.transition_bars
+    pitches[transition] = 36 + context.harmony.progression.roots[bars[transition]]
+    return make_events(onsets, durations, pitches, spec.velocities['bass'])
+
+def drums_block(context, rng):
+    spec = context.spec
+    return drum_events(context.section.measures, 'techno', spec.beats_per_bar, spec.beat_length,
+                       fills=DRUM_FILLS.get(context.section.name))
+
+# Song model generator around a block function; module level so worker processes can run it
+def plan_block(block, track_names, section_index, context, rng):
+    muted = [name.startswith(context.section.drop) for name in track_names]
+    if all(muted):
+        return [empty_events() for _ in track_names]  # Muted in this section, e.g. drums in a breakdown
+    with METRICS.timer('block_seconds', generator=block.__name__):
+        events = block(context, rng)
+    if not any(muted):
+        return events
+    return [empty_events() if mute else e for mute, e in zip(muted, events)]
+
+# Blocks the quality gate checks in a section: the lead melody and the bass, unless muted
+def quality_checks(contexts, section_index):
+    context = contexts[section_index]
+    lead = f'Melody {context.block_index % len(context.spec.melody_programs) + 1}'
+    return [(track, LIMITS[role], context.harmony.progression)
+            for track, role in ((lead, 'melody'), ('Bass', 'bass')) if not track.startswith(context.section.drop)]
+
+# Key signature wherever the key changes, for the conductor track
+def song_key_signatures(model):
+    key_signatures, last = [], None
+    for section_index in range(model.grid.num_sections):
+        context = model.context(section_index)
+        key = context.spec[context.section.material].key
+        if key != last:
+            key_signatures.append((model.grid.section_offset(section_index), key_signature(key), key[1] == 'minor'))
+            last = key
+    return key_signatures
+
+# Arrangement plan of a song; cheap, and decides which sections share their blocks
+def plan_form(seed):
+    return generate_form(np.random.default_rng(derive_seed(seed, 'form')), variation=FORM_VARIATION)
+
+# Build the song model with different melody tracks for each instrument; blocks can be rerolled later.
+# With an executor the distinct blocks are generated in parallel, the compiled spec travels with them
+# Blocks failing the quality checks are rerolled before anything is grooved or encoded
+def build_song(seed=None, executor=None, spec=None):
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    spec = spec or song_spec()
+    with METRICS.timer('stage_seconds', stage='plan'):
+        plan = plan_form(seed)
+    grid = plan.grid(spec.time_signature, bpm=spec.bpm)
+    grid.tempo_map = build_tempo_map(grid, spec.bpm)
+
+    tracks = [Track(f'Melody {i + 1}', empty_events(), program=program)
+              for i, program in enumerate(spec.melody_programs)]
+    tracks += [
+        Track('Drums', empty_events(), is_drum=True),
+        Track('Strings', empty_events()),
+        Track('Bass', empty_events()),
+        Track('Chords', empty_events()),
+    ]
+    assign_channels(tracks, MIDI_PORTS)
+
+    # A section's block key includes its transition, so a chorus leading elsewhere is its own block
+    contexts = plan_contexts(plan, spec)
+    keys = [key + (context.harmony.names[len(context.harmony.names) - context.transition_bars:],)
+            for key, context in zip(plan.keys, contexts)]
+    model = SongModel(grid, tracks, seed, post_process=groove_pass(GROOVE, grid), section_keys=keys,
+                      plan_section=lambda index, rng: contexts[index])
+    melody_names = tuple(f'Melody {i + 1}' for i in range(len(spec.melody_programs)))
+    model.add_generator(melody_names, partial(plan_block, melody_block, melody_names))
+    for name, block in [('Drums', drums_block), ('Bass', bass_block)]:
+        model.add_generator(name, partial(plan_block, block, (name,)))
+    model.add_generator(('Chords', 'Strings'), partial(plan_block, comping_block, ('Chords', 'Strings')))
+    with METRICS.timer('stage_seconds', stage='generate'):
+        model.build(executor)
+    if QUALITY_ATTEMPTS:
+        gate = QualityGate(partial(quality_checks, contexts), QUALITY_ATTEMPTS, QUALITY_BUDGET)
+        with METRICS.timer('stage_seconds', stage='quality'):
+            report = gate.refine(model, executor)
+        METRICS.inc('quality_rejected_total', report['rejected'])
+        METRICS.inc('quality_rerolls_total', report['rerolls'])
+    METRICS.inc('songs_total')
+    return model
+
+# Tracks of a built song with the loudness automation applied
+def mixed_tracks(model):
+    with METRICS.timer('stage_seconds', stage='post_process'):
+        tracks = model.tracks()
+    METRICS.observe('notes_per_song', sum(len(t.events) for t in tracks))
+    if not FADE_OUT_BEATS:
+        return tracks
+    fade = Envelope.fade_out(model.grid.total_beats, FADE_OUT_BEATS)
+    return [automate(track, expression=fade) for track in tracks]
+
+# Every setting that influences the generated files, used as the cache key
+def generation_params(seed):
+    return {
+        'seed': seed,
+        'song_spec': song_spec().document,
+        'form_rules': FORM_RULES,
+        'section_types': SECTION_TYPES,
+        'form_variation': FORM_VARIATION,
+        'drum_fills': DRUM_FILLS,
+        'modulation_bars': MODULATION_BARS,
+        'quality': (QUALITY_ATTEMPTS, QUALITY_BUDGET, LIMITS),
+        'fade_out_beats': FADE_OUT_BEATS,
+        'section_tempos': SECTION_TEMPOS,
+        'tempo_ramp_beats': TEMPO_RAMP_BEATS,
+        'tempo_variants': TEMPO_VARIANTS,
+        'comping': COMPING,
+        'groove': GROOVE,
+        'mixes': EXPORT_MIXES,
+        'stems': EXPORT_STEMS,
+        'port_files': EXPORT_PORT_FILES,
+        'audio': (AUDIO_SOUNDFONT, AUDIO_SAMPLE_RATE) if AUDIO_SOUNDFONT else None,
+    }
+
+# Write every requested file of a song and return their paths
+def write_song_files(grid, tracks, out_dir, basename, key_signatures=()):
+    exporter = SongExporter(tracks, grid.tempo_map, grid.time_signature_events(), key_signatures)
+    with METRICS.timer('stage_seconds', stage='encode'):
+        paths = list(exporter.export(out_dir, basename, EXPORT_MIXES, EXPORT_STEMS, EXPORT_PORT_FILES).values())
+        for bpm in TEMPO_VARIANTS:
+            paths.append(exporter.write_mix(os.path.join(out_dir, f'{basename}_{bpm}bpm.mid'),
+                                            tempo_map=grid.tempo_map.scaled(bpm / song_spec().bpm)))
+    METRICS.inc('bytes_written_total', exporter.bytes_written, target='midi')
+    if AUDIO_SOUNDFONT and paths:
+        with METRICS.timer('stage_seconds', stage='audio'):
+            paths.append(render_audio(paths[0], os.path.join(out_dir, f'{basename}.wav')))
+        METRICS.inc('bytes_written_total', os.path.getsize(paths[-1]), target='audio')
+    return paths
+
+# Render a MIDI file to a .wav file with the fluidsynth program and AUDIO_SOUNDFONT
+def render_audio(midi_path, wav_path):
+    try:
+        subprocess.run(['fluidsynth', '-ni', '-F', wav_path, '-r', str(AUDIO_SAMPLE_RATE),
+                        AUDIO_SOUNDFONT, midi_path], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        raise OSError(f"fluidsynth failed: {e.stderr.decode(errors='replace').strip()}") from e
+    return wav_path
+
+# Store written files under the cache key, the index is written last
+def store_in_cache(cache, key, paths, basename):
+    index = {}
+    for path in paths:
+        suffix = os.path.basename(path)[len(basename):]
+        kind = suffix.lstrip('_') or 'mid'
+        with open(path, 'rb') as f:
+            cache.put(key, f.read(), kind)
+        index[kind] = suffix
+    cache.put(key, json.dumps(index).encode('utf-8'), 'index.json')
+
+# Recreate the files of a cached song under a new name; returns their paths, None on a miss
+def restore_from_cache(cache, key, out_dir, basename):
+    entry = cache.get_indexed(key, 'index.json')
+    if entry is None:
+        return None
+    index, files = entry
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for kind, data in files.items():
+        paths.append(os.path.join(out_dir, basename + index[kind]))
+        with open(paths[-1], 'wb') as f:
+            f.write(data)
+    return paths
+
+# Append a generated song to a packed song store and return its index there
+def store_song(store, model, seed, fingerprint=None, batch_seed=None):
+    grid = model.grid
+    meta = {'seed': seed, 'engine': ENGINE_VERSION, 'form': ' '.join(grid.section_names)}
+    if fingerprint is not None:
+        meta['minhash'] = fingerprint.tolist()
+    if batch_seed is not None:
+        meta['batch_seed'] = batch_seed
+    tracks = mixed_tracks(model)
+    written = store.bytes_written
+    with METRICS.timer('stage_seconds', stage='store'):
+        song_id = store.append(tracks, grid.tempo_map, grid.time_signature_events(),
+                               song_key_signatures(model), meta=meta)
+    METRICS.inc('bytes_written_total', store.bytes_written - written, target='store')
+    return song_id
+
+# LSH index of the fingerprints already in a store, so a batch also skips songs of earlier runs
+def load_fingerprints(store):
+    index = LSHIndex(DEDUP_THRESHOLD)
+    for song_id in range(len(store)):
+        meta = store.meta(song_id)['meta'] or {}
+        if 'minhash' in meta:
+            index.add(song_id, np.array(meta['minhash'], dtype=np.uint32))
+    return index
+
+# Generate num_songs songs into a packed store; near-duplicates get a new seed or are dropped.
+# Seeds already in the store's batch manifest are skipped, so rerunning an interrupted batch resumes it
+def generate_batch(num_songs, store_dir=None, first_seed=0):
+    report = {'stored': 0, 'duplicates': 0, 'dropped': 0, 'failed': 0, 'resumed': 0, 'errors': []}
+    flusher = PeriodicFlusher(METRICS, METRICS_PATH, METRICS_FLUSH_SECONDS).start() if METRICS_PATH else None
+    try:
+        with SongStore(store_dir or SONG_STORE_DIR, 'a') as store, \
+                Manifest(os.path.join(store.root, BATCH_MANIFEST)) as manifest:
+            _fill_store(store, manifest, num_songs, first_seed, report)
+    finally:
+        if flusher is not None:
+            flusher.stop()
+    return report
+
+# Batch loop of generate_batch; the store's fingerprints seed the duplicate index
+def _fill_store(store, manifest, num_songs, first_seed, report):
+    # A crash between storing a song and logging it leaves only the last song unlogged
+    last = (store.meta(-1)['meta'] or {}) if len(store) else {}
+    if last.get('batch_seed') is not None and last['batch_seed'] not in manifest:
+        manifest.append({'seed': last['batch_seed'], 'status': 'stored', 'song_id': len(store) - 1,
+                         'song_seed': last['seed']})
+    index = load_fingerprints(store) if DEDUP_THRESHOLD else None
+    for seed in range(first_seed, first_seed + num_songs):
+        if seed in manifest:
+            report['resumed'] += 1
+            continue
+        record = {'seed': seed, 'status': 'dropped', 'errors': []}
+        fingerprint = None
+        for attempt in range(DEDUP_REROLLS + 1):
+            dedup_seed = seed if attempt == 0 else derive_seed(seed, 'dedup', attempt)
+            model, song_seed, errors = with_retries(build_song, dedup_seed, BATCH_RETRIES, batch_seed=seed)
+            record['errors'] += errors
+            if model is None:
+                record['status'] = 'failed'
+                break
+            if index is None:
+                break
+            fingerprint = signature(model.tracks(), DEDUP_TRACKS)
+            if index.query(fingerprint) is None:
+                break
+            report['duplicates'] += 1
+            METRICS.inc('duplicates_total')
+            model = None
+        if model is not None:
+            song_id = store_song(store, model, song_seed, fingerprint, batch_seed=seed)
+            if index is not None:
+                index.add(song_id, fingerprint)
+            record.update(status='stored', song_id=song_id, song_seed=song_seed)
+        report[record['status']] += 1
+        report['errors'] += record['errors']
+        manifest.append(record)
+
+# Tracks of one song for training data, no MIDI encoding involved
+def dataset_song(seed):
+    return build_song(seed).tracks()
+
+# Piano rolls and token sequences of num_songs songs as sharded NPZ files, generated in worker processes
+def export_training_data(num_songs, out_dir, first_seed=0, workers=None, steps_per_beat=4):
+    return export_dataset(dataset_song, range(first_seed, first_seed + num_songs), out_dir,
+                          workers=workers, steps_per_beat=steps_per_beat, retries=BATCH_RETRIES,
+                          stall_seconds=WORKER_STALL_SECONDS)
+
+# Write the metrics file, if one is configured
+def flush_metrics():
+    if METRICS_PATH:
+        PeriodicFlusher(METRICS, METRICS_PATH).flush()
+
+# Build one song, its blocks generated in a fresh worker pool when GENERATION_WORKERS is set
+def build_song_pooled(seed):
+    if not GENERATION_WORKERS:
+        return build_song(seed)
+    with ProcessPoolExecutor(GENERATION_WORKERS) as executor:
+        return build_song(seed, executor)
+
+# Print error records to stderr, one line each
+def report_errors(errors):
+    for error in errors:
+        where = f" in section {error['section']} ({', '.join(error['tracks']) or 'planning'})" \
+            if 'section' in error else ''
+        print(f"Seed {error['seed']} failed{where}: {error['error']}: {error['message']}", file=sys.stderr)
+
+# Generate the entire piece and write all requested variants of it; returns the written (or from
+# the cache restored) paths, or None when the song was stored or could not be generated or written
+def generate_piece(seed=None, cache=None, store=None):
+    if store is None and SONG_STORE_DIR:
+        with SongStore(SONG_STORE_DIR, 'a') as store:
+            return generate_piece(seed, cache, store)
     print("Generating musical piece...")  # Debug message
-    s = stream.Stream()
-    s.insert(0, tempo.MetronomeMark(number=BPM))
-
-    sections = ['intro', 'verse', 'chorus', 'verse', 'bridge', 'chorus', 'outro']
-    total_measures = 0
-
-    # Create multiple melody tracks, each with a different instrument
-    melody_tracks = []
-    for inst in melody_instruments:
-        melody_track = stream.Part()
-        melody_track.append(inst)
-        melody_tracks.append(melody_track)
-
-    chords = stream.Part()
-    bass = stream.Part()
-    strings = stream.Part()
-    drums = stream.Part()
-
-    # For each section, set one melody track as active and others as inactive
-    for section_index, section in enumerate(sections):
-        key_signature, scale_obj = keys_and_scales[section]
-        chord_progression = chord_progressions[section]
-        bass_notes = bass_notes_dict[section]
-
-        # Generate melody for this section in each track
-        for i, melody_track in enumerate(melody_tracks):
-            melody_section = generate_melody_section(SECTION_MEASURES, scale_obj, chord_progression)
-            
-            # Adjust volume based on active/inactive status
-            volume_level = ACTIVE_VOLUME if i == section_index % len(melody_tracks) else INACTIVE_VOLUME
-            for n in melody_section.flat.notes:
-                n.volume.velocity = volume_level
-            
-            melody_track.append(melody_section)
-
-        chords_section = generate_chords_section(SECTION_MEASURES, chord_progression)
-        chords.append(chords_section)
-
-        bass_section = generate_bass_section(SECTION_MEASURES, bass_notes)
-        bass.append(bass_section)
-
-        strings_section = generate_strings_section(SECTION_MEASURES, scale_obj, chord_progression)
-        strings.append(strings_section)
-
-        drums_section = generate_techno_beat_section(SECTION_MEASURES, total_measures)
-        drums.append(drums_section)
-
-        total_measures += SECTION_MEASURES
-
-    # Add tracks to the main stream
-    for melody_track in melody_tracks:
-        s.insert(0, melody_track)
-    s.insert(0, drums)
-    s.insert(0, strings)
-    s.insert(0, bass)
-    s.insert(0, chords)
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    if store is not None:
+        cache = None  # Stored songs never become files, nothing to cache
+    elif cache is None and SONG_CACHE_DIR:
+        cache = SongCache(SONG_CACHE_DIR, SONG_CACHE_MAX_BYTES)
 
  # Generiere den Dateinamen mit Datum und Uhrzeit
     current_time = datetime.now().strftime('%Y%m%d_%H%M%S')
-    midi_filename = f'Song_{current_time}.mid'
-    file_path = os.path.join(os.getcwd(), midi_filename)
+    basename = f'Song_{current_time}'
+    midi_filename = f'{basename}.mid'
+    out_dir = os.getcwd()
+
+    # Same settings and seed as an earlier run: copy the cached files
+    key = make_key(generation_params(seed), ENGINE_VERSION) if cache is not None else None
+    if cache is not None:
+        restored = restore_from_cache(cache, key, out_dir, basename)
+        METRICS.inc('cache_lookups_total', result='hit' if restored else 'miss')
+        METRICS.set('cache_hit_ratio', cache.hit_ratio)
+        if restored:
+            print(f"The piece was restored from the cache as '{midi_filename}' in {out_dir}.")
+            flush_metrics()
+            return restored
+
+    # A song that fails to generate is retried with new seeds; the failures are reported, not raised
+    model, song_seed, errors = with_retries(build_song_pooled, seed, BATCH_RETRIES)
+    report_errors(errors)
+    if model is None:
+        print(f"No song generated for seed {seed} after {BATCH_RETRIES + 1} attempts.", file=sys.stderr)
+        return None
+    seed = song_seed
+    print(f"Form: {plan_form(seed).describe()}")
+    if store is not None:
+        index = store_song(store, model, seed)
+        print(f"The piece was stored as song {index} in {store.root}.")
+        flush_metrics()
+        return
+    grid, tracks = model.grid, mixed_tracks(model)
 
-    # MIDI-Datei speichern
+    # MIDI-Datei speichern; every track is encoded once and shared by all files. Only file system
+    # errors are reported here, anything else is a bug and raises
     try:
-        s.write('midi', fp=file_path)
-        print(f"The piece was successfully saved as '{midi_filename}' in {os.getcwd()}.")
-    except Exception as e:
-        print(f"Error saving MIDI file: {e}")
+        paths = write_song_files(grid, tracks, out_dir, basename, song_key_signatures(model))
+    except OSError as e:
+        print(f"Error saving MIDI file: {e}", file=sys.stderr)
+        flush_metrics()
+        return None
+    if cache is not None:
+        store_in_cache(cache, key, paths, basename)
+    print(f"The piece was successfully saved as '{midi_filename}' in {out_dir}.")
+    flush_metrics()
+    return paths
 
 if __name__ == "__main__":
-    generate_piece()
\ No newline at end of file
+    generate_piece()
@@ -3,11 +3,19 @@ from music21 import roman
 import random
 from datetime import datetime
 import os
+import sys
 # github.com/zeittresor
 
+# Gemeinsame Engine-Module liegen im Hauptverzeichnis
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from automation import Envelope, scale_velocities
+from bass_engine import generate_bassline
+from drum_patterns import drum_events
+from song_events import compile_progression, events_from_part, events_to_part
+
 BPM = 120              # Tempo
-NUM_MEASURES = 64      # Gesamtlänge in Takten
 SECTION_MEASURES = 16  # Takte pro Abschnitt
+BASS_STYLE = 'walking' # 'walking', 'octave' oder 'root_fifth'
 
 possible_keys = [
     ('C', 'major'), ('G', 'major'), ('D', 'major'), ('A', 'major'), ('E', 'major'),
@@ -53,14 +61,6 @@ def generate_random_progression(key_obj, mode):
             chord_names.append(root_name)
     return chord_names
 
-def get_bass_note_from_chord(chord_str):
-    """Ermittelt aus dem Akkordnamen die Bassnote."""
-    if len(chord_str) > 1 and chord_str[1] in ['#', 'b']:
-        root = chord_str[:2]
-    else:
-        root = chord_str[0]
-    return root + "2"
-
 def generate_melody_section(num_measures, scale_obj, chord_progression):
     melody = stream.Part()
     melody.id = 'Melody'
@@ -98,24 +98,12 @@ def generate_chords_section(num_measures, chord_progression):
         chords_part.append(chord_symbol)
     return chords_part
 
-def generate_bass_section(num_measures, bass_notes):
-    bass = stream.Part()
+def generate_bass_section(num_measures, chord_progression):
+    """Erzeugt die Basslinie direkt aus den Tonhöhenklassen der Akkorde."""
+    events = generate_bassline(compile_progression(chord_progression), num_measures,
+                               style=BASS_STYLE, velocity=70)
+    bass = events_to_part(events)
     bass.id = 'Bass'
-    pitch_range = [pitch.Pitch(p) for p in bass_notes]
-    for i in range(num_measures):
-        notes_in_measure = []
-        rhythm_choices = [1.0, 2.0]
-        total_duration = 0.0
-        while total_duration < 4.0:
-            duration_choice = random.choice(rhythm_choices)
-            if total_duration + duration_choice > 4.0:
-                duration_choice = 4.0 - total_duration
-            bass_note = note.Note(random.choice(pitch_range))
-            bass_note.duration = duration.Duration(duration_choice)
-            bass_note.volume.velocity = 70
-            notes_in_measure.append(bass_note)
-            total_duration += duration_choice
-        bass.append(notes_in_measure)
     return bass
 
 def generate_strings_section(num_measures, scale_obj, chord_progression):
@@ -129,71 +117,16 @@ def generate_strings_section(num_measures, scale_obj, chord_progression):
         strings.append(string_chord)
     return strings
 
-def generate_techno_beat_section(num_measures, start_measure):
-    drums = stream.Part()
+def generate_drums_section(num_measures, fills=None):
+    """Techno-Beat aus der Pattern-Bibliothek; Fills ersetzen die Takte, statt sie zu überlagern."""
+    drums = events_to_part(drum_events(num_measures, 'techno', fills=fills))
     drums.id = 'Drums'
-    drums.insert(0, instrument.Percussion())
-    drums.insert(0, clef.PercussionClef())
-    drums.insert(0, meter.TimeSignature('4/4'))
-
-    for measure in range(num_measures):
-        measure_offset = (start_measure + measure) * 4.0
-        for beat in range(4):
-            kick = note.Unpitched()
-            kick.ps = 35
-            kick.duration = duration.Duration(1.0)
-            kick.volume.velocity = 90
-            kick.offset = measure_offset + beat
-            drums.append(kick)
-            if beat == 3 and measure % 4 == 3:
-                extra_kick = note.Unpitched()
-                extra_kick.ps = 35
-                extra_kick.duration = duration.Duration(0.5)
-                extra_kick.volume.velocity = 90
-                extra_kick.offset = measure_offset + beat + 0.5
-                drums.append(extra_kick)
-        for beat in [1, 3]:
-            snare = note.Unpitched()
-            snare.ps = 38
-            snare.duration = duration.Duration(1.0)
-            snare.volume.velocity = 80
-            snare.offset = measure_offset + beat
-            drums.append(snare)
-        for beat in range(8):
-            hihat = note.Unpitched()
-            hihat.ps = 42
-            hihat.duration = duration.Duration(0.5)
-            hihat.volume.velocity = 70
-            hihat.offset = measure_offset + (beat * 0.5)
-            drums.append(hihat)
-        if (measure % 4) == 3:
-            crash = note.Unpitched()
-            crash.ps = 49
-            crash.duration = duration.Duration(1.0)
-            crash.volume.velocity = 85
-            crash.offset = measure_offset + 3
-            drums.append(crash)
-    for n in drums.recurse():
-        if 'Instrument' in n.classes:
-            n.midiChannel = 9
-        elif 'Note' in n.classes or 'Unpitched' in n.classes:
-            n.channel = 9
+    # Kanal 10 (Index 9) ist in General MIDI das Schlagzeug, sonst klingen die Noten als Klavier
+    inst = instrument.Percussion()
+    inst.midiChannel = 9
+    drums.insert(0, inst)
     return drums
 
-def generate_fill_in(num_measures, start_measure):
-    fill = stream.Part()
-    fill.id = 'DrumFill'
-    for measure in range(num_measures):
-        measure_offset = (start_measure + measure) * 4.0
-        for beat in [0, 1, 2, 3]:
-            snare = note.Unpitched()
-            snare.ps = 38
-            snare.duration = duration.Duration(0.5)
-            snare.volume.velocity = 80
-            snare.offset = measure_offset + beat * 0.5
-            fill.append(snare)
-    return fill
-
 def generate_piece():
     print("Generating musical piece...")
     s = stream.Stream()
@@ -220,27 +153,25 @@ def generate_piece():
 
     for section in sections:
         chord_progression = generate_random_progression(key_obj, mode)
-        bass_notes = [get_bass_note_from_chord(ch) for ch in chord_progression]
 
         melody_section = generate_melody_section(SECTION_MEASURES, scale_obj, chord_progression)
         chords_section = generate_chords_section(SECTION_MEASURES, chord_progression)
-        bass_section = generate_bass_section(SECTION_MEASURES, bass_notes)
+        bass_section = generate_bass_section(SECTION_MEASURES, chord_progression)
         strings_section = generate_strings_section(SECTION_MEASURES, scale_obj, chord_progression)
-        drums_section = generate_techno_beat_section(SECTION_MEASURES, total_measures)
-        if section in ['chorus', 'outro']:
-            drums_section.append(generate_fill_in(SECTION_MEASURES, total_measures))
+        fills = {-1: 'snare_8ths'} if section in ['chorus', 'outro'] else None
+        drums_section = generate_drums_section(SECTION_MEASURES, fills)
         
         melody.append(melody_section)
         chords.append(chords_section)
         bass.append(bass_section)
         strings.append(strings_section)
-        drums.append(drums_section)
+        drums.insert(total_measures * 4.0, drums_section)
 
         total_measures += SECTION_MEASURES
 
-    for i, n in enumerate(strings.flatten().getElementsByClass('Note')):
-        if n.offset >= (NUM_MEASURES - 4) * 4:
-            n.volume.velocity = max(60 - (i * 5), 0)
+    # Streicher über die letzten vier Takte ausblenden, nach Zeit statt nach Notenindex
+    fade = Envelope.fade_out(total_measures * 4.0, 16.0)
+    strings = events_to_part(scale_velocities(events_from_part(strings), fade))
 
     melody.insert(0, instrument.StringInstrument())
     chords.insert(0, instrument.StringInstrument())
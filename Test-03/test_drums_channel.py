@@ -0,0 +1,28 @@
+"""Prüft, dass die Schlagzeugspur von test-03.py auf MIDI-Kanal 10 exportiert wird."""
+import importlib.util
+import os
+
+from music21 import midi, stream
+
+spec = importlib.util.spec_from_file_location(
+    'test_03', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-03.py'))
+test_03 = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(test_03)
+
+
+def note_on_channels(path):
+    mf = midi.MidiFile()
+    mf.open(path)
+    mf.read()
+    mf.close()
+    return [sorted({e.channel for e in track.events if e.type == midi.ChannelVoiceMessages.NOTE_ON})
+            for track in mf.tracks]
+
+
+def test_drums_are_exported_on_channel_10(tmp_path):
+    s = stream.Stream()
+    s.insert(0, test_03.generate_drums_section(2, fills={-1: 'snare_8ths'}))
+    path = str(tmp_path / 'drums.mid')
+    s.write('midi', fp=path)
+    channels = [c for c in note_on_channels(path) if c]
+    assert channels == [[10]]
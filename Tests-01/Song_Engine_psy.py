@@ -1,211 +1,13 @@
 import os
 import random
-from datetime import datetime
 import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import sys
 
-from music21 import *
-import fluidsynth
-
-# ================== Globale Einstellungen ==================
-
-# Constants
-BPM = 140  # Erhöht für einen typischen Techno/Psytrance-Charakter
-SECTION_MEASURES = 16  # Anzahl der Takte pro Abschnitt (z.B. verse, chorus)
-
-# Taktarten
-time_signature_options = ['4/4', '3/4']
-
-# Genre-Auswahl
-GENRE = "psytrance"  # Optionen: "psytrance", "classic", "synth"
-
-# Scale and Key options for variation, ensuring harmony
-keys_and_scales_options = [
-    ('C', 'MajorScale'),
-    ('G', 'MajorScale'),
-    ('A', 'MinorScale'),
-    ('D', 'MinorScale'),
-    ('F', 'MajorScale'),
-    ('E', 'MinorScale'),
-    ('Bb', 'MajorScale'),
-]
-
-# Chord progressions with randomized but harmonic options
-chord_progressions_options = {
-    'intro': [['Am', 'F', 'C', 'G'], ['Am', 'F', 'C', 'G']],
-    'verse': [['Am', 'F', 'C', 'G'], ['Dm', 'Am', 'Bb', 'F'], ['Em', 'C', 'G', 'D']],
-    'chorus': [['C', 'G', 'Am', 'F'], ['F', 'G', 'Am', 'C'], ['C', 'G', 'F', 'Am']],
-    'bridge': [['Dm', 'Am', 'Bb', 'F'], ['Gm', 'Bb', 'C', 'Dm'], ['Am', 'F', 'C', 'G']],
-    'outro': [['Am', 'F', 'C', 'G'], ['Am', 'F', 'C', 'G']],
-}
-
-# ================== Musikgenerierungsfunktionen ==================
-
-# Funktion zur zufälligen Auswahl von Schlüssel und Skala
-def get_random_key_and_scale():
-    key_name, scale_type = random.choice(keys_and_scales_options)
-    k = key.Key(key_name)
-    if scale_type == 'MajorScale':
-        s = scale.MajorScale(key_name)
-    elif scale_type == 'MinorScale':
-        s = scale.MinorScale(key_name)
-    else:
-        s = scale.MajorScale(key_name)
-    return k, s
-
-# Funktion zur zufälligen Auswahl der Akkordprogression für einen Abschnitt
-def get_random_chord_progression(section):
-    return random.choice(chord_progressions_options[section])
-
-# Funktion zur Generierung der Melodie basierend auf Akkordnoten
-def generate_melody_section(num_measures, scale_obj, chord_progression):
-    melody = stream.Part()
-    melody.id = 'Melody'
-    melody.append(instrument.ElectricOrgan())  # Korrigiert auf ElectricOrgan
-    for measure in range(num_measures):
-        chord_str = chord_progression[measure % len(chord_progression)]
-        try:
-            chord_symbol = harmony.ChordSymbol(chord_str)
-        except Exception as e:
-            print(f"Fehler beim Erstellen von ChordSymbol für '{chord_str}': {e}")
-            continue  # Überspringen Sie den aktuellen Akkord und fahren Sie fort
-
-        chord_pitches = [p.nameWithOctave for p in chord_symbol.pitches]
-        # Wähle eine zufällige Note aus den Akkordnoten
-        melody_note = note.Note(random.choice(chord_pitches))
-        melody_note.duration = duration.Duration(1.0)  # Viertelnoten
-        melody_note.volume.velocity = 80
-        melody.append(melody_note)
-    return melody
-
-# Funktion zur Generierung der Basslinie basierend auf Akkordnoten
-def generate_bass_section(num_measures, chord_progression):
-    bass = stream.Part()
-    bass.id = 'Bass'
-    bass.append(instrument.ElectricBass())
-    for i in range(num_measures):
-        chord_str = chord_progression[i % len(chord_progression)]
-        try:
-            chord_symbol = harmony.ChordSymbol(chord_str)
-            root = chord_symbol.root()
-            bass_note = note.Note(root, octave=2)
-            bass_note.duration = duration.Duration(1.0)  # Viertelnoten
-            bass_note.volume.velocity = 100
-            bass.append(bass_note)
-        except Exception as e:
-            print(f"Fehler beim Erstellen von ChordSymbol für Bassnote '{chord_str}': {e}")
-            continue  # Überspringen Sie den aktuellen Akkord und fahren Sie fort
-    return bass
-
-# Funktion zur Generierung der Akkorde
-def generate_chords_section(num_measures, chord_progression):
-    chords_part = stream.Part()
-    chords_part.id = 'Chords'
-    chords_part.append(instrument.ElectricGuitar())
-    for i in range(num_measures):
-        chord_str = chord_progression[i % len(chord_progression)]
-        try:
-            chord_symbol = harmony.ChordSymbol(chord_str)
-            chord_symbol.duration = duration.Duration(4.0)
-            chords_part.append(chord_symbol)
-        except Exception as e:
-            print(f"Fehler beim Erstellen von ChordSymbol für '{chord_str}': {e}")
-            continue  # Überspringen Sie den aktuellen Akkord und fahren Sie fort
-    return chords_part
-
-# Funktion zur Generierung der Strings
-def generate_strings_section(num_measures, scale_obj, chord_progression):
-    strings = stream.Part()
-    strings.id = 'Strings'
-    strings.append(instrument.StringInstrument())
-    pitch_range = scale_obj.getPitches('C3', 'C5')
-    for i in range(num_measures):
-        chord_str = chord_progression[i % len(chord_progression)]
-        try:
-            chord_symbol = harmony.ChordSymbol(chord_str)
-            string_chord = Chord(chord_symbol.pitches)  # Korrigiert auf Chord
-            string_chord.duration = duration.Duration(4.0)
-            string_chord.volume.velocity = 60
-            strings.append(string_chord)
-        except Exception as e:
-            print(f"Fehler beim Erstellen von ChordSymbol für '{chord_str}': {e}")
-            continue  # Überspringen Sie den aktuellen Akkord und fahren Sie fort
-    return strings
-
-# Funktion zur Generierung des Techno-Beats
-def generate_techno_beat_section(num_measures, start_measure):
-    drums = stream.Part()
-    drums.id = 'Drums'
-    drums.insert(0, instrument.Percussion())
-    drums.insert(0, clef.PercussionClef())
-    drums.insert(0, meter.TimeSignature('4/4'))
-
-    for measure in range(num_measures):
-        measure_offset = (start_measure + measure) * 4.0
-        for beat in range(4):
-            # Kick Drum auf jedem Beat
-            kick = note.Unpitched()
-            kick.ps = 35  # Standard Kick Drum MIDI Program Number
-            kick.duration = duration.Duration(1.0)
-            kick.volume.velocity = 90
-            kick.offset = measure_offset + beat
-            drums.append(kick)
-            # Snare auf dem 2. und 4. Beat
-            if beat in [1, 3]:
-                snare = note.Unpitched()
-                snare.ps = 38  # Standard Snare Drum MIDI Program Number
-                snare.duration = duration.Duration(1.0)
-                snare.volume.velocity = 80
-                snare.offset = measure_offset + beat
-                drums.append(snare)
-            # Hi-Hat auf jedem halben Beat
-            for sub_beat in range(2):
-                hihat = note.Unpitched()
-                hihat.ps = 42  # Closed Hi-Hat MIDI Program Number
-                hihat.duration = duration.Duration(0.5)
-                hihat.volume.velocity = 70
-                hihat.offset = measure_offset + beat + (sub_beat * 0.5)
-                drums.append(hihat)
-            # Zusätzliche Percussion wie Claps auf dem 2. und 4. Beat
-            if beat in [1, 3]:
-                clap = note.Unpitched()
-                clap.ps = 39  # Handclap MIDI Program Number
-                clap.duration = duration.Duration(1.0)
-                clap.volume.velocity = 80
-                clap.offset = measure_offset + beat
-                drums.append(clap)
-        # Optional: Crash Cymbal alle 4 Takte
-        if (measure + start_measure) % 4 == 3:
-            crash = note.Unpitched()
-            crash.ps = 49  # Crash Cymbal MIDI Program Number
-            crash.duration = duration.Duration(1.0)
-            crash.volume.velocity = 85
-            crash.offset = measure_offset + 3
-            drums.append(crash)
-    # Setzen des MIDI-Kanals für Percussion
-    for n in drums.recurse().notes:
-        n.channel = 9  # General MIDI Percussion Channel
-    return drums
-
-# Funktion zur Generierung eines Drum-Fill-Ins
-def generate_fill_in(num_measures, start_measure):
-    fill = stream.Part()
-    fill.id = 'DrumFill'
-    for measure in range(num_measures):
-        measure_offset = (start_measure + measure) * 4.0
-        for beat in [0, 1, 2, 3]:
-            snare = note.Unpitched()
-            snare.ps = 38  # Snare Drum
-            snare.duration = duration.Duration(0.5)
-            snare.volume.velocity = 80
-            snare.offset = measure_offset + beat * 0.5
-            fill.append(snare)
-    # Setzen des MIDI-Kanals für Percussion
-    for n in fill.recurse().notes:
-        n.channel = 9  # General MIDI Percussion Channel
-    return fill
+# Generierung ohne GUI-Abhängigkeiten liegt in psy_core.py, hier nur die Oberfläche und die Wiedergabe
+from psy_core import SECTIONS, SONG_RETRIES, TRACK_NAMES, build_song_model, write_song
+from batch import with_retries
+from playback import IDLE, PLAYING, STOPPING, FluidSynthOutput, PlaybackEngine, song_messages
 
 # ================== GUI-Klasse ==================
 
@@ -217,9 +19,11 @@ class SongGeneratorGUI:
         
         self.soundfont_path = None
         self.current_midi_file = None
-        self.fs = None  # FluidSynth instance
-        self.play_thread = None
-        self.is_playing = False
+        self.current_song = None  # Nachrichten des zuletzt generierten Songs
+        self.model = None  # Song-Modell für das Neu-Erzeugen einzelner Abschnitte
+        self.engine = None  # Dauerhafte Wiedergabe-Engine, Synth und SoundFont bleiben geladen
+        self.endless = tk.BooleanVar(value=False)
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # SoundFont Auswahl
         self.select_sf_button = tk.Button(master, text="SoundFont auswählen", command=self.select_soundfont)
@@ -236,6 +40,22 @@ class SongGeneratorGUI:
         # Next Button
         self.next_button = tk.Button(master, text="Next", command=self.generate_and_play, state=tk.DISABLED)
         self.next_button.pack(pady=5)
+
+        # Endlos-Wiedergabe: der nächste Song wird im Hintergrund erzeugt und lückenlos angehängt
+        self.endless_check = tk.Checkbutton(master, text="Endlos", variable=self.endless)
+        self.endless_check.pack()
+
+        # Einzelnen Abschnitt bzw. eine Spur eines Abschnitts neu würfeln
+        reroll_frame = tk.Frame(master)
+        reroll_frame.pack(pady=5)
+        section_choices = [f"{i + 1}: {name}" for i, name in enumerate(SECTIONS)]
+        self.reroll_section = tk.StringVar(value=section_choices[0])
+        self.reroll_track = tk.StringVar(value="Alle Spuren")
+        tk.OptionMenu(reroll_frame, self.reroll_section, *section_choices).pack(side=tk.LEFT)
+        tk.OptionMenu(reroll_frame, self.reroll_track, "Alle Spuren", *TRACK_NAMES).pack(side=tk.LEFT)
+        self.reroll_button = tk.Button(reroll_frame, text="Neu würfeln", command=self.reroll_block,
+                                       state=tk.DISABLED)
+        self.reroll_button.pack(side=tk.LEFT)
         
         # Status Label
         self.status_label = tk.Label(master, text="Bitte wählen Sie eine SoundFont-Datei aus.")
@@ -247,6 +67,15 @@ class SongGeneratorGUI:
             filetypes=[("SoundFont Dateien", "*.sf2")]
         )
         if file_path:
+            try:
+                if self.engine is None:
+                    self.engine = PlaybackEngine(FluidSynthOutput(file_path),
+                                                 on_state_change=self.on_playback_state)
+                else:
+                    self.engine.output.load_soundfont(file_path)
+            except Exception as e:
+                messagebox.showerror("Fehler", f"SoundFont konnte nicht geladen werden: {e}")
+                return
             self.soundfont_path = file_path
             self.status_label.config(text=f"Ausgewählte SoundFont: {os.path.basename(file_path)}")
             self.play_button.config(state=tk.NORMAL)
@@ -259,141 +88,126 @@ class SongGeneratorGUI:
             self.stop_button.config(state=tk.DISABLED)
 
     def generate_and_play(self):
-        if self.is_playing:
-            self.stop_song()
         self.status_label.config(text="Generiere neuen Song...")
         self.master.update_idletasks()
-        # Generiere neuen Song
-        self.generate_song()
-        # Spiele den neuen Song ab
-        self.play_song()
+        # Generiere neuen Song, spiele ihn ab; ein laufender Song wird sofort abgebrochen
+        if self.generate_song() and self.engine is not None:
+            self.engine.play(self.current_song, label=self.current_midi_file)
 
     def generate_song(self):
         # Generiere den Song
-        self.generate_piece()
+        if not self.generate_piece():
+            self.status_label.config(text="Es konnte kein Song erzeugt werden.")
+            return False
         self.status_label.config(text="Song generiert und bereit zur Wiedergabe.")
+        return True
 
     def play_song(self):
-        if not self.current_midi_file:
+        if not self.current_song:
             messagebox.showerror("Fehler", "Kein MIDI-File zum Abspielen vorhanden.")
             return
-        if not self.soundfont_path:
+        if not self.engine:
             messagebox.showerror("Fehler", "Bitte wählen Sie eine SoundFont-Datei aus.")
             return
-        if self.is_playing:
+        if self.engine.state == PLAYING:
             messagebox.showinfo("Info", "Ein Song wird bereits abgespielt.")
             return
-        # Starten der Wiedergabe in einem separaten Thread
-        self.play_thread = threading.Thread(target=self.play_midi)
-        self.play_thread.start()
+        self.engine.play(self.current_song, label=self.current_midi_file)
 
-    def play_midi(self):
-        self.is_playing = True
-        self.status_label.config(text="Wiedergabe läuft...")
-        try:
-            if not self.fs:
-                self.fs = fluidsynth.Synth()
-                # Starten von FluidSynth mit dem entsprechenden Treiber
-                # "alsa" für Linux, "coreaudio" für macOS, "dsound" für Windows
-                driver = "dsound" if os.name == 'nt' else "alsa"
-                # Für macOS könnte es erforderlich sein, den Treiber auf "coreaudio" zu setzen
-                if sys.platform == 'darwin':
-                    driver = "coreaudio"
-                self.fs.start(driver=driver)
-                sfid = self.fs.sfload(self.soundfont_path)
-                self.fs.program_select(0, sfid, 0, 0)  # Kanal 0, SoundFont 0, Preset 0
-            # Laden und Abspielen des MIDI-Files
-            self.fs.play_midi(self.current_midi_file)
-        except AttributeError as ae:
-            messagebox.showerror("Fehler", f"Fehler beim Abspielen des Songs: {ae}")
-        except Exception as e:
-            messagebox.showerror("Fehler", f"Fehler beim Abspielen des Songs: {e}")
-        self.is_playing = False
-        self.status_label.config(text="Wiedergabe beendet.")
-        if self.fs:
-            self.fs.delete()
-            self.fs = None
+    def queue_next_song(self):
+        # Läuft im Hintergrund-Thread, damit die Wiedergabe nicht unterbrochen wird. Tkinter ist nicht
+        # thread-sicher: hier entstehen nur Modell und MIDI, übernommen wird der Song (oder der Fehler)
+        # im Tk-Thread
+        self.master.after(0, self.enqueue_song, *self.make_song())
+
+    def enqueue_song(self, model, messages, midi_file, error):
+        if self.show_song(model, messages, midi_file, error) and self.engine is not None:
+            self.engine.enqueue(self.current_song, label=self.current_midi_file)
+
+    def reroll_block(self):
+        if self.model is None:
+            return
+        section_index = int(self.reroll_section.get().split(':')[0]) - 1
+        track = self.reroll_track.get()
+        changed = self.model.regenerate(section=section_index,
+                                        track=None if track == "Alle Spuren" else track)
+        if track == "Alle Spuren" and section_index > 0:
+            # Neue Tonart: der Übergang am Ende des vorigen Abschnitts muss in allen Spuren über den
+            # Akkorden mitziehen (Chords samt Strings). Mit den alten Seeds ändern sich nur die Übergangstakte
+            for name in ('Melody', 'Chords', 'Bass'):
+                self.model.refresh(section=section_index - 1, track=name)
+        self.write_current_song()
+        self.status_label.config(text=f"Neu erzeugt: {', '.join(changed)}")
+        if self.engine is not None:
+            self.engine.play(self.current_song, label=self.current_midi_file)
+
+    def on_playback_state(self, state, label):
+        # Wird vom Scheduler-Thread aufgerufen, Tk-Zugriffe laufen über den Haupt-Thread
+        self.master.after(0, self.show_playback_state, state, label)
+
+    def show_playback_state(self, state, label):
+        if state == PLAYING:
+            self.status_label.config(text="Wiedergabe läuft...")
+            if self.endless.get():
+                threading.Thread(target=self.queue_next_song, daemon=True).start()
+        elif state == STOPPING:
+            self.status_label.config(text="Wiedergabe gestoppt.")
+        elif state == IDLE:
+            self.status_label.config(text="Wiedergabe beendet.")
 
     def stop_song(self):
-        if self.fs:
-            try:
-                self.fs.stop()
-                self.fs.delete()
-                self.fs = None
-                self.is_playing = False
-                self.status_label.config(text="Wiedergabe gestoppt.")
-            except Exception as e:
-                messagebox.showerror("Fehler", f"Fehler beim Stoppen des Songs: {e}")
+        if self.engine and self.engine.stop():
+            self.status_label.config(text="Wiedergabe gestoppt.")
         else:
             self.status_label.config(text="Keine Wiedergabe läuft.")
 
+    def on_close(self):
+        if self.engine is not None:
+            self.engine.shutdown()
+        self.master.destroy()
+
     def generate_piece(self):
         # Generieren des gesamten Stücks
-        s = stream.Stream()
-        s.insert(0, tempo.MetronomeMark(number=BPM))
-        s.insert(0, meter.TimeSignature(random.choice(time_signature_options)))  # Zufällige Taktart auswählen
-
-        sections = ['intro', 'verse', 'chorus', 'verse', 'bridge', 'chorus', 'outro']
-        total_measures = 0
-
-        melody = stream.Part()
-        chords = stream.Part()
-        bass = stream.Part()
-        strings = stream.Part()
-        drums = stream.Part()
-
-        for section in sections:
-            key_signature, scale_obj = get_random_key_and_scale()
-            chord_progression = get_random_chord_progression(section)
-
-            # Einfügen der Tonart an der richtigen Position
-            s.insert(total_measures * 4, key_signature)
-
-            # Generieren der einzelnen Abschnitte
-            melody_section = generate_melody_section(SECTION_MEASURES, scale_obj, chord_progression)
-            melody.append(melody_section)
-
-            chords_section = generate_chords_section(SECTION_MEASURES, chord_progression)
-            chords.append(chords_section)
-
-            bass_section = generate_bass_section(SECTION_MEASURES, chord_progression)
-            bass.append(bass_section)
-
-            strings_section = generate_strings_section(SECTION_MEASURES, scale_obj, chord_progression)
-            strings.append(strings_section)
-
-            drums_section = generate_techno_beat_section(SECTION_MEASURES, total_measures)
-            if section in ['chorus', 'outro']:
-                fill = generate_fill_in(2, total_measures + SECTION_MEASURES)
-                drums.append(fill)  # Fügen Sie das Fill-In hinzu
-            drums.append(drums_section)
-
-            total_measures += SECTION_MEASURES
-
-        # Instrumentenzuweisungen
-        melody.insert(0, instrument.ElectricOrgan())  # Korrigiert auf ElectricOrgan
-        chords.insert(0, instrument.ElectricGuitar())
-        bass.insert(0, instrument.ElectricBass())
-        strings.insert(0, instrument.StringInstrument())
-
-        # Hinzufügen aller Parts zum Hauptstream
-        s.insert(0, drums)
-        s.insert(0, strings)
-        s.insert(0, bass)
-        s.insert(0, chords)
-        s.insert(0, melody)
-
-        # Dateiname mit Zeitstempel generieren
-        current_time = datetime.now().strftime('%Y%m%d_%H%M%S')
-        midi_filename = f'Song_{GENRE}_{current_time}.mid'
-        self.current_midi_file = os.path.join(os.getcwd(), midi_filename)
-
-        # MIDI-Datei speichern
+        return self.show_song(*self.make_song())
+
+    def write_current_song(self):
+        return self.show_song(self.model, *self.render_song(self.model))
+
+    def make_song(self):
+        # Ohne Tk-Zugriffe, läuft auch im Hintergrund-Thread. Schlägt die Erzeugung fehl, wird sie wie
+        # in psy_core mit neuen Seeds wiederholt; liefert (Modell, Nachrichten, Datei, Fehlertext)
+        model, _, errors = with_retries(build_song_model, random.randrange(2 ** 32), SONG_RETRIES)
+        if model is None:
+            error = errors[-1]
+            return None, None, None, f"Song konnte nicht erzeugt werden: {error['error']}: {error['message']}"
+        return (model,) + self.render_song(model)
+
+    def render_song(self, model):
+        # Ohne Tk-Zugriffe: Nachrichten für die Wiedergabe direkt aus dem Speicher, dazu die MIDI-Datei
+        # mit Zeitstempel im Namen; liefert (Nachrichten, Datei, Fehlertext)
+        try:
+            messages = song_messages(model.tracks(), model.grid.tempo_map)
+        except Exception as e:
+            return None, None, f"Song konnte nicht gerendert werden: {e}"
         try:
-            s.write('midi', fp=self.current_midi_file)
-            print(f"The piece was successfully saved as '{midi_filename}' in {os.getcwd()}.")
+            midi_file = write_song(model)
         except Exception as e:
-            messagebox.showerror("Fehler", f"Error saving MIDI file: {e}")
+            return messages, None, f"Error saving MIDI file: {e}"
+        print(f"The piece was successfully saved as '{os.path.basename(midi_file)}' in {os.getcwd()}.")
+        return messages, midi_file, None
+
+    def show_song(self, model, messages, midi_file, error):
+        # Nur im Tk-Thread: übernimmt den fertigen Song, aktualisiert die Oberfläche und zeigt Fehler an;
+        # False, wenn kein neuer Song zur Wiedergabe bereitsteht
+        if messages is not None:
+            self.model = model
+            self.current_song = messages
+            if midi_file is not None:
+                self.current_midi_file = midi_file
+            self.reroll_button.config(state=tk.NORMAL)
+        if error is not None:
+            messagebox.showerror("Fehler", error)
+        return messages is not None
 
 # ================== Hauptfunktion ==================
 
@@ -0,0 +1,258 @@
+"""Headless-Kern der Psytrance-Engine: Song-Modell, MIDI-Export und Kommandozeile.
+
+Importiert weder tkinter noch music21, fluidsynth oder rtmidi, läuft also auch
+auf Render-Knoten ohne Display und Audio. Die GUI (Song_Engine_psy.py) baut
+auf diesem Modul auf; der Live-Modus lädt seine MIDI-Module erst beim Start.
+
+    python psy_core.py --count 10 --seed 1 --out renders
+    python psy_core.py --live "Song Engine"
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+# Gemeinsame Engine-Module liegen im Hauptverzeichnis
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from batch import with_retries
+from comping import comp_parts
+from drum_patterns import drum_events
+from groove import groove_pass
+from measure_grid import MeasureGrid
+from midi_writer import assign_channels
+from modulation import key_signature, modulation_table
+from sequencer import sequence
+from song_events import Track, empty_events, pitch_class
+from song_model import SongModel
+from song_spec import chord_table
+from tempo_map import TempoMap
+
+# ================== Globale Einstellungen ==================
+
+# Constants
+BPM = 140  # Erhöht für einen typischen Techno/Psytrance-Charakter
+SECTION_MEASURES = 16  # Anzahl der Takte pro Abschnitt (z.B. verse, chorus)
+
+# Ein Song, dessen Erzeugung fehlschlägt, wird mit so vielen neuen Seeds wiederholt
+SONG_RETRIES = 2
+
+# Humanisierung nach der Erzeugung: None, 'straight', 'shuffle', 'pop', 'techno', 'psy'
+GROOVE = 'psy'
+
+# Tempo-Automation, wird als eigene Conductor-Spur geschrieben
+SECTION_TEMPOS = {}  # Tempo pro Abschnitt, z.B. {'chorus': 145, 'outro': 128}
+TEMPO_RAMP_BEATS = 0.0  # Schläge für den Übergang zum neuen Abschnittstempo (0 = Sprung)
+
+# Taktarten
+time_signature_options = ['4/4', '3/4']
+
+# Genre-Auswahl
+GENRE = "psytrance"  # Optionen: "psytrance", "classic", "synth"
+
+# Instrumente als General-MIDI-Programme: E-Orgel, E-Gitarre, E-Bass, Streicher
+PROGRAMS = {'Melody': 16, 'Chords': 26, 'Bass': 33, 'Strings': 48}
+
+# Scale and Key options for variation, ensuring harmony
+keys_and_scales_options = [
+    ('C', 'MajorScale'),
+    ('G', 'MajorScale'),
+    ('A', 'MinorScale'),
+    ('D', 'MinorScale'),
+    ('F', 'MajorScale'),
+    ('E', 'MinorScale'),
+    ('Bb', 'MajorScale'),
+]
+
+# Tonartwechsel: Takte am Abschnittsende, die über einen Pivot-Akkord in die nächste Tonart führen (0 = Sprung)
+MODULATION_BARS = 2
+# Vorberechnete Modulationen zwischen allen Tonarten oben; Akkordnamen mit '-' für b ('B-')
+MODULATIONS = modulation_table(tuple((pitch_class(k), 'major' if s == 'MajorScale' else 'minor')
+                                     for k, s in keys_and_scales_options), MODULATION_BARS, flat='-')
+
+# Step-Sequencer (sequencer.PATTERNS): jeder Abschnitt spielt eines der Muster, zufällig gewählt
+MELODY_SEQUENCES = ['arp_up', 'arp_updown', 'arp_gated', 'arp_random']
+BASS_SEQUENCES = ['rolling', 'rolling_octave', 'gallop']
+MELODY_LOW = 57  # Tiefster Grundton der Melodie (A3), die Arpeggien laufen zwei Oktaven hoch
+BASS_LOW = 36  # Tiefster Grundton des Basses (C2)
+MELODY_VELOCITY, MELODY_ACCENT = 80, 100
+BASS_VELOCITY, BASS_ACCENT = 100, 120
+
+# Begleitmuster für Akkorde und Streicher (comping.COMP_PATTERNS), z.B. 'pad', 'stabs', 'arp_up'
+COMPING = {'Chords': 'pad', 'Strings': 'pad'}
+CHORDS_VELOCITY = 90
+STRINGS_VELOCITY = 60
+
+# Chord progressions with randomized but harmonic options
+chord_progressions_options = {
+    'intro': [['Am', 'F', 'C', 'G'], ['Am', 'F', 'C', 'G']],
+    'verse': [['Am', 'F', 'C', 'G'], ['Dm', 'Am', 'Bb', 'F'], ['Em', 'C', 'G', 'D']],
+    'chorus': [['C', 'G', 'Am', 'F'], ['F', 'G', 'Am', 'C'], ['C', 'G', 'F', 'Am']],
+    'bridge': [['Dm', 'Am', 'Bb', 'F'], ['Gm', 'Bb', 'C', 'Dm'], ['Am', 'F', 'C', 'G']],
+    'outro': [['Am', 'F', 'C', 'G'], ['Am', 'F', 'C', 'G']],
+}
+
+# ================== Musikgenerierungsfunktionen ==================
+
+# Funktion zur zufälligen Auswahl der Tonart als (Grundton-Tonklasse, Tongeschlecht)
+def get_random_tonality():
+    key_name, scale_type = random.choice(keys_and_scales_options)
+    return pitch_class(key_name), 'minor' if scale_type == 'MinorScale' else 'major'
+
+# Funktion zur zufälligen Auswahl der Akkordprogression für einen Abschnitt
+def get_random_chord_progression(section):
+    return random.choice(chord_progressions_options[section])
+
+# Melodie oder Bass eines Abschnitts als Step-Sequenz über die Akkorde jedes Takts;
+# die 16tel-Linien entstehen für den ganzen Abschnitt auf einmal aus den Musterarrays
+def generate_sequence_block(grid, section_index, chord_progression, patterns, low, velocity, accent, rng):
+    pattern = patterns[rng.integers(len(patterns))]
+    return sequence(pattern, chord_table(tuple(chord_progression)), grid.section_bar_lengths(section_index),
+                    low, velocity, accent, rng)
+
+# Akkorde und Streicher eines Abschnitts als Noten-Events; beide Spuren teilen sich die
+# einmal berechneten Voicings der Akkordtabelle, beim Schreiben wird nichts mehr aufgelöst
+def generate_comping_block(grid, section_index, chord_progression):
+    return comp_parts(chord_table(tuple(chord_progression)), grid.section_bar_lengths(section_index),
+                      [(COMPING['Chords'], CHORDS_VELOCITY), (COMPING['Strings'], STRINGS_VELOCITY)])
+
+# ================== Song-Modell ==================
+
+SECTIONS = ['intro', 'verse', 'chorus', 'verse', 'bridge', 'chorus', 'outro']
+TRACK_NAMES = ['Melody', 'Chords', 'Bass', 'Strings', 'Drums']
+
+# Tonart und Akkordfolge eines Abschnitts, gemeinsam für alle Spuren des Abschnitts
+def plan_section(section):
+    return {'tonality': get_random_tonality(), 'progression': get_random_chord_progression(section)}
+
+# Akkorde jedes Takts eines Abschnitts; die letzten Takte führen in die Tonart des nächsten Abschnitts
+def section_progression(model, section_index):
+    context = model.context(section_index)
+    num_measures = model.grid.section_measures(section_index)
+    progression = context['progression']
+    bars = [progression[i % len(progression)] for i in range(num_measures)]
+    if section_index + 1 < model.grid.num_sections:
+        transition = MODULATIONS.transition(context['tonality'], model.context(section_index + 1)['tonality'])
+        if 0 < len(transition) < num_measures:
+            bars[-len(transition):] = transition
+    return bars
+
+# Schlagzeug eines Abschnitts aus der Pattern-Bibliothek; das Fill-In ersetzt die letzten zwei Takte
+def generate_drums_block(grid, section_index):
+    bar = int(grid.section_start_bar[section_index])
+    fills = {-2: 'snare_roll'} if SECTIONS[section_index] in ['chorus', 'outro'] else None
+    return drum_events(grid.section_measures(section_index), 'psy', int(grid.beats_in_bar[bar]),
+                       float(grid.beat_length[bar]), fills=fills)
+
+# Baut das Song-Modell; jeder Abschnitt und jede Spur lässt sich später einzeln neu erzeugen
+def build_song_model(seed=None):
+    time_signature = random.Random(seed).choice(time_signature_options)  # Zufällige Taktart, mit Seed reproduzierbar
+    # Takt- und Schlagraster wird einmal pro Song berechnet und von allen Generatoren geteilt
+    grid = MeasureGrid.from_sections(SECTIONS, SECTION_MEASURES, time_signature, bpm=BPM)
+    # Tempo-Map für die Conductor-Spur, die Noten bleiben in Schlägen
+    grid.tempo_map = TempoMap.from_sections(
+        grid, [SECTION_TEMPOS.get(name, BPM) for name in SECTIONS], ramp_beats=TEMPO_RAMP_BEATS)
+
+    # Spuren mit Instrumentenzuweisungen (General-MIDI-Programme)
+    tracks = [
+        Track('Melody', empty_events(), program=PROGRAMS['Melody']),
+        Track('Chords', empty_events(), program=PROGRAMS['Chords']),
+        Track('Bass', empty_events(), program=PROGRAMS['Bass']),
+        Track('Strings', empty_events(), program=PROGRAMS['Strings']),
+        Track('Drums', empty_events(), is_drum=True),
+    ]
+    assign_channels(tracks)
+
+    model = SongModel(grid, tracks, seed, plan_section=lambda index, rng: plan_section(SECTIONS[index]),
+                      post_process=groove_pass(GROOVE, grid))
+    model.add_generator('Melody', lambda index, ctx, rng: generate_sequence_block(
+        grid, index, section_progression(model, index), MELODY_SEQUENCES, MELODY_LOW,
+        MELODY_VELOCITY, MELODY_ACCENT, rng))
+    model.add_generator(('Chords', 'Strings'), lambda index, ctx, rng: generate_comping_block(
+        grid, index, section_progression(model, index)))
+    model.add_generator('Bass', lambda index, ctx, rng: generate_sequence_block(
+        grid, index, section_progression(model, index), BASS_SEQUENCES, BASS_LOW,
+        BASS_VELOCITY, BASS_ACCENT, rng))
+    model.add_generator('Drums', lambda index, ctx, rng: generate_drums_block(grid, index))
+    return model.build()
+
+# Tonarten aller Abschnitte für die Conductor-Spur
+def model_key_signatures(model):
+    key_signatures = []
+    for section_index in range(model.grid.num_sections):
+        tonality = model.context(section_index)['tonality']
+        key_signatures.append((model.grid.section_offset(section_index), key_signature(tonality),
+                               tonality[1] == 'minor'))
+    return key_signatures
+
+# MIDI-Datei eines Songs schreiben: Conductor-Spur mit Tempo, Taktart und Tonarten plus Notenspuren.
+# Nur geänderte Spuren werden neu kodiert, der Rest kommt aus dem Modell-Cache
+def write_song(model, out_dir=None, filename=None):
+    if filename is None:
+        filename = f'Song_{GENRE}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.mid'
+    path = os.path.join(out_dir or os.getcwd(), filename)
+    with open(path, 'wb') as f:
+        f.write(model.midi_bytes(model_key_signatures(model)))
+    return path
+
+# Mehrere Songs nacheinander; mit Seed tragen die Dateien ihren Seed im Namen und sind reproduzierbar.
+# Schlägt ein Song auch mit neuen Seeds fehl, gehen die Fehler nach stderr und statt des Pfads kommt None
+def generate_songs(count, first_seed=None, out_dir=None):
+    for i in range(count):
+        seed = random.randrange(2 ** 32) if first_seed is None else first_seed + i
+        model, _, errors = with_retries(build_song_model, seed, SONG_RETRIES)
+        for error in errors:
+            print(f"Seed {error['seed']}: {error['error']}: {error['message']}", file=sys.stderr)
+        if model is None:
+            yield None
+            continue
+        filename = None if first_seed is None and count == 1 else f'Song_{GENRE}_{model.seed}.mid'
+        yield write_song(model, out_dir, filename)
+
+# Endlose Folge von Abschnitten; der nächste Song entsteht, während der aktuelle läuft
+def live_sections():
+    from realtime import song_sections
+
+    while True:
+        model = build_song_model()
+        yield from song_sections(model.tracks(), model.grid)
+
+# Live-Modus für Installationen: spielt endlos auf einen virtuellen MIDI-Port (ALSA unter Linux)
+def run_live(port_name='Song Engine'):
+    from realtime import RealtimeStreamer, RtMidiOutput
+
+    streamer = RealtimeStreamer(live_sections(), RtMidiOutput(port_name)).start()
+    try:
+        while True:
+            time.sleep(10)
+            print(streamer.jitter_stats())
+    except KeyboardInterrupt:
+        streamer.stop()
+
+# ================== Kommandozeile ==================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Psytrance-Songs ohne GUI als MIDI-Dateien erzeugen.")
+    parser.add_argument('--count', type=int, default=1, help="Anzahl der Songs (Standard: 1)")
+    parser.add_argument('--seed', type=int, help="Seed des ersten Songs, die weiteren zählen hoch")
+    parser.add_argument('--out', default=os.getcwd(), help="Zielverzeichnis (Standard: aktuelles Verzeichnis)")
+    parser.add_argument('--live', nargs='?', const='Song Engine', metavar='PORT',
+                        help="Endlos auf einen virtuellen MIDI-Port spielen statt Dateien zu schreiben")
+    args = parser.parse_args(argv)
+    if args.live:
+        run_live(args.live)
+        return 0
+    os.makedirs(args.out, exist_ok=True)
+    failed = 0
+    for path in generate_songs(args.count, args.seed, args.out):
+        if path is None:
+            failed += 1
+            continue
+        print(f"The piece was successfully saved as '{os.path.basename(path)}' in {args.out}.")
+    if failed:
+        print(f"{failed} of {args.count} songs could not be generated.", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
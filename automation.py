@@ -0,0 +1,86 @@
+"""Time-based automation lanes for velocity and MIDI controllers.
+
+An Envelope is a piecewise linear curve of levels (0.0-1.0 and above) over
+beats. It is evaluated for all notes of a track at once to scale their
+velocities, or sampled into sparse controller changes (CC7 volume, CC11
+expression) that midi_writer and playback send alongside the notes.
+"""
+import numpy as np
+
+from song_events import CONTROLLER_DTYPE, Track
+
+CC_VOLUME = 7
+CC_EXPRESSION = 11
+
+
+class Envelope:
+    """Piecewise linear level over beats; constant before and after its points."""
+
+    def __init__(self, points):
+        points = sorted((float(beat), float(level)) for beat, level in points)
+        if not points:
+            raise ValueError("An envelope needs at least one point")
+        self.beats = np.array([b for b, _ in points])
+        self.levels = np.array([v for _, v in points])
+        self.beats.setflags(write=False)
+        self.levels.setflags(write=False)
+
+    @classmethod
+    def ramp(cls, start_beat, end_beat, start_level, end_level):
+        return cls([(start_beat, start_level), (end_beat, end_level)])
+
+    @classmethod
+    def fade_out(cls, end_beat, length):
+        return cls.ramp(end_beat - length, end_beat, 1.0, 0.0)
+
+    @classmethod
+    def fade_in(cls, length, start_beat=0.0):
+        return cls.ramp(start_beat, start_beat + length, 0.0, 1.0)
+
+    def __call__(self, beats):
+        return np.interp(beats, self.beats, self.levels)
+
+
+def scale_velocities(events, envelope):
+    """Copy of events with velocities scaled by the envelope at each onset.
+
+    Notes scaled below velocity 1 are dropped instead of sounding at 1.
+    """
+    velocity = np.rint(events['velocity'] * envelope(events['onset']))
+    out = events[velocity >= 1].copy()
+    out['velocity'] = np.minimum(velocity[velocity >= 1], 127)
+    return out
+
+
+def controller_changes(envelope, controller, start_beat=None, end_beat=None, resolution=0.25):
+    """Sample an envelope into sparse CONTROLLER_DTYPE changes.
+
+    Levels map to 0-127; a value is only emitted when it differs from the
+    previous one, so flat stretches cost nothing.
+    """
+    start_beat = envelope.beats[0] if start_beat is None else start_beat
+    end_beat = envelope.beats[-1] if end_beat is None else end_beat
+    beats = np.union1d(np.arange(start_beat, end_beat, resolution), [end_beat])
+    values = np.clip(np.rint(envelope(beats) * 127), 0, 127).astype(np.uint8)
+    keep = np.concatenate(([True], values[1:] != values[:-1]))
+    changes = np.zeros(int(keep.sum()), dtype=CONTROLLER_DTYPE)
+    changes['beat'] = beats[keep]
+    changes['controller'] = controller
+    changes['value'] = values[keep]
+    return changes
+
+
+def automate(track, velocity=None, volume=None, expression=None, resolution=0.25):
+    """New Track with velocity scaled and CC7/CC11 lanes added from envelopes.
+
+    Each of velocity, volume and expression is an Envelope or None.
+    """
+    events = track.events if velocity is None else scale_velocities(track.events, velocity)
+    lanes = [track.controllers]
+    for controller, envelope in ((CC_VOLUME, volume), (CC_EXPRESSION, expression)):
+        if envelope is not None:
+            lanes.append(controller_changes(envelope, controller, resolution=resolution))
+    controllers = np.concatenate(lanes)
+    controllers = controllers[np.argsort(controllers['beat'], kind='stable')]
+    return Track(track.name, events, track.program, track.channel, track.is_drum, controllers,
+                 track.port)
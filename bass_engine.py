@@ -0,0 +1,117 @@
+"""Bass line engine working on integer pitch classes.
+
+A whole section is generated in one batched NumPy pass from a compiled
+chord progression, no music21 Pitch objects are created on the way.
+"""
+import random
+from functools import lru_cache
+
+import numpy as np
+
+from song_events import compile_progression, empty_events, make_events
+
+BASS_ROOT_MIDI = 36  # C2, chord roots land between C2 and B2
+
+# One bar per entry as (onset, duration) pairs in beats, written for 4/4
+BASS_RHYTHMS = {
+    'root_fifth': (
+        ((0.0, 2.0), (2.0, 2.0)),
+        ((0.0, 1.0), (1.0, 1.0), (2.0, 1.0), (3.0, 1.0)),
+        ((0.0, 1.5), (1.5, 0.5), (2.0, 2.0)),
+        ((0.0, 1.0), (1.0, 2.0), (3.0, 1.0)),
+    ),
+    'walking': (
+        ((0.0, 1.0), (1.0, 1.0), (2.0, 1.0), (3.0, 1.0)),
+        ((0.0, 1.0), (1.0, 1.0), (2.0, 1.0), (3.0, 0.5), (3.5, 0.5)),
+    ),
+    'octave': (
+        tuple((i * 0.5, 0.5) for i in range(8)),
+        tuple((i * 0.5, 0.25) for i in range(8)),
+        ((0.0, 0.5), (0.5, 0.5), (1.5, 0.5), (2.0, 0.5), (2.5, 0.5), (3.5, 0.5)),
+    ),
+}
+
+BASS_STYLES = tuple(BASS_RHYTHMS)
+
+
+@lru_cache(maxsize=None)
+def _rhythm_table(style, beats_per_bar):
+    # Clip the 4/4 tables to the bar length once per style and meter
+    table = []
+    for pattern in BASS_RHYTHMS[style]:
+        kept = [(o, min(d, beats_per_bar - o)) for o, d in pattern if o < beats_per_bar]
+        onsets = np.array([o for o, _ in kept])
+        durations = np.array([d for _, d in kept])
+        table.append((onsets, durations))
+    return tuple(table)
+
+
+def _chord_intervals(progression):
+    # Chord tones as intervals above the root, padded by repeating the root
+    width = max(len(t) for t in progression.tones)
+    intervals = np.zeros((len(progression), width), dtype=np.int16)
+    counts = np.zeros(len(progression), dtype=np.int16)
+    for i, tones in enumerate(progression.tones):
+        intervals[i, :len(tones)] = [(t - tones[0]) % 12 for t in tones]
+        counts[i] = len(tones)
+    return intervals, counts
+
+
+def generate_bassline(chord_progression, num_measures, style='root_fifth', start_offset=0.0,
+                      velocity=70, beats_per_bar=4.0, rng=None, track=0):
+    """Generate a section's bass line as an event array.
+
+    chord_progression may be chord names or a CompiledProgression, one chord
+    per bar. Styles: 'walking', 'octave' (octave pumping) and 'root_fifth'.
+    """
+    if style not in BASS_RHYTHMS:
+        raise ValueError(f"Unknown bass style {style!r}, choose from {BASS_STYLES}")
+    if num_measures <= 0:
+        return empty_events()
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(32))
+
+    progression = compile_progression(chord_progression)
+    chord_index = progression.per_bar(num_measures)
+    roots = progression.roots[chord_index]
+    next_roots = progression.roots[(chord_index + 1) % len(progression)]
+    table = _rhythm_table(style, float(beats_per_bar))
+    pattern_choice = rng.integers(0, len(table), size=num_measures)
+
+    onsets, durations, bars, steps, last = [], [], [], [], []
+    for pattern_id, (pattern_onsets, pattern_durations) in enumerate(table):
+        pattern_bars = np.flatnonzero(pattern_choice == pattern_id)
+        if not len(pattern_bars) or not len(pattern_onsets):
+            continue
+        n = len(pattern_onsets)
+        bars.append(np.repeat(pattern_bars, n))
+        steps.append(np.tile(np.arange(n), len(pattern_bars)))
+        last.append(np.tile(np.arange(n) == n - 1, len(pattern_bars)))
+        onsets.append(np.tile(pattern_onsets, len(pattern_bars)))
+        durations.append(np.tile(pattern_durations, len(pattern_bars)))
+    if not bars:
+        return empty_events()
+    bars = np.concatenate(bars)
+    steps = np.concatenate(steps)
+    last = np.concatenate(last)
+    onsets = np.concatenate(onsets) + bars * beats_per_bar + start_offset
+    durations = np.concatenate(durations)
+
+    root_midi = BASS_ROOT_MIDI + roots[bars].astype(np.int16)
+    if style == 'root_fifth':
+        pitches = root_midi + 7 * (steps % 2)
+    elif style == 'octave':
+        pitches = root_midi + 12 * (steps % 2)
+    else:
+        # Walking: root on the downbeat, chord tones in between and a
+        # chromatic approach into the next bar's root on the last step
+        intervals, counts = _chord_intervals(progression)
+        bar_chords = chord_index[bars]
+        tone_pick = (rng.random(len(bars)) * counts[bar_chords]).astype(np.int64)
+        pitches = root_midi + intervals[bar_chords, tone_pick]
+        approach = BASS_ROOT_MIDI + next_roots[bars] + rng.choice((-1, 1), size=len(bars))
+        pitches = np.where(last & (steps > 0), approach, pitches)
+        pitches = np.where(steps == 0, root_midi, pitches)
+
+    events = make_events(onsets, durations, pitches, velocity, track)
+    return events[np.argsort(events['onset'], kind='stable')]
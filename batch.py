@@ -0,0 +1,169 @@
+"""Failure handling for long batch runs.
+
+A song that raises is retried with new seeds derived from its own, and
+every failure becomes a JSON serialisable error record: seed, attempt,
+error type and message and, for song_model.BlockError, the section and
+tracks of the failing block. Process pools run under a watchdog that
+replaces the pool when a worker dies or no task finishes in time and
+resubmits what was unfinished. Manifests are append-only JSON lines with
+one record per finished item, so an interrupted batch resumes where it
+stopped instead of starting over.
+"""
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import METRICS
+from song_model import BlockError, derive_seed
+
+
+def error_record(error, **where):
+    """Plain dict describing an exception; where adds context such as seed=..."""
+    record = dict(where)
+    if isinstance(error, BlockError):
+        record.update(error=error.error_type, message=error.message, section=error.section_index,
+                      tracks=list(error.track_names), location=error.location)
+    else:
+        record.update(error=type(error).__name__, message=str(error))
+    return record
+
+
+def retry_seeds(seed, retries):
+    """The seed itself, then retries new seeds derived from it."""
+    return [seed] + [derive_seed(seed, 'retry', attempt) for attempt in range(1, retries + 1)]
+
+
+def with_retries(make, seed, retries=2, **where):
+    """Call make(seed), on an exception again with a new seed, up to retries times.
+
+    Returns (result, seed used, error records); result and seed are None
+    when every attempt failed. Only Exception subclasses are caught, so an
+    interrupt still stops the batch.
+    """
+    errors = []
+    for attempt, attempt_seed in enumerate(retry_seeds(seed, retries)):
+        try:
+            return make(attempt_seed), attempt_seed, errors
+        except Exception as e:
+            errors.append(error_record(e, seed=attempt_seed, attempt=attempt, **where))
+            METRICS.inc('song_errors_total', error=errors[-1]['error'])
+    return None, None, errors
+
+
+class Manifest:
+    """Append-only JSON lines file of finished items, indexed by record[key].
+
+    A line torn by a crash is skipped on load, and the next append starts on
+    a fresh line. Use as a context manager or call close().
+    """
+
+    def __init__(self, path, key='seed'):
+        self.path = path
+        self.key = key
+        self.records = {}
+        self._file = None
+        self._torn = False
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    self._torn = not line.endswith('\n')
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record[key]] = record
+
+    def __contains__(self, item):
+        return item in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, item, default=None):
+        return self.records.get(item, default)
+
+    def append(self, record, durable=False):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if self._torn:
+                self._file.write('\n')
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self._file.flush()
+        if durable:
+            os.fsync(self._file.fileno())
+        self.records[record[self.key]] = record
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _stop_pool(executor, kill):
+    if kill:
+        # A hung or dead pool cannot shut down on its own; the executor offers no public kill
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            process.kill()
+    executor.shutdown(wait=True, cancel_futures=True)
+
+
+def run_pool(func, tasks, workers=None, stall_seconds=None, max_crashes=2):
+    """Run func(*task) for every task in a process pool under a watchdog.
+
+    Yields (task index, result, error record or None) as tasks finish. If
+    a worker process dies or no task finishes for stall_seconds (None =
+    wait forever), the pool is killed and a new one runs the unfinished
+    tasks. A task that was running during max_crashes such failures is
+    given up with a 'WorkerLost' record. Exceptions raised by func are
+    reported as error records, not retried.
+    """
+    pending = dict(enumerate(tasks))
+    crashes = dict.fromkeys(pending, 0)
+    restarts = 0
+    while pending:
+        executor = ProcessPoolExecutor(workers)
+        futures = {executor.submit(func, *task): index for index, task in pending.items()}
+        failure, running, finished = None, set(), False
+        try:
+            while futures and failure is None:
+                running = {index for future, index in futures.items() if future.running()}
+                done, _ = wait(futures, timeout=stall_seconds, return_when=FIRST_COMPLETED)
+                if not done:
+                    failure = f"no task finished for {stall_seconds} s"
+                for future in done:
+                    index = futures.pop(future)
+                    error = future.exception()
+                    if isinstance(error, BrokenProcessPool):
+                        failure = "a worker process died"
+                        continue
+                    del pending[index]
+                    if error is None:
+                        yield index, future.result(), None
+                    else:
+                        yield index, None, error_record(error, task=index)
+            finished = failure is None
+        finally:
+            _stop_pool(executor, kill=not finished)
+        if failure is None:
+            break
+        restarts += 1
+        METRICS.inc('pool_restarts_total')
+        # The tasks that were running are the suspects, or the first ones submitted if the pool
+        # failed before any was seen running; the rest simply run again
+        suspects = running & pending.keys() or set(list(pending)[:workers or os.cpu_count() or 1])
+        for index in sorted(suspects):
+            crashes[index] += 1
+            if crashes[index] >= max_crashes:
+                del pending[index]
+                yield index, None, {'task': index, 'error': 'WorkerLost', 'message': failure}
+        if restarts >= max_crashes * len(crashes):
+            for index in sorted(pending):
+                yield index, None, {'task': index, 'error': 'WorkerLost', 'message': "too many pool restarts"}
+            pending.clear()
@@ -0,0 +1,119 @@
+"""Chord parts (comping) rendered straight to note events.
+
+Chords are voiced once: song_spec.chord_table caches the voicings of a
+progression, and the rendered hit layout of a (chords, bars, pattern)
+combination is cached as well. A pattern turns the voicings into notes:
+
+    pad     the whole chord held for the bar
+    stabs   short chords on fixed offsets of every beat
+    arp     one chord tone per step, in up, down or updown order
+
+comp_parts() renders the chord track and the strings from the same chord
+table in one call, so nothing is realised twice and the MIDI writer only
+ever sees plain note events.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from song_events import make_events
+
+# kind is 'pad', 'stabs' or 'arp'. hits are offsets within every beat, length
+# the note length in beats (None = until the next hit), order the arpeggio
+# direction and octave a transposition in semitones
+CompPattern = namedtuple('CompPattern', 'kind hits length order octave')
+
+COMP_PATTERNS = {
+    'pad': CompPattern('pad', (0.0,), None, None, 0),
+    'pulse': CompPattern('stabs', (0.0,), 0.5, None, 0),
+    'stabs': CompPattern('stabs', (0.5,), 0.25, None, 0),  # Off-beat stabs
+    'gallop': CompPattern('stabs', (0.0, 0.75), 0.25, None, 0),
+    'arp_up': CompPattern('arp', (0.0, 0.25, 0.5, 0.75), None, 'up', 12),
+    'arp_down': CompPattern('arp', (0.0, 0.25, 0.5, 0.75), None, 'down', 12),
+    'arp_updown': CompPattern('arp', (0.0, 0.25, 0.5, 0.75), None, 'updown', 12),
+    'arp_8ths': CompPattern('arp', (0.0, 0.5), None, 'up', 12),
+}
+
+
+def comp_pattern(pattern):
+    """A CompPattern from a name of COMP_PATTERNS or a CompPattern."""
+    if isinstance(pattern, CompPattern):
+        return pattern
+    if pattern not in COMP_PATTERNS:
+        raise ValueError(f"Unknown comping pattern {pattern!r}, choose from {sorted(COMP_PATTERNS)}")
+    return COMP_PATTERNS[pattern]
+
+
+def _hits(bar_lengths, pattern):
+    # (bar, onset within the bar, length) of every hit, cut at the bar line
+    num_measures = len(bar_lengths)
+    if pattern.kind == 'pad':
+        return np.arange(num_measures), np.zeros(num_measures), bar_lengths.copy()
+    offsets = np.asarray(pattern.hits, dtype=np.float64)
+    beats = np.arange(int(np.ceil(bar_lengths.max())))
+    positions = (beats[:, None] + offsets[None, :]).ravel()
+    step = np.diff(np.append(offsets, offsets[0] + 1.0))  # Gap to the next hit, per offset
+    gaps = np.tile(step, len(beats))
+    keep = positions[None, :] < bar_lengths[:, None]
+    bars = np.broadcast_to(np.arange(num_measures)[:, None], keep.shape)[keep]
+    onsets = np.broadcast_to(positions, keep.shape)[keep]
+    lengths = np.broadcast_to(gaps if pattern.length is None else pattern.length, keep.shape)[keep]
+    return bars, onsets, np.minimum(lengths, bar_lengths[bars] - onsets)
+
+
+def _arp_index(counter, sizes, order):
+    # Position in the voicing of the n-th step of a bar
+    if order == 'down':
+        return sizes - 1 - counter % sizes
+    if order == 'updown':
+        period = np.maximum(2 * sizes - 2, 1)
+        step = counter % period
+        return np.where(step < sizes, step, period - step)
+    return counter % sizes
+
+
+@lru_cache(maxsize=256)
+def _render(table, bar_lengths, pattern):
+    # Read-only (onsets, durations, pitches) of a chord part
+    bar_lengths = np.array(bar_lengths, dtype=np.float64)
+    bar_offsets = np.cumsum(bar_lengths) - bar_lengths
+    chord_of_bar = table.progression.per_bar(len(bar_lengths))
+    bars, onsets, lengths = _hits(bar_lengths, pattern)
+    chords = chord_of_bar[bars]
+    sizes = table.voicing_sizes[chords]
+    if pattern.kind == 'arp':
+        first = np.searchsorted(bars, bars)  # Hits are sorted by bar, so this is the bar's first hit
+        tones = _arp_index(np.arange(len(bars)) - first, sizes, pattern.order)
+        pitches = table.voicings[chords, tones]
+    else:
+        # Every hit sounds the whole voicing
+        hit = np.repeat(np.arange(len(bars)), sizes)
+        tone = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        bars, onsets, lengths, pitches = bars[hit], onsets[hit], lengths[hit], table.voicings[chords[hit], tone]
+    rendered = (bar_offsets[bars] + onsets, lengths, pitches + pattern.octave)
+    for array in rendered:
+        array.setflags(write=False)
+    return rendered
+
+
+def comp(table, bar_lengths, pattern='pad', velocity=80):
+    """Note events of one chord part over consecutive bars.
+
+    table is a song_spec.ChordTable whose chords play one per bar, cycling;
+    bar_lengths holds the length of every bar in beats (a MeasureGrid's
+    section_bar_lengths). Onsets start at 0 for the first bar.
+    """
+    bar_lengths = tuple(float(b) for b in np.atleast_1d(bar_lengths))
+    if not bar_lengths:
+        return make_events([], [], [], velocity)
+    onsets, durations, pitches = _render(table, bar_lengths, comp_pattern(pattern))
+    return make_events(onsets, durations, pitches, velocity)
+
+
+def comp_parts(table, bar_lengths, parts):
+    """Event arrays of several chord parts, e.g. chords and strings, from one table.
+
+    parts is a sequence of (pattern, velocity) pairs.
+    """
+    return [comp(table, bar_lengths, pattern, velocity) for pattern, velocity in parts]
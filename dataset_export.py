@@ -0,0 +1,218 @@
+"""Training data export: piano rolls and token sequences in sharded NPZ files.
+
+Songs go straight from their event arrays to tensors; nothing is encoded to
+MIDI or parsed back. Worker processes each generate and write whole shards,
+so only seeds and shard paths cross process boundaries. Finished shards are
+logged in progress.jsonl, so an interrupted export resumes with the shards
+still missing; a song that fails is retried with a new seed (see batch.py).
+
+Shard layout (one .npz per shard, songs concatenated along the first axis):
+
+    roll           (sum of steps, 128, tracks) uint8 velocities
+    roll_offsets   (songs + 1,) first step of every song in roll
+    tokens         (sum of tokens,) int32, see TOKEN_OFFSETS
+    token_offsets  (songs + 1,)
+    seeds          (songs,) generation seed of every song
+    track_names    (tracks,)
+"""
+import json
+import os
+
+import numpy as np
+
+from batch import Manifest, run_pool, with_retries
+from metrics import METRICS, collect_in_worker
+
+MAX_SHIFT = 64  # Longest single time shift / duration token in steps
+MAX_TRACKS = 16
+VELOCITY_BINS = 32
+
+# Token vocabulary: PAD, BOS, EOS, then one block per token kind
+TOKEN_OFFSETS = {}
+_next = 3
+for _kind, _size in (('shift', MAX_SHIFT), ('track', MAX_TRACKS), ('pitch', 128),
+                     ('duration', MAX_SHIFT), ('velocity', VELOCITY_BINS)):
+    TOKEN_OFFSETS[_kind] = _next
+    _next += _size
+VOCAB_SIZE = _next
+PAD, BOS, EOS = 0, 1, 2
+
+
+def _steps(tracks, steps_per_beat):
+    # (start step, length in steps, pitch, velocity, track index) of every note
+    events = np.concatenate([t.events for t in tracks]) if tracks else np.zeros(0)
+    if not len(events):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty, empty
+    track = np.repeat(np.arange(len(tracks)), [len(t.events) for t in tracks])
+    start = np.floor(events['onset'] * steps_per_beat + 1e-6).astype(np.int64)
+    end = np.rint((events['onset'] + events['duration']) * steps_per_beat).astype(np.int64)
+    length = np.maximum(end - start, 1)
+    pitch = np.clip(events['pitch'], 0, 127).astype(np.int64)
+    velocity = np.clip(events['velocity'], 1, 127).astype(np.int64)
+    return start, length, pitch, velocity, track
+
+
+def roll_length(tracks, steps_per_beat=4):
+    """Steps of the piano roll of tracks, up to the end of the last note."""
+    start, length = _steps(tracks, steps_per_beat)[:2]
+    return int((start + length).max()) if len(start) else 0
+
+
+def piano_roll(tracks, steps_per_beat=4, num_steps=None, out=None):
+    """(steps, 128, tracks) uint8 array of velocities; overlaps keep the loudest.
+
+    out is a zeroed array of that shape to fill instead of a new one, e.g. a
+    song's slice of a whole shard.
+    """
+    start, length, pitch, velocity, track = _steps(tracks, steps_per_beat)
+    if out is not None:
+        num_steps = len(out)
+    elif num_steps is None:
+        num_steps = int((start + length).max()) if len(start) else 0
+    roll = out if out is not None else np.zeros((num_steps, 128, len(tracks)), dtype=np.uint8)
+    if not len(start):
+        return roll
+    order = np.argsort(velocity, kind='stable')  # Loudest written last wins
+    start, length, pitch, velocity, track = (a[order] for a in (start, length, pitch, velocity, track))
+    first = np.cumsum(length) - length
+    step = np.repeat(start, length) + np.arange(length.sum()) - np.repeat(first, length)
+    keep = step < num_steps
+    roll[step[keep], np.repeat(pitch, length)[keep], np.repeat(track, length)[keep]] = \
+        np.repeat(velocity, length)[keep]
+    return roll
+
+
+def tokens(tracks, steps_per_beat=4):
+    """Token sequence: BOS, then per note [shift...] track pitch duration velocity, EOS.
+
+    Notes are ordered by start step, track and pitch; shift tokens only
+    appear when time advances, long gaps use several of them.
+    """
+    start, length, pitch, velocity, track = _steps(tracks, steps_per_beat)
+    if not len(start):
+        return np.array([BOS, EOS], dtype=np.int32)
+    if track.max() >= MAX_TRACKS:
+        raise ValueError(f"Token export supports at most {MAX_TRACKS} tracks")
+    order = np.lexsort((pitch, track, start))
+    start, length, pitch, velocity, track = (a[order] for a in (start, length, pitch, velocity, track))
+
+    delta = np.diff(start, prepend=0)
+    shifts = -(-delta // MAX_SHIFT)  # Shift tokens in front of each note
+    per_note = shifts + 4
+    out = np.empty(per_note.sum() + 2, dtype=np.int32)
+    out[0], out[-1] = BOS, EOS
+    note_start = 1 + np.cumsum(per_note) - per_note
+
+    # Shift tokens: full MAX_SHIFT steps, the last one carries the remainder
+    first_shift = np.repeat(note_start, shifts)
+    within = np.arange(shifts.sum()) - np.repeat(np.cumsum(shifts) - shifts, shifts)
+    remainder = np.repeat(delta - (shifts - 1) * MAX_SHIFT, shifts)
+    is_last = within == np.repeat(shifts - 1, shifts)
+    out[first_shift + within] = TOKEN_OFFSETS['shift'] - 1 + np.where(is_last, remainder, MAX_SHIFT)
+
+    body = note_start + shifts
+    out[body] = TOKEN_OFFSETS['track'] + track
+    out[body + 1] = TOKEN_OFFSETS['pitch'] + pitch
+    out[body + 2] = TOKEN_OFFSETS['duration'] - 1 + np.minimum(length, MAX_SHIFT)
+    out[body + 3] = TOKEN_OFFSETS['velocity'] + (velocity * VELOCITY_BINS) // 128
+    return out
+
+
+def write_shard(path, songs, steps_per_beat=4, formats=('roll', 'tokens'), compress=True):
+    """Write [(seed, tracks), ...] as one NPZ shard and return its path."""
+    arrays = {'seeds': np.array([seed for seed, _ in songs], dtype=np.int64),
+              'track_names': np.array([t.name for t in songs[0][1]] if songs else [], dtype=str)}
+    if 'roll' in formats:
+        # Every song is rendered straight into its slice of the shard's roll, so the shard is held
+        # in memory once instead of once per song and again for the concatenation
+        lengths = [roll_length(tracks, steps_per_beat) for _, tracks in songs]
+        offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        roll = np.zeros((offsets[-1], 128, len(songs[0][1]) if songs else 0), dtype=np.uint8)
+        for (_, tracks), first, last in zip(songs, offsets[:-1], offsets[1:]):
+            piano_roll(tracks, steps_per_beat, out=roll[first:last])
+        arrays['roll'] = roll
+        arrays['roll_offsets'] = offsets
+    if 'tokens' in formats:
+        sequences = [tokens(tracks, steps_per_beat) for _, tracks in songs]
+        arrays['tokens'] = np.concatenate(sequences) if sequences else np.zeros(0, dtype=np.int32)
+        arrays['token_offsets'] = np.concatenate(([0], np.cumsum([len(s) for s in sequences])))
+    # Written under a temporary name first, so a shard on disk is always complete
+    tmp = f'{path[:-len(".npz")] if path.endswith(".npz") else path}.tmp{os.getpid()}.npz'
+    (np.savez_compressed if compress else np.savez)(tmp, **arrays)
+    os.replace(tmp, path)
+    return path
+
+
+def _produce_shard(make_song, seeds, path, steps_per_beat, formats, compress, retries=0):
+    # Generate every song of the shard, then write it; returns (path, songs written, error records)
+    songs, errors = [], []
+    for seed in seeds:
+        result, used_seed, failures = with_retries(make_song, seed, retries, requested_seed=seed)
+        errors += failures
+        if result is not None:
+            songs.append((used_seed, result))
+    with METRICS.timer('stage_seconds', stage='shard_write'):
+        write_shard(path, songs, steps_per_beat, formats, compress)
+    METRICS.inc('bytes_written_total', os.path.getsize(path), target='dataset')
+    return path, len(songs), errors
+
+
+def _produce_shard_in_worker(*args):
+    # The worker's metrics of this shard travel back with the result
+    return collect_in_worker(_produce_shard, *args)
+
+
+def export_dataset(make_song, seeds, out_dir, workers=None, songs_per_shard=32, steps_per_beat=4,
+                   formats=('roll', 'tokens'), compress=True, prefix='shard', retries=2, stall_seconds=None):
+    """Generate songs for all seeds into sharded NPZ files.
+
+    make_song(seed) returns a list of song_events.Track objects and must be
+    picklable (a module level function). workers=0 runs in this process.
+    A song that raises is retried with up to retries new seeds and left out
+    when all fail. Shards already finished by an earlier run with the same
+    seeds are kept. Worker pools are watched (see batch.run_pool, which
+    also explains stall_seconds). Writes manifest.json next to the shards,
+    including every error record, and returns the shard paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    seeds = list(seeds)
+    chunks = [seeds[i:i + songs_per_shard] for i in range(0, len(seeds), songs_per_shard)]
+    paths = [os.path.join(out_dir, f'{prefix}-{i:05d}.npz') for i in range(len(chunks))]
+    with Manifest(os.path.join(out_dir, 'progress.jsonl'), key='shard') as progress:
+        todo = []
+        for i, (chunk, path) in enumerate(zip(chunks, paths)):
+            done = progress.get(os.path.basename(path))
+            if done is None or done['seeds'] != chunk or not os.path.exists(path):
+                todo.append(i)
+        tasks = [(make_song, chunks[i], paths[i], steps_per_beat, formats, compress, retries) for i in todo]
+        if workers == 0:
+            results = ((position, _produce_shard(*task), None) for position, task in enumerate(tasks))
+        else:
+            results = run_pool(_produce_shard_in_worker, tasks, workers, stall_seconds)
+        lost = []
+        for position, result, error in results:
+            i = todo[position]
+            if error is not None:
+                lost.append(dict(error, shard=os.path.basename(paths[i])))  # Missing shard, redone on resume
+                continue
+            if workers != 0:
+                result, snapshot = result
+                METRICS.merge(snapshot)
+            _, count, errors = result
+            progress.append({'shard': os.path.basename(paths[i]), 'seeds': chunks[i], 'songs': count,
+                             'errors': errors})
+        records = []
+        for chunk, path in zip(chunks, paths):
+            record = progress.get(os.path.basename(path))
+            if record is not None and record['seeds'] == chunk:
+                records.append(record)
+    written = [os.path.join(out_dir, record['shard']) for record in records]
+    manifest = {'shards': [record['shard'] for record in records],
+                'songs': sum(record['songs'] for record in records),
+                'steps_per_beat': steps_per_beat, 'formats': list(formats),
+                'token_offsets': TOKEN_OFFSETS, 'vocab_size': VOCAB_SIZE,
+                'errors': [e for record in records for e in record['errors']], 'lost_shards': lost}
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return written
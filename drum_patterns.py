@@ -0,0 +1,148 @@
+"""Drum pattern library: main beats, fills, rolls and breaks as compact arrays.
+
+Every bar type is built once per meter and cached as a small HIT_DTYPE
+array. A section's drum track is assembled by choosing one bar type per
+bar and gathering all hits in a single NumPy pass, so a fill replaces the
+beat in its bars instead of being layered on top of it.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+from song_events import empty_events, make_events
+
+# General MIDI percussion keys
+KICK = 35
+SNARE = 38
+CLAP = 39
+CLOSED_HAT = 42
+LOW_TOM = 45
+OPEN_HAT = 46
+MID_TOM = 47
+CRASH = 49
+HIGH_TOM = 50
+
+HIT_DTYPE = np.dtype([
+    ('onset', '<f4'),  # Beats from the start of the bar
+    ('duration', '<f4'),
+    ('pitch', 'u1'),
+    ('velocity', 'u1'),
+])
+
+# Fills written for a 4/4 bar as (onset, duration, pitch, velocity), one tuple
+# of hits per bar. In other meters they keep their distance to the bar end.
+FILLS = {
+    'snare_8ths': (
+        ((0.0, 1.0, KICK, 90), (1.0, 1.0, KICK, 90), (0.0, 0.5, CLOSED_HAT, 70), (0.5, 0.5, CLOSED_HAT, 70),
+         (1.0, 0.5, CLOSED_HAT, 70), (1.5, 0.5, CLOSED_HAT, 70),
+         (2.0, 0.5, SNARE, 70), (2.5, 0.5, SNARE, 78), (3.0, 0.5, SNARE, 86), (3.5, 0.5, SNARE, 95)),
+    ),
+    'snare_16ths': (
+        ((0.0, 1.0, KICK, 90), (1.0, 1.0, KICK, 90), (2.0, 1.0, KICK, 90), (1.0, 1.0, SNARE, 80),
+         (3.0, 0.25, SNARE, 75), (3.25, 0.25, SNARE, 82), (3.5, 0.25, SNARE, 90), (3.75, 0.25, SNARE, 100)),
+    ),
+    'tom_roll': (
+        ((0.0, 1.0, KICK, 90), (1.0, 1.0, SNARE, 80),
+         (2.0, 0.25, HIGH_TOM, 85), (2.25, 0.25, HIGH_TOM, 80), (2.5, 0.25, HIGH_TOM, 85),
+         (2.75, 0.25, MID_TOM, 80), (3.0, 0.25, MID_TOM, 90), (3.25, 0.25, MID_TOM, 85),
+         (3.5, 0.25, LOW_TOM, 95), (3.75, 0.25, LOW_TOM, 100)),
+    ),
+    'snare_roll': (
+        tuple((i * 0.5, 0.5, SNARE, 60 + 2 * i) for i in range(8)) + ((0.0, 1.0, KICK, 90), (2.0, 1.0, KICK, 90)),
+        tuple((i * 0.25, 0.25, SNARE, 76 + 2 * i) for i in range(16)),
+    ),
+    'break': (
+        ((0.0, 1.0, KICK, 100), (0.0, 2.0, CRASH, 100)),
+    ),
+    'hats_break': (
+        tuple((i * 0.5, 0.5, CLOSED_HAT, 60) for i in range(8)),
+        tuple((i * 0.5, 0.5, CLOSED_HAT, 60) for i in range(6)) + ((3.0, 1.0, OPEN_HAT, 80),),
+    ),
+}
+
+BEAT_STYLES = ('techno', 'psy')
+FILL_NAMES = tuple(FILLS)
+
+
+def _hits(hits):
+    array = np.zeros(len(hits), dtype=HIT_DTYPE)
+    if hits:
+        array['onset'], array['duration'], array['pitch'], array['velocity'] = zip(*hits)
+    array.setflags(write=False)
+    return array
+
+
+@lru_cache(maxsize=None)
+def beat_bar(style, beats_per_bar=4, beat_length=1.0, accent=False):
+    """One bar of a main beat; accent marks the bar ending a four-bar phrase.
+
+    'techno' is kick, snare on the off-beats and eighth hats with an extra
+    kick and a crash ending the phrase; 'psy' adds a clap to every snare.
+    """
+    if style not in BEAT_STYLES:
+        raise ValueError(f"Unknown drum style {style!r}, choose from {BEAT_STYLES}")
+    hits = []
+    for beat in range(beats_per_bar):
+        onset = beat * beat_length
+        hits.append((onset, beat_length, KICK, 90))
+        if beat % 2 == 1:
+            hits.append((onset, beat_length, SNARE, 80))
+            if style == 'psy':
+                hits.append((onset, beat_length, CLAP, 80))
+        hits.append((onset, beat_length / 2, CLOSED_HAT, 70))
+        hits.append((onset + beat_length / 2, beat_length / 2, CLOSED_HAT, 70))
+    if accent:
+        last = (beats_per_bar - 1) * beat_length
+        if style == 'techno':
+            hits.append((last + beat_length / 2, beat_length / 2, KICK, 90))
+        hits.append((last, beat_length, CRASH, 85))
+    return _hits(sorted(hits))
+
+
+@lru_cache(maxsize=None)
+def fill_bars(name, beats_per_bar=4, beat_length=1.0):
+    """Bars of a named fill for a meter, one cached hit array per bar."""
+    if name not in FILLS:
+        raise ValueError(f"Unknown fill {name!r}, choose from {FILL_NAMES}")
+    bar_length = beats_per_bar * beat_length
+    bars = []
+    for hits in FILLS[name]:
+        # Scale to the beat length, then anchor to the end of the bar
+        moved = [(o * beat_length + bar_length - 4 * beat_length, d * beat_length, p, v) for o, d, p, v in hits]
+        bars.append(_hits(sorted(h for h in moved if h[0] >= 0.0)))
+    return tuple(bars)
+
+
+def drum_events(num_bars, style='techno', beats_per_bar=4, beat_length=1.0, fills=None,
+                accent_every=4, start_offset=0.0, track=0):
+    """Drum track of a section as an event array.
+
+    fills maps bar indexes (negative counts from the end) to fill names; a
+    two-bar fill covers its bar and the next one. Fill bars replace the beat.
+    """
+    if num_bars <= 0:
+        return empty_events()
+    bank = [beat_bar(style, beats_per_bar, beat_length, False),
+            beat_bar(style, beats_per_bar, beat_length, True)]
+    bar_kind = np.zeros(num_bars, dtype=np.intp)
+    if accent_every:
+        bar_kind[accent_every - 1::accent_every] = 1
+    for bar, name in sorted((fills or {}).items()):
+        if bar < 0:
+            bar += num_bars
+        for i, hits in enumerate(fill_bars(name, beats_per_bar, beat_length)):
+            if 0 <= bar + i < num_bars:
+                bar_kind[bar + i] = len(bank)
+            bank.append(hits)
+
+    # Gather the hits of every bar from the bank in one pass
+    hits = np.concatenate(bank)
+    sizes = np.array([len(b) for b in bank])
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    counts = sizes[bar_kind]
+    bar_of_hit = np.repeat(np.arange(num_bars), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(starts[bar_kind], counts) + np.arange(counts.sum()) - first
+    chosen = hits[rows]
+    onsets = start_offset + bar_of_hit * (beats_per_bar * beat_length) + chosen['onset'].astype(np.float64)
+    return make_events(onsets, chosen['duration'], chosen['pitch'], chosen['velocity'], track)
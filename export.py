@@ -0,0 +1,120 @@
+"""Export one generated song to several MIDI files in one pass.
+
+Every track is encoded at most once; full mixes, partial mixes and per-track
+stems are assembled from the same cached chunks plus one conductor track.
+"""
+import os
+import re
+
+from midi_writer import TICKS_PER_QUARTER, encode_conductor_track, encode_song_track, ports_used, write_midi_file
+
+# Named mixes as track filters; None keeps every track
+MIX_VARIANTS = {
+    'full': None,
+    'drums_only': lambda track: track.is_drum,
+    'no_melody': lambda track: not track.name.lower().startswith('melody'),
+    'no_drums': lambda track: not track.is_drum,
+}
+
+
+def _file_safe(name):
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_')
+
+
+class SongExporter:
+    """Writes mixes and stems of a list of song_events.Track objects."""
+
+    def __init__(self, tracks, tempo_map, time_signatures=(), key_signatures=(), tpq=TICKS_PER_QUARTER):
+        self.tracks = list(tracks)
+        self.tempo_map = tempo_map
+        self.time_signatures = list(time_signatures)
+        self.key_signatures = list(key_signatures)
+        self.tpq = tpq
+        self._chunks = {}
+        self._conductors = {}
+        self.bytes_written = 0
+
+    def chunk(self, track):
+        """Encoded chunk of a track, encoded on first use only."""
+        key = id(track)
+        if key not in self._chunks:
+            self._chunks[key] = encode_song_track(track, self.tpq)
+        return self._chunks[key]
+
+    def conductor(self, tempo_map=None):
+        tempo_map = tempo_map or self.tempo_map
+        # Keyed by content: temporary maps (tempo variants) may reuse a collected map's id
+        key = tuple(tempo_map.changes())
+        if key not in self._conductors:
+            self._conductors[key] = encode_conductor_track(
+                tempo_map, self.time_signatures, self.key_signatures, self.tpq)
+        return self._conductors[key]
+
+    def select(self, selector=None):
+        """Tracks for a mix name, a filter callable or a list of track names."""
+        if isinstance(selector, str):
+            if selector not in MIX_VARIANTS:
+                raise ValueError(f"Unknown mix {selector!r}, choose from {sorted(MIX_VARIANTS)}")
+            selector = MIX_VARIANTS[selector]
+        if selector is None:
+            return list(self.tracks)
+        if callable(selector):
+            return [t for t in self.tracks if selector(t)]
+        names = set(selector)
+        return [t for t in self.tracks if t.name in names]
+
+    def write_mix(self, path, selector=None, tempo_map=None):
+        tracks = self.select(selector)
+        chunks = [self.conductor(tempo_map)] + [self.chunk(t) for t in tracks]
+        self.bytes_written += write_midi_file(path, chunks, self.tpq)
+        return path
+
+    def write_stems(self, path_pattern, tempo_map=None):
+        """One file per non-empty track; path_pattern is formatted with {name}.
+
+        Returns {track name: path}.
+        """
+        paths = {}
+        for track in self.tracks:
+            if not len(track.events):
+                continue
+            path = path_pattern.format(name=_file_safe(track.name))
+            chunks = [self.conductor(tempo_map), self.chunk(track)]
+            self.bytes_written += write_midi_file(path, chunks, self.tpq)
+            paths[track.name] = path
+        return paths
+
+    def write_ports(self, path_pattern, tempo_map=None):
+        """One file per MIDI port the tracks use; path_pattern is formatted with {port}.
+
+        For players and hardware that only take 16 channels per file.
+        Returns {port: path}.
+        """
+        paths = {}
+        for port in ports_used(self.tracks):
+            path = path_pattern.format(port=port)
+            paths[port] = self.write_mix(path, lambda t: t.port == port, tempo_map)
+        return paths
+
+    def export(self, out_dir, basename, mixes=('full',), stems=False, port_files=False):
+        """Write the requested mixes (and stems) and return {label: path}.
+
+        The 'full' mix is written as <basename>.mid, the others as
+        <basename>_<mix>.mid and stems as <basename>_stem_<track>.mid.
+        With port_files, a song routed to several ports is also written as
+        <basename>_port<n>.mid per port.
+        """
+        os.makedirs(out_dir, exist_ok=True)
+        written = {}
+        for mix in mixes:
+            suffix = '' if mix == 'full' else f'_{mix}'
+            written[mix] = self.write_mix(os.path.join(out_dir, f'{basename}{suffix}.mid'), mix)
+        if stems:
+            pattern = os.path.join(out_dir, f'{basename}_stem_{{name}}.mid')
+            for name, path in self.write_stems(pattern).items():
+                written[f'stem:{name}'] = path
+        if port_files and len(ports_used(self.tracks)) > 1:
+            pattern = os.path.join(out_dir, f'{basename}_port{{port}}.mid')
+            for port, path in self.write_ports(pattern).items():
+                written[f'port:{port}'] = path
+        return written
@@ -0,0 +1,120 @@
+"""MinHash fingerprints and an LSH index for spotting near-duplicate songs.
+
+A song is reduced to a set of shingles: n-grams of (interval, time step)
+pairs along each fingerprinted track, so transposed or re-timed copies of
+the same lines still match. MinHash compresses the set into NUM_PERM
+integers whose agreement estimates the Jaccard similarity of two songs.
+The LSH index splits signatures into bands and hashes each band into a
+bucket; only songs sharing a bucket are compared, so a lookup costs a few
+dict probes however many songs are indexed.
+"""
+import numpy as np
+
+NGRAM = 4  # Notes per shingle
+NUM_PERM = 128
+BANDS = 16  # 16 bands of 8 rows: songs above ~0.7 similarity almost always collide
+STEPS_PER_BEAT = 4  # Time resolution of the rhythm part of a shingle
+MAX_HASH = np.uint64(0xFFFFFFFF)
+_PRIME = np.uint64((1 << 61) - 1)
+_SEED = 0x5EED  # Fixed, so fingerprints stay comparable across runs and processes
+
+_rng = np.random.default_rng(_SEED)
+_A = _rng.integers(1, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+del _rng
+
+
+def shingles(tracks, steps_per_beat=STEPS_PER_BEAT):
+    """32-bit codes of the (interval, inter-onset step) n-grams of every track.
+
+    The track's position in the list is part of each code, so the same line
+    in another voice counts as different material.
+    """
+    codes = []
+    for position, track in enumerate(tracks):
+        events = track.events
+        if len(events) < NGRAM:
+            continue
+        events = events[np.argsort(events['onset'], kind='stable')]
+        intervals = np.clip(np.diff(events['pitch'].astype(np.int64)), -64, 63) + 64
+        steps = np.clip(np.rint(np.diff(events['onset']) * steps_per_beat).astype(np.int64), 0, 127)
+        pairs = intervals * 128 + steps  # 14 bits per note transition
+        window = np.lib.stride_tricks.sliding_window_view(pairs, NGRAM - 1).astype(np.uint64)
+        code = np.full(len(window), position * 0x9E3779B1 + 1, dtype=np.uint64)
+        for column in window.T:
+            code = code * np.uint64(0x100000001B3) ^ column  # FNV-style mix, wraps in 64 bits
+        codes.append((code ^ (code >> np.uint64(32))) & MAX_HASH)
+    return np.unique(np.concatenate(codes)) if codes else np.zeros(0, dtype=np.uint64)
+
+
+def minhash(codes):
+    """MinHash signature (NUM_PERM uint32) of a set of 32-bit codes."""
+    if not len(codes):
+        return np.full(NUM_PERM, MAX_HASH, dtype=np.uint32)
+    hashed = (_A[:, None] * codes[None, :] + _B[:, None]) % _PRIME & MAX_HASH
+    return hashed.min(axis=1).astype(np.uint32)
+
+
+def signature(tracks, prefixes=None):
+    """MinHash signature of a song's tracks, optionally only names with given prefixes."""
+    if prefixes is not None:
+        tracks = [t for t in tracks if t.name.startswith(tuple(prefixes))]
+    return minhash(shingles(tracks))
+
+
+def similarity(a, b):
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(np.asarray(a) == np.asarray(b)))
+
+
+class LSHIndex:
+    """In-memory banded LSH index of MinHash signatures.
+
+    add(key, signature) stores a song; query(signature) returns the most
+    similar stored song at or above threshold as (key, similarity), or
+    None. Signatures are kept in one growing array for verification.
+    """
+
+    def __init__(self, threshold=0.8, bands=BANDS):
+        if NUM_PERM % bands:
+            raise ValueError(f"{NUM_PERM} permutations do not split into {bands} bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self._buckets = [{} for _ in range(bands)]
+        self._keys = []
+        self._signatures = np.zeros((1024, NUM_PERM), dtype=np.uint32)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _band_keys(self, sig):
+        return [sig[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def add(self, key, sig):
+        sig = np.asarray(sig, dtype=np.uint32)
+        slot = len(self._keys)
+        if slot == len(self._signatures):
+            self._signatures = np.concatenate((self._signatures, np.zeros_like(self._signatures)))
+        self._signatures[slot] = sig
+        self._keys.append(key)
+        for buckets, band in zip(self._buckets, self._band_keys(sig)):
+            buckets.setdefault(band, []).append(slot)
+        return slot
+
+    def candidates(self, sig):
+        """Slots sharing at least one band bucket with the signature."""
+        found = set()
+        for buckets, band in zip(self._buckets, self._band_keys(np.asarray(sig, dtype=np.uint32))):
+            found.update(buckets.get(band, ()))
+        return found
+
+    def query(self, sig):
+        slots = np.fromiter(self.candidates(sig), dtype=np.intp)
+        if not len(slots):
+            return None
+        scores = (self._signatures[slots] == np.asarray(sig, dtype=np.uint32)).mean(axis=1)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return self._keys[slots[best]], float(scores[best])
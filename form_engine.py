@@ -0,0 +1,113 @@
+"""Arrangement plans from a small song-form grammar.
+
+A plan only lists sections (type, length, variant, muted tracks); it is
+cheap to build and says up front which sections are musically identical,
+so the expensive per-track generation can run once per distinct block and
+be spread over worker processes.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from measure_grid import MeasureGrid
+
+# material: whose keys/chords the section uses; measures: allowed lengths, one
+# picked per song so repeats match; drop: track name prefixes left silent
+SECTION_TYPES = {
+    'intro': {'material': 'intro', 'measures': (8, 16)},
+    'verse': {'material': 'verse', 'measures': (16,)},
+    'chorus': {'material': 'chorus', 'measures': (16,)},
+    'bridge': {'material': 'bridge', 'measures': (8, 16)},
+    'breakdown': {'material': 'bridge', 'measures': (8,), 'drop': ('Drums', 'Bass')},
+    'buildup': {'material': 'verse', 'measures': (4, 8), 'drop': ('Melody', 'Strings')},
+    'outro': {'material': 'outro', 'measures': (8, 16)},
+}
+
+# Non-terminal -> weighted expansions; 'name*n' repeats a section n times
+FORM_RULES = {
+    'song': [(1.0, ('intro', 'body', 'outro'))],
+    'body': [
+        (3.0, ('verse', 'chorus', 'verse', 'bridge', 'chorus')),
+        (2.0, ('verse', 'chorus', 'breakdown', 'buildup', 'chorus*2')),
+        (1.0, ('verse', 'chorus', 'body')),
+    ],
+}
+
+PlannedSection = namedtuple('PlannedSection', 'name material measures variant drop')
+
+
+class ArrangementPlan:
+    """Ordered sections of a song plus the blocks they share."""
+
+    def __init__(self, sections):
+        self.sections = tuple(sections)
+        self.keys = [(s.name, s.measures, s.variant) for s in self.sections]
+        self.unique_keys = list(dict.fromkeys(self.keys))
+        self._block_index = {k: i for i, k in enumerate(self.unique_keys)}
+
+    def __len__(self):
+        return len(self.sections)
+
+    @property
+    def names(self):
+        return [s.name for s in self.sections]
+
+    @property
+    def total_measures(self):
+        return sum(s.measures for s in self.sections)
+
+    def block_index(self, section_index):
+        """Index of the distinct block a section plays; repeats share one."""
+        return self._block_index[self.keys[section_index]]
+
+    def grid(self, time_signature='4/4', bpm=120):
+        return MeasureGrid([(s.name, s.measures, time_signature) for s in self.sections], bpm)
+
+    def describe(self):
+        return ' '.join(f'{s.name}[{s.measures}]' + (f'.{s.variant}' if s.variant else '')
+                        for s in self.sections)
+
+
+def _expand(symbol, rules, rng, depth, max_depth, out):
+    name, _, repeat = symbol.partition('*')
+    if name not in rules:
+        out.extend([name] * int(repeat or 1))
+        return
+    options = rules[name]
+    if depth >= max_depth:
+        # Too deep: only expansions that cannot recurse any further
+        options = [o for o in options if not any(s.partition('*')[0] in rules for s in o[1])] or options
+    weights = np.array([w for w, _ in options], dtype=np.float64)
+    _, expansion = options[rng.choice(len(options), p=weights / weights.sum())]
+    for _ in range(int(repeat or 1)):
+        for child in expansion:
+            _expand(child, rules, rng, depth + 1, max_depth, out)
+
+
+def generate_form(rng=None, rules=FORM_RULES, section_types=SECTION_TYPES, start='song',
+                  max_depth=4, variation=0.0):
+    """Expand the grammar into an ArrangementPlan.
+
+    rng is a numpy Generator. variation is the chance that a repeated
+    section gets fresh material instead of reusing the earlier block.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    names = []
+    _expand(start, rules, rng, 0, max_depth, names)
+    unknown = sorted(set(names) - set(section_types))
+    if unknown:
+        raise ValueError(f"Form uses undefined section types {unknown}")
+
+    lengths, variants, sections = {}, {}, []
+    for name in names:
+        spec = section_types[name]
+        if name not in lengths:
+            lengths[name] = int(rng.choice(spec['measures']))
+        if name not in variants:
+            variants[name] = 0
+        elif rng.random() < variation:
+            variants[name] += 1
+        sections.append(PlannedSection(name, spec.get('material', name), lengths[name],
+                                       variants[name], tuple(spec.get('drop', ()))))
+    return ArrangementPlan(sections)
@@ -0,0 +1,132 @@
+"""Precomputed bar and beat offsets shared by all generators of a song.
+
+The grid is built once per song from the section list and its meters.
+Generators look offsets up by bar index instead of multiplying measure
+numbers by a hard-coded 4.0, so 3/4, 6/8 or mixed meters stay aligned.
+"""
+import numpy as np
+
+
+def parse_time_signature(time_signature):
+    """Return (numerator, denominator) for a string such as '3/4'."""
+    if isinstance(time_signature, str):
+        numerator, _, denominator = time_signature.partition('/')
+        time_signature = (int(numerator), int(denominator))
+    numerator, denominator = time_signature
+    if numerator <= 0 or denominator not in (1, 2, 4, 8, 16, 32):
+        raise ValueError(f"Invalid time signature: {time_signature!r}")
+    return numerator, denominator
+
+
+class MeasureGrid:
+    """Bar and beat offsets (in quarter-note beats) for a whole song.
+
+    sections is a list of (name, num_measures, time_signature) tuples. All
+    offsets are computed up front, lookups are plain array indexing. Seconds
+    follow tempo_map (a tempo_map.TempoMap) when given, else the constant bpm.
+    """
+
+    def __init__(self, sections, bpm=120, tempo_map=None):
+        self.section_names = []
+        self.bpm = bpm
+        self.tempo_map = tempo_map
+        meters = []
+        measures = []
+        for name, num_measures, time_signature in sections:
+            self.section_names.append(name)
+            measures.append(int(num_measures))
+            meters.append(parse_time_signature(time_signature))
+        self.num_sections = len(measures)
+
+        section_bars = np.array(measures, dtype=np.int64)
+        self.section_start_bar = np.concatenate(([0], np.cumsum(section_bars)))
+        self.num_bars = int(self.section_start_bar[-1])
+
+        # Per bar: number of beats, beat length and time signature
+        bar_section = np.repeat(np.arange(self.num_sections), section_bars)
+        numerators = np.array([m[0] for m in meters], dtype=np.int64)
+        denominators = np.array([m[1] for m in meters], dtype=np.int64)
+        self.bar_section = bar_section
+        self.beats_in_bar = numerators[bar_section]
+        self.beat_length = 4.0 / denominators[bar_section]
+        self.bar_length = self.beats_in_bar * self.beat_length
+        self.time_signatures = [f"{n}/{d}" for n, d in meters]
+
+        # bar_offsets has num_bars + 1 entries, the last one is the song end
+        self.bar_offsets = np.concatenate(([0.0], np.cumsum(self.bar_length)))
+        # section_offsets has num_sections + 1 entries in the same way
+        self.section_offsets = self.bar_offsets[self.section_start_bar]
+
+        # beat_offsets[bar, beat] with NaN padding for shorter bars
+        max_beats = int(self.beats_in_bar.max()) if self.num_bars else 0
+        beat_index = np.arange(max_beats)
+        self.beat_offsets = (self.bar_offsets[:-1, None]
+                             + beat_index[None, :] * self.beat_length[:, None])
+        self.beat_offsets[beat_index[None, :] >= self.beats_in_bar[:, None]] = np.nan
+
+        # Section-local views so generators can work relative to their start
+        self._section_bar_offsets = []
+        self._section_beat_offsets = []
+        for i in range(self.num_sections):
+            bars = slice(self.section_start_bar[i], self.section_start_bar[i + 1])
+            self._section_bar_offsets.append(self.bar_offsets[bars] - self.section_offsets[i])
+            self._section_beat_offsets.append(self.beat_offsets[bars] - self.section_offsets[i])
+
+        for array in (self.section_start_bar, self.bar_section, self.beats_in_bar,
+                      self.beat_length, self.bar_length, self.bar_offsets,
+                      self.section_offsets, self.beat_offsets):
+            array.setflags(write=False)
+
+    @classmethod
+    def from_sections(cls, section_names, measures_per_section, time_signature='4/4', bpm=120):
+        """Grid for a section list that shares one length and one meter."""
+        return cls([(name, measures_per_section, time_signature) for name in section_names], bpm=bpm)
+
+    @property
+    def total_beats(self):
+        return float(self.bar_offsets[-1])
+
+    def bar_offset(self, bar):
+        return float(self.bar_offsets[bar])
+
+    def beat_offset(self, bar, beat):
+        return float(self.beat_offsets[bar, beat])
+
+    def section_offset(self, section_index):
+        return float(self.section_offsets[section_index])
+
+    def section_length(self, section_index):
+        return float(self.section_offsets[section_index + 1] - self.section_offsets[section_index])
+
+    def section_measures(self, section_index):
+        return int(self.section_start_bar[section_index + 1] - self.section_start_bar[section_index])
+
+    def section_time_signature(self, section_index):
+        return self.time_signatures[section_index]
+
+    def section_bar_offsets(self, section_index):
+        """Bar offsets of a section relative to the section start."""
+        return self._section_bar_offsets[section_index]
+
+    def section_beat_offsets(self, section_index):
+        """[bar, beat] offsets of a section relative to its start (NaN padded)."""
+        return self._section_beat_offsets[section_index]
+
+    def section_bar_lengths(self, section_index):
+        start, end = self.section_start_bar[section_index], self.section_start_bar[section_index + 1]
+        return self.bar_length[start:end]
+
+    def time_signature_events(self):
+        """(beat, numerator, denominator) wherever the meter changes."""
+        events = []
+        for i, time_signature in enumerate(self.time_signatures):
+            if i == 0 or time_signature != self.time_signatures[i - 1]:
+                numerator, denominator = parse_time_signature(time_signature)
+                events.append((self.section_offset(i), numerator, denominator))
+        return events
+
+    def seconds_at(self, offset):
+        """Wall-clock seconds at a beat offset for the grid's tempo."""
+        if self.tempo_map is not None:
+            return self.tempo_map.seconds_at(offset)
+        return offset * 60.0 / self.bpm
@@ -0,0 +1,198 @@
+"""Multi-voice melody engine with counterpoint-aware voice leading.
+
+All melody voices of a section are written together, note against note on
+a shared rhythm. The harmony is analysed once per section (chord tones and
+scale as pitch-class masks); each voice then picks its next pitch from a
+candidate row, scored against the voices already placed with slices of
+tables computed once per section, with penalties for crossings, parallel fifths and octaves, unisons
+and wide spacing between the upper voices.
+"""
+import random
+from functools import lru_cache
+
+import numpy as np
+
+from song_events import compile_progression, empty_events, make_events
+
+SCALE_STEPS = {
+    'major': (0, 2, 4, 5, 7, 9, 11),
+    'minor': (0, 2, 3, 5, 7, 8, 10),
+}
+
+# Top to bottom, MIDI note ranges of up to five voices
+VOICE_RANGES = ((67, 86), (60, 79), (55, 74), (48, 67), (41, 62))
+
+# Written for 4/4; each pattern fills one bar
+RHYTHMIC_PATTERNS = (
+    (1.0, 1.0, 1.0, 1.0), (0.5, 0.5, 1.0, 2.0), (0.75, 0.75, 0.5, 2.0),
+    (1.5, 0.5, 1.5, 0.5), (0.5, 1.5, 0.5, 1.5),
+)
+# Semitone steps the lead voice aims for, one per note of a bar
+MELODIC_PATTERNS = (
+    (0, 2, 4, 5), (0, -2, -4, -5), (0, 2, 0, -2),
+    (0, 3, 5, 7), (0, -3, -5, -7),
+)
+
+CROSSING_PENALTY = 100.0
+PARALLEL_PENALTY = 20.0
+UNISON_PENALTY = 8.0
+SPACING_PENALTY = 10.0
+NON_CHORD_PENALTY = 6.0  # Scale tone where a chord tone is required
+MAX_SPACING = 12  # Semitones between neighbouring upper voices
+NEW_TONE_BONUS = 2.0  # Prefer chord tones no other voice holds yet
+
+
+@lru_cache(maxsize=None)
+def scale_mask(tonic_pc, mode='major'):
+    """Boolean pitch-class mask of a scale."""
+    mask = np.zeros(12, dtype=bool)
+    mask[[(tonic_pc + step) % 12 for step in SCALE_STEPS[mode]]] = True
+    mask.setflags(write=False)
+    return mask
+
+
+def _rhythm(num_measures, beats_per_bar, patterns, rng):
+    # Onsets and durations of the shared note slots, clipped to the bar
+    onsets, durations = [], []
+    choice = rng.integers(0, len(patterns), size=num_measures)
+    for bar, pattern_id in enumerate(choice.tolist()):
+        position = 0.0
+        for length in patterns[pattern_id]:
+            if position >= beats_per_bar:
+                break
+            onsets.append(bar * beats_per_bar + position)
+            durations.append(min(length, beats_per_bar - position))
+            position += length
+    return np.array(onsets), np.array(durations)
+
+
+def _is_perfect(interval):
+    return (interval % 12 == 0) | (interval % 12 == 7)
+
+
+def generate_voices(chord_progression, scale, num_measures, num_voices=5, lead=0, beats_per_bar=4.0,
+                    voice_ranges=VOICE_RANGES, rhythmic_patterns=RHYTHMIC_PATTERNS,
+                    melodic_patterns=MELODIC_PATTERNS, velocity=80, rng=None):
+    """Write num_voices melody lines over a section, top voice first.
+
+    scale is a 12-entry pitch-class mask (see scale_mask). lead is the
+    voice that carries the melodic patterns, the others harmonise it.
+    Downbeats strongly prefer chord tones, other notes may use scale tones.
+    Returns (list of event arrays, pitch matrix of shape notes x voices).
+    """
+    if num_voices > len(voice_ranges):
+        raise ValueError(f"Only {len(voice_ranges)} voice ranges for {num_voices} voices")
+    if num_measures <= 0:
+        return [empty_events() for _ in range(num_voices)], np.zeros((0, num_voices), dtype=np.int64)
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(32))
+
+    # Harmonic analysis, once for the whole section
+    progression = compile_progression(chord_progression)
+    onsets, durations = _rhythm(num_measures, beats_per_bar, rhythmic_patterns, rng)
+    bar = (onsets // beats_per_bar).astype(np.int64)
+    chord_of_note = progression.per_bar(num_measures)[bar]
+    on_beat = np.isclose(onsets % 1.0, 0.0)
+    scale_pcs = np.asarray(scale)
+    allowed = progression.tone_mask[chord_of_note] | (~on_beat[:, None] & scale_pcs[None, :])
+    chord_tones = progression.tone_mask[chord_of_note]
+    step_in_bar = np.arange(len(onsets)) - np.searchsorted(onsets, bar * beats_per_bar)
+    lead_steps = np.array(melodic_patterns)[rng.integers(0, len(melodic_patterns), size=num_measures)]
+    lead_steps = lead_steps[bar, np.minimum(step_in_bar, lead_steps.shape[1] - 1)]
+    noise = rng.random((len(onsets), num_voices))
+
+    # Everything that does not depend on the pitches already chosen is tabulated once per voice:
+    # candidates are the voice's whole range (index 0 = its lowest pitch), pitches outside the key
+    # cost inf instead of being filtered out. Placed voices then only touch single entries or
+    # slices of a penalty row, so the note loop does no per-pair array work. The penalties are
+    # summed in a fixed order; equal costs are decided by that rounding, so the order is kept
+    order = [lead] + [v for v in range(num_voices) if v != lead]
+    lows, base_costs, bonuses, same_class = [], [], [], []
+    for low, high in voice_ranges[:num_voices]:
+        classes = np.arange(low, high + 1) % 12
+        in_key = (scale_pcs | allowed)[:, classes]
+        base = NON_CHORD_PENALTY * ~allowed[:, classes]
+        base[~in_key & in_key.any(axis=1)[:, None]] = np.inf  # Nothing in key: every pitch may play
+        lows.append(low)
+        base_costs.append(base)
+        bonuses.append(NEW_TONE_BONUS * chord_tones[:, classes])
+        same_class.append([np.flatnonzero(classes == pc) for pc in range(12)])
+    distance = np.abs(np.arange(-256, 257)).astype(np.float64)  # |candidate - target|, 256 = 0
+    placed_above = [[u for u in order[:j] if u < voice] for j, voice in enumerate(order)]
+    placed_below = [[u for u in order[:j] if u > voice] for j, voice in enumerate(order)]
+    upper_pairs = [[u for u in order[:j] if abs(u - voice) == 1 and max(u, voice) < num_voices - 1]
+                   for j, voice in enumerate(order)]
+    lead_steps = lead_steps.tolist()
+
+    pitches = np.zeros((len(onsets), num_voices), dtype=np.int64)
+    previous = [(low + high) // 2 for low, high in voice_ranges[:num_voices]]
+    for i in range(len(onsets)):
+        current = list(previous)
+        for j, voice in enumerate(order):
+            low, p = lows[voice], previous[voice]
+            size = base_costs[voice].shape[1]
+            first = low - p - (lead_steps[i] if voice == lead else 0) + 256
+            cost = distance[first:first + size] + noise[i, voice] * 2.0
+            cost += base_costs[voice][i]
+            if j:
+                # Voices stay in order: above every lower voice, below every higher one
+                top = min((current[u] for u in placed_above[j]), default=low + size) - low
+                bottom = max((current[u] for u in placed_below[j]), default=low - 1) - low
+                crossing = np.zeros(size)
+                if bottom >= top - 1:
+                    crossing += CROSSING_PENALTY
+                else:
+                    crossing[max(top, 0):] = CROSSING_PENALTY
+                    crossing[:max(bottom + 1, 0)] = CROSSING_PENALTY
+                parallel, unison, wide = np.zeros(size), np.zeros(size), np.zeros(size)
+                bonus = bonuses[voice][i].copy()
+                for u in order[:j]:
+                    n, b = current[u] - low, previous[u] - low  # Other voice, as candidate indexes
+                    # Parallel perfect intervals: same perfect interval, both voices moving the same way
+                    interval = p - low - b
+                    if n != b and interval % 12 in (0, 7):
+                        match = (n + interval) % 12
+                        if n > b:
+                            above = max(p - low + 1, 0)
+                            parallel[above + (match - above) % 12::12] += PARALLEL_PENALTY
+                        else:
+                            parallel[match:max(p - low, 0):12] += PARALLEL_PENALTY
+                    if 0 <= n < size:
+                        unison[n] += UNISON_PENALTY
+                    # Spacing to the neighbouring upper voices
+                    if u in upper_pairs[j]:
+                        wide[:max(n - MAX_SPACING, 0)] += SPACING_PENALTY
+                        wide[max(n + MAX_SPACING + 1, 0):] += SPACING_PENALTY
+                    bonus[same_class[voice][(n + low) % 12]] = 0.0  # Chord tone held already
+                cost += crossing
+                cost += parallel
+                cost += unison
+                cost += wide
+                cost -= bonus
+            current[voice] = low + int(np.argmin(cost))
+        pitches[i] = current
+        previous = current
+
+    voices = [make_events(onsets, durations, pitches[:, v], velocity) for v in range(num_voices)]
+    return voices, pitches
+
+
+def counterpoint_report(pitches):
+    """Count rule violations in a notes x voices pitch matrix (top voice first).
+
+    Checks every voice pair at once: parallel fifths and octaves between
+    consecutive notes, voice crossings and over-wide upper spacing.
+    """
+    pitches = np.asarray(pitches)
+    upper = np.triu(np.ones((pitches.shape[1],) * 2, dtype=bool), 1)
+    intervals = pitches[:, :, None] - pitches[:, None, :]
+    motion = np.sign(np.diff(pitches, axis=0))
+    same_way = (motion[:, :, None] == motion[:, None, :]) & (motion[:, :, None] != 0)
+    parallel = (_is_perfect(intervals[:-1]) & (intervals[1:] % 12 == intervals[:-1] % 12) & same_way
+                & upper[None])
+    neighbours = np.diff(pitches, axis=1)
+    return {
+        'parallel_perfect': int(parallel.sum()),
+        'crossings': int((neighbours > 0).sum()),
+        'wide_spacing': int((-neighbours[:, :-1] > MAX_SPACING).sum()),
+    }
@@ -0,0 +1,292 @@
+"""Counters, gauges and histograms for batch and service runs.
+
+Recording is lock-free: every thread writes into its own shard (plain
+dicts), and snapshot() merges the shards only when metrics are exported.
+Worker processes keep their own registry; run tasks through
+collect_in_worker(), which sends the task's snapshot() back with its result
+for merge() in the parent. Output is Prometheus text exposition
+(to a file for the node exporter's textfile collector or over HTTP) or a
+JSON document flushed periodically by a background thread.
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds of the default histogram buckets, in seconds or counts
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """Named metrics with optional labels, e.g. inc('songs_total', engine='pop').
+
+    Histograms need their buckets declared once with histogram(); undeclared
+    names fall back to LATENCY_BUCKETS.
+    """
+
+    def __init__(self, prefix='song_engine'):
+        self.prefix = prefix
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()  # Only taken when a thread records its first value
+        self._buckets = {}
+        self._help = {}
+        self._merged = self._new_shard()
+
+    @staticmethod
+    def _new_shard():
+        return {'counter': {}, 'gauge': {}, 'histogram': {}}
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._new_shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def histogram(self, name, buckets, help_text=None):
+        """Declare the bucket upper bounds of a histogram."""
+        self._buckets[name] = tuple(sorted(buckets))
+        if help_text:
+            self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        counters = self._shard()['counter']
+        key = _key(name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self._shard()['gauge'][_key(name, labels)] = (time.time(), value)
+
+    def observe(self, name, value, **labels):
+        histograms = self._shard()['histogram']
+        key = _key(name, labels)
+        entry = histograms.get(key)
+        buckets = self._buckets.get(name, LATENCY_BUCKETS)
+        if entry is None:
+            entry = histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the wall time of a block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """Merged values of all threads as a picklable dict (see merge)."""
+        with self._shards_lock:
+            shards = [self._merged] + list(self._shards)
+        counters, gauges, histograms = {}, {}, {}
+        for shard in shards:
+            for key, value in dict(shard['counter']).items():
+                counters[key] = counters.get(key, 0) + value
+            for key, value in dict(shard['gauge']).items():
+                if key not in gauges or value[0] > gauges[key][0]:
+                    gauges[key] = value
+            for key, (counts, total, count) in dict(shard['histogram']).items():
+                if key in histograms:
+                    merged = histograms[key]
+                    merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                    merged[1] += total
+                    merged[2] += count
+                else:
+                    histograms[key] = [list(counts), total, count]
+        return {'counter': counters, 'gauge': gauges, 'histogram': histograms,
+                'buckets': dict(self._buckets)}
+
+    def merge(self, snapshot):
+        """Add a snapshot from another process (or registry) into this one."""
+        with self._shards_lock:
+            merged = self._merged
+            for key, value in snapshot['counter'].items():
+                merged['counter'][key] = merged['counter'].get(key, 0) + value
+            for key, value in snapshot['gauge'].items():
+                if key not in merged['gauge'] or value[0] > merged['gauge'][key][0]:
+                    merged['gauge'][key] = value
+            for key, (counts, total, count) in snapshot['histogram'].items():
+                entry = merged['histogram'].setdefault(key, [[0] * len(counts), 0.0, 0])
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+            for name, buckets in snapshot.get('buckets', {}).items():
+                self._buckets.setdefault(name, buckets)
+
+    def reset(self):
+        """Forget every recorded value, e.g. in a freshly forked worker."""
+        with self._shards_lock:
+            self._shards = []
+            self._merged = self._new_shard()
+        self._local = threading.local()
+
+    def _labels(self, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+    def prometheus_text(self):
+        """All metrics in Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        families = {}
+        for kind in ('counter', 'gauge', 'histogram'):
+            for (name, labels), value in snapshot[kind].items():
+                families.setdefault((name, kind), []).append((labels, value))
+        for (name, kind), samples in sorted(families.items()):
+            full = f'{self.prefix}_{name}'
+            if name in self._help:
+                lines.append(f'# HELP {full} {self._help[name]}')
+            lines.append(f'# TYPE {full} {kind}')
+            for labels, value in sorted(samples):
+                if kind == 'counter':
+                    lines.append(f'{full}{self._labels(labels)} {value}')
+                elif kind == 'gauge':
+                    lines.append(f'{full}{self._labels(labels)} {value[1]}')
+                else:
+                    counts, total, count = value
+                    bounds = [str(b) for b in snapshot['buckets'].get(name, LATENCY_BUCKETS)] + ['+Inf']
+                    running = 0
+                    for bound, bucket_count in zip(bounds, counts):
+                        running += bucket_count
+                        lines.append(f'{full}_bucket{self._labels(labels, [("le", bound)])} {running}')
+                    lines.append(f'{full}_sum{self._labels(labels)} {total}')
+                    lines.append(f'{full}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def json_document(self):
+        snapshot = self.snapshot()
+
+        def rows(kind, convert):
+            return [dict(name=name, labels=dict(labels), **convert(value))
+                    for (name, labels), value in sorted(snapshot[kind].items())]
+
+        return {
+            'time': time.time(),
+            'counters': rows('counter', lambda v: {'value': v}),
+            'gauges': rows('gauge', lambda v: {'value': v[1], 'updated': v[0]}),
+            'histograms': rows('histogram', lambda v: {'buckets': v[0], 'sum': v[1], 'count': v[2]}),
+            'buckets': {name: list(b) for name, b in snapshot['buckets'].items()},
+        }
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.prometheus_text())
+        return path
+
+    def write_json(self, path):
+        _write_atomic(path, json.dumps(self.json_document(), indent=1))
+        return path
+
+
+def _write_atomic(path, text):
+    # Readers never see a half written file
+    tmp = f'{path}.tmp{os.getpid()}'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class PeriodicFlusher:
+    """Writes the registry to a JSON (or .prom) file every interval seconds."""
+
+    def __init__(self, registry, path, interval=10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def flush(self):
+        if self.path.endswith('.prom'):
+            return self.registry.write_prometheus(self.path)
+        return self.registry.write_json(self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop the thread and write a final flush."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def serve_prometheus(registry, port=9464, host=''):
+    """Serve /metrics over HTTP from a daemon thread; returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.prometheus_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+_worker_pid = None  # Process whose registry holds only its own values
+
+
+def collect_in_worker(func, *args, registry=None):
+    """Call func(*args) in a worker process; returns (result, snapshot).
+
+    The snapshot holds what the call recorded in registry (METRICS by
+    default) and goes to registry.merge() in the parent. A forked worker
+    starts with a copy of the parent's values; they are dropped before its
+    first task so nothing is counted twice.
+    """
+    global _worker_pid
+    registry = registry or METRICS
+    if _worker_pid != os.getpid():
+        registry.reset()
+        _worker_pid = os.getpid()
+    result = func(*args)
+    snapshot = registry.snapshot()
+    registry.reset()
+    return result, snapshot
+
+
+# Process-wide registry used by the engines
+METRICS = MetricsRegistry()
+METRICS.histogram('block_seconds', LATENCY_BUCKETS, 'Generation time of one block per generator')
+METRICS.histogram('stage_seconds', LATENCY_BUCKETS, 'Time per song pipeline stage')
+METRICS.histogram('notes_per_song', SIZE_BUCKETS, 'Note events of a generated song')
+METRICS.describe('songs_total', 'Songs generated')
+METRICS.describe('bytes_written_total', 'Bytes written per target (midi, audio, store, dataset)')
+METRICS.describe('cache_lookups_total', 'Song cache lookups by result')
+METRICS.describe('cache_hit_ratio', 'Song cache hits over lookups of this process')
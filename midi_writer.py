@@ -0,0 +1,187 @@
+"""Minimal Standard MIDI File writer for event arrays.
+
+Each track is encoded into a self-contained 'MTrk' chunk. Chunks are plain
+bytes, so callers can cache them and assemble any number of files (tempo
+variants, stems, mixes) without re-encoding the notes.
+
+Channels are allocated from a routing table: every melodic track gets a
+channel of its own, 15 per port around the drum channel, and further
+tracks move on to the next port (a MIDI port meta event in their chunk)
+instead of stealing a channel already in use.
+"""
+import struct
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+TICKS_PER_QUARTER = 480
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+DRUM_CHANNEL = 9
+MELODIC_CHANNELS = tuple(c for c in range(16) if c != DRUM_CHANNEL)
+
+# Where a track is played: MIDI port, channel on that port and its program
+Route = namedtuple('Route', 'port channel program')
+
+
+def _vlq(value):
+    # Variable-length quantity as used for delta times and meta lengths
+    data = bytearray([value & 0x7F])
+    value >>= 7
+    while value:
+        data.insert(0, 0x80 | (value & 0x7F))
+        value >>= 7
+    return bytes(data)
+
+
+def _meta(kind, payload):
+    return bytes([0xFF, kind]) + _vlq(len(payload)) + payload
+
+
+def encode_track_chunk(messages):
+    """Encode (tick, message bytes) pairs into an 'MTrk' chunk.
+
+    Messages must already be in playing order; ticks are absolute.
+    """
+    body = bytearray()
+    last_tick = 0
+    for tick, message in messages:
+        body += _vlq(tick - last_tick)
+        body += message
+        last_tick = tick
+    body += b'\x00' + _meta(0x2F, b'')  # End of track
+    return b'MTrk' + struct.pack('>I', len(body)) + bytes(body)
+
+
+def encode_note_track(events, channel=0, program=None, name=None, tpq=TICKS_PER_QUARTER,
+                      header_messages=(), port=0):
+    """Encode an event array into a track chunk on one channel.
+
+    The program change (if any) is written once at the start of the track,
+    after a MIDI port meta event when the track is not on port 0.
+    header_messages are extra (tick, bytes) pairs such as controller
+    messages; they are merged in before notes on the same tick.
+    """
+    head = []
+    if name:
+        head.append((0, _meta(0x03, name.encode('latin-1', 'replace'))))
+    if port:
+        head.append((0, _meta(0x21, bytes([port & 0x7F]))))
+    if program is not None:
+        head.append((0, bytes([PROGRAM_CHANGE | channel, program & 0x7F])))
+
+    n = len(events)
+    on_ticks = np.rint(events['onset'] * tpq).astype(np.int64)
+    off_ticks = np.maximum(np.rint((events['onset'] + events['duration']) * tpq).astype(np.int64),
+                           on_ticks + 1)
+    ticks = np.concatenate((off_ticks, on_ticks))
+    # Note-offs sort before note-ons on the same tick so repeated notes retrigger
+    order = np.concatenate((np.zeros(n, dtype=np.int8), np.ones(n, dtype=np.int8)))
+    pitches = np.clip(np.concatenate((events['pitch'], events['pitch'])), 0, 127)
+    velocities = np.concatenate((np.full(n, 64), np.clip(events['velocity'], 1, 127)))
+    index = np.lexsort((order, ticks))
+
+    extra = sorted(header_messages, key=lambda m: m[0])
+    next_extra = 0
+    messages = head
+    off_status, on_status = NOTE_OFF | channel, NOTE_ON | channel
+    for tick, is_on, pitch, velocity in zip(ticks[index].tolist(), order[index].tolist(),
+                                            pitches[index].tolist(), velocities[index].tolist()):
+        while next_extra < len(extra) and extra[next_extra][0] <= tick:
+            messages.append(extra[next_extra])
+            next_extra += 1
+        messages.append((tick, bytes((on_status if is_on else off_status, pitch, velocity))))
+    messages.extend(extra[next_extra:])
+    return encode_track_chunk(messages)
+
+
+def encode_conductor_track(tempo_map, time_signatures=(), key_signatures=(), tpq=TICKS_PER_QUARTER):
+    """Encode tempo, time and key signature meta events into a track chunk.
+
+    time_signatures are (beat, numerator, denominator) and key_signatures
+    (beat, sharps, is_minor) tuples; tempo_map provides changes().
+    """
+    messages = []
+    for beat, numerator, denominator in time_signatures:
+        payload = bytes((numerator, denominator.bit_length() - 1, 24, 8))
+        messages.append((int(round(beat * tpq)), 0, _meta(0x58, payload)))
+    for beat, sharps, is_minor in key_signatures:
+        payload = struct.pack('>bB', sharps, 1 if is_minor else 0)
+        messages.append((int(round(beat * tpq)), 1, _meta(0x59, payload)))
+    for beat, bpm in tempo_map.changes():
+        microseconds = int(round(60_000_000 / bpm))
+        messages.append((int(round(beat * tpq)), 2, _meta(0x51, microseconds.to_bytes(3, 'big'))))
+    messages.sort(key=lambda m: (m[0], m[1]))
+    return encode_track_chunk([(tick, message) for tick, _, message in messages])
+
+
+def controller_messages(controllers, channel, tpq=TICKS_PER_QUARTER):
+    """(tick, bytes) control change messages from a CONTROLLER_DTYPE array."""
+    ticks = np.rint(controllers['beat'] * tpq).astype(np.int64).tolist()
+    status = CONTROL_CHANGE | channel
+    return [(tick, bytes((status, controller & 0x7F, value & 0x7F)))
+            for tick, controller, value in zip(ticks, controllers['controller'].tolist(),
+                                               controllers['value'].tolist())]
+
+
+def encode_song_track(track, tpq=TICKS_PER_QUARTER):
+    """Encode a song_events.Track using its own port, channel, program and controllers."""
+    return encode_note_track(track.events, track.channel,
+                             None if track.is_drum else track.program, track.name, tpq,
+                             controller_messages(track.controllers, track.channel, tpq), track.port)
+
+
+@lru_cache(maxsize=256)
+def routing_table(layout, max_ports=None):
+    """Routes for a track layout, a tuple of (is_drum, program) per track.
+
+    Melodic tracks take the channels of MELODIC_CHANNELS in order, port by
+    port; drum tracks share the drum channel of port 0, where they need no
+    program change. Raises ValueError when more than max_ports ports
+    (None = no limit) would be needed.
+    """
+    routes = []
+    melodic = 0
+    for is_drum, program in layout:
+        if is_drum:
+            routes.append(Route(0, DRUM_CHANNEL, None))
+            continue
+        port, slot = divmod(melodic, len(MELODIC_CHANNELS))
+        if max_ports is not None and port >= max_ports:
+            raise ValueError(f"{sum(not d for d, _ in layout)} melodic tracks need more than "
+                             f"{max_ports} MIDI ports of {len(MELODIC_CHANNELS)} channels")
+        routes.append(Route(port, MELODIC_CHANNELS[slot], program))
+        melodic += 1
+    return tuple(routes)
+
+
+def assign_channels(tracks, max_ports=None):
+    """Set port and channel of every track from its routing table."""
+    layout = tuple((track.is_drum, None if track.is_drum else track.program) for track in tracks)
+    for track, route in zip(tracks, routing_table(layout, max_ports)):
+        track.port = route.port
+        track.channel = route.channel
+    return tracks
+
+
+def ports_used(tracks):
+    """Sorted ports the tracks are routed to."""
+    return sorted({track.port for track in tracks})
+
+
+def midi_file_bytes(chunks, tpq=TICKS_PER_QUARTER):
+    """Assemble a format 1 file from encoded track chunks."""
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(chunks), tpq)
+    return header + b''.join(chunks)
+
+
+def write_midi_file(path, chunks, tpq=TICKS_PER_QUARTER):
+    """Write a format 1 file and return the number of bytes written."""
+    data = midi_file_bytes(chunks, tpq)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return len(data)
@@ -0,0 +1,120 @@
+"""Key changes between sections through pivot chords.
+
+Keys are (tonic pitch class, mode) pairs. For every pair of keys a song
+can use, the distance on the circle of fifths, the pivot chord and the
+transition chords are worked out once into a ModulationTable, so planning
+a modulation during generation is a dict lookup. Nothing here needs
+music21; chord names come out in the form song_events.parse_chord reads.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+MODES = ('major', 'minor')
+
+# Diatonic triads of a key as (semitones above the tonic, chord quality)
+DIATONIC = {
+    'major': ((0, ''), (2, 'm'), (4, 'm'), (5, ''), (7, ''), (9, 'm')),
+    'minor': ((0, 'm'), (3, ''), (5, 'm'), (7, 'm'), (8, ''), (10, '')),
+}
+# How well a chord leads into a key, by its degree there; pre-dominants lead best
+PIVOT_WEIGHT = {
+    'major': {2: 3, 5: 3, 9: 2, 4: 1, 0: 0, 7: 0},
+    'minor': {5: 3, 8: 2, 3: 1, 10: 1, 0: 0, 7: 0},
+}
+SHARP_NAMES = ('C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B')
+FLAT_NAMES = ('C', 'Db', 'D', 'Eb', 'E', 'F', 'Gb', 'G', 'Ab', 'A', 'Bb', 'B')
+
+# chords lead from the source key into the target key, pivot is None for a
+# direct modulation (no chord shared by both keys)
+Modulation = namedtuple('Modulation', 'source target distance pivot chords')
+
+
+def key_signature(key):
+    """Sharps (positive) or flats (negative) of a key's signature."""
+    tonic, mode = key
+    major_tonic = tonic if mode == 'major' else (tonic + 3) % 12
+    sharps = (major_tonic * 7) % 12
+    return sharps - 12 if sharps > 6 else sharps
+
+
+def key_distance(a, b):
+    """Steps between two keys on the circle of fifths (relative keys are 0)."""
+    steps = (key_signature(a) - key_signature(b)) % 12
+    return min(steps, 12 - steps)
+
+
+def chord_name(root, quality, key, flat='b'):
+    """Name of a chord, spelled with flats in flat keys (flat='-' for music21)."""
+    if key_signature(key) < 0:
+        return FLAT_NAMES[root % 12].replace('b', flat) + quality
+    return SHARP_NAMES[root % 12] + quality
+
+
+def diatonic_chords(key):
+    """(root pitch class, quality) of the diatonic triads of a key."""
+    tonic, mode = key
+    return tuple(((tonic + offset) % 12, quality) for offset, quality in DIATONIC[mode])
+
+
+def _plan(source, target, bars, flat):
+    distance = key_distance(source, target)
+    if source == target or bars <= 0:
+        return Modulation(source, target, distance, None, ())
+    tonic, mode = target
+    shared = set(diatonic_chords(source)) & set(diatonic_chords(target))
+    weight = PIVOT_WEIGHT[mode]
+    if shared:
+        # Best lead into the new key; ties go to the lower root for a stable table
+        pivot = max(sorted(shared), key=lambda chord: weight[(chord[0] - tonic) % 12])
+    else:
+        # No common chord: the new key's pre-dominant, approached directly
+        pivot = ((tonic + (2 if mode == 'major' else 5)) % 12, 'm')
+    dominant = (tonic + 7) % 12
+    dominant_bars = max(bars // 2, 1)
+    chords = ([chord_name(*pivot, target, flat)] * (bars - dominant_bars)
+              + [chord_name(dominant, '', target, flat)] * (dominant_bars - 1)
+              + [chord_name(dominant, '7', target, flat)])
+    return Modulation(source, target, distance, chord_name(*pivot, target, flat) if shared else None,
+                      tuple(chords))
+
+
+class ModulationTable:
+    """Precomputed modulations between every pair of a set of keys.
+
+    distance[i, j] is the circle-of-fifths distance between keys[i] and
+    keys[j]. plan(source, target) returns the Modulation for the last bars
+    of a section in source leading into target.
+    """
+
+    def __init__(self, keys, bars=2, flat='b'):
+        self.keys = tuple(sorted(set(keys)))
+        self.bars = bars
+        self.flat = flat
+        self._index = {k: i for i, k in enumerate(self.keys)}
+        self.distance = np.array([[key_distance(a, b) for b in self.keys] for a in self.keys], dtype=np.int8)
+        self.distance.setflags(write=False)
+        self._plans = {(a, b): _plan(a, b, bars, flat) for a in self.keys for b in self.keys}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def plan(self, source, target):
+        try:
+            return self._plans[source, target]
+        except KeyError:
+            raise KeyError(f"Modulation {source} -> {target} is not in the table of {self.keys}") from None
+
+    def transition(self, source, target):
+        """Transition chord names only (empty when the key stays)."""
+        return self.plan(source, target).chords
+
+
+@lru_cache(maxsize=64)
+def modulation_table(keys, bars=2, flat='b'):
+    """Cached ModulationTable for a tuple of (tonic pitch class, mode) keys."""
+    for tonic, mode in keys:
+        if mode not in MODES or not 0 <= tonic < 12:
+            raise ValueError(f"Invalid key {(tonic, mode)!r}")
+    return ModulationTable(keys, bars, flat)
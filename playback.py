@@ -0,0 +1,233 @@
+"""Persistent playback engine for the GUIs.
+
+The synth and SoundFont are loaded once and reused for every song. Songs are
+turned into a time-sorted message array up front and a single scheduler
+thread plays them from an in-memory queue, so the next song starts without
+a gap and stop() takes effect immediately. fluidsynth is imported lazily.
+"""
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+IDLE = 'idle'
+PLAYING = 'playing'
+STOPPING = 'stopping'
+
+MESSAGE_DTYPE = np.dtype([
+    ('time', '<f8'),
+    ('status', 'u1'),
+    ('data1', 'u1'),
+    ('data2', 'u1'),
+])
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+ALL_NOTES_OFF = 123
+
+
+def song_messages(tracks, tempo_map):
+    """Flatten song_events.Track objects into a message array in seconds.
+
+    Program and controller changes come first, note-offs sort before
+    note-ons at the same time so repeated notes retrigger cleanly.
+    """
+    blocks, orders = [], []
+    programs = [t for t in tracks if not t.is_drum]
+    head = np.zeros(len(programs), dtype=MESSAGE_DTYPE)
+    head['status'] = [PROGRAM_CHANGE | t.channel for t in programs]
+    head['data1'] = [t.program & 0x7F for t in programs]
+    blocks.append(head)
+    orders.append(np.zeros(len(head), dtype=np.int8))
+    for track in tracks:
+        if len(track.controllers):
+            controls = np.zeros(len(track.controllers), dtype=MESSAGE_DTYPE)
+            controls['time'] = tempo_map.seconds_at(track.controllers['beat'])
+            controls['status'] = CONTROL_CHANGE | track.channel
+            controls['data1'] = track.controllers['controller']
+            controls['data2'] = track.controllers['value']
+            blocks.append(controls)
+            orders.append(np.zeros(len(controls), dtype=np.int8))
+        events = track.events
+        if not len(events):
+            continue
+        n = len(events)
+        block = np.zeros(2 * n, dtype=MESSAGE_DTYPE)
+        block['time'][:n] = tempo_map.seconds_at(events['onset'] + events['duration'])
+        block['time'][n:] = tempo_map.seconds_at(events['onset'])
+        block['status'][:n] = NOTE_OFF | track.channel
+        block['status'][n:] = NOTE_ON | track.channel
+        block['data1'] = np.tile(np.clip(events['pitch'], 0, 127), 2)
+        block['data2'][n:] = np.clip(events['velocity'], 1, 127)
+        blocks.append(block)
+        orders.append(np.repeat(np.array([1, 2], dtype=np.int8), n))
+    messages = np.concatenate(blocks)
+    order = np.concatenate(orders)
+    return messages[np.lexsort((order, messages['time']))]
+
+
+class FluidSynthOutput:
+    """Sends messages to a FluidSynth instance that stays alive between songs."""
+
+    def __init__(self, soundfont_path, driver=None):
+        import fluidsynth
+
+        if driver is None:
+            # "alsa" für Linux, "coreaudio" für macOS, "dsound" für Windows
+            driver = "dsound" if os.name == 'nt' else "alsa"
+            if sys.platform == 'darwin':
+                driver = "coreaudio"
+        self.synth = fluidsynth.Synth()
+        self.synth.start(driver=driver)
+        self.soundfont_path = None
+        self.sfid = None
+        self.load_soundfont(soundfont_path)
+
+    def load_soundfont(self, soundfont_path):
+        """Load a SoundFont unless it is already the active one."""
+        if soundfont_path == self.soundfont_path:
+            return
+        if self.sfid is not None:
+            self.synth.sfunload(self.sfid)
+        self.sfid = self.synth.sfload(soundfont_path)
+        self.soundfont_path = soundfont_path
+        for channel in range(16):
+            self.synth.program_select(channel, self.sfid, 128 if channel == 9 else 0, 0)
+
+    def send(self, status, data1, data2):
+        kind, channel = status & 0xF0, status & 0x0F
+        if kind == NOTE_ON and data2:
+            self.synth.noteon(channel, data1, data2)
+        elif kind in (NOTE_ON, NOTE_OFF):
+            self.synth.noteoff(channel, data1)
+        elif kind == PROGRAM_CHANGE:
+            self.synth.program_change(channel, data1)
+        elif kind == CONTROL_CHANGE:
+            self.synth.cc(channel, data1, data2)
+
+    def all_notes_off(self):
+        for channel in range(16):
+            self.synth.cc(channel, ALL_NOTES_OFF, 0)
+
+    def close(self):
+        self.synth.delete()
+
+
+class PlaybackEngine:
+    """Lock-protected player with a gapless queue on top of one output.
+
+    output needs send(status, data1, data2), all_notes_off() and close().
+    on_state_change(state, label) is called from the scheduler thread.
+    """
+
+    def __init__(self, output, on_state_change=None):
+        self.output = output
+        self.on_state_change = on_state_change
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queue = deque()
+        self._cancel = threading.Event()
+        self._state = IDLE
+        self._label = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='PlaybackEngine', daemon=True)
+        self._thread.start()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def _set_state(self, state, label):
+        # Caller holds the lock; the callback runs after it is released
+        self._state = state
+        self._label = label
+        return state, label
+
+    def _notify(self, change):
+        if self.on_state_change is not None:
+            self.on_state_change(*change)
+
+    def play(self, messages, label=None):
+        """Stop whatever is playing and start messages right away."""
+        with self._lock:
+            self._queue.clear()
+            if self._state == PLAYING:
+                self._cancel.set()
+            self._queue.append((messages, label))
+            self._wakeup.notify()
+
+    def enqueue(self, messages, label=None):
+        """Queue messages to start exactly when the current song ends."""
+        with self._lock:
+            self._queue.append((messages, label))
+            self._wakeup.notify()
+
+    def stop(self):
+        """Cancel playback and drop queued songs; False if nothing played."""
+        with self._lock:
+            self._queue.clear()
+            if self._state != PLAYING:
+                return False
+            self._cancel.set()
+            change = self._set_state(STOPPING, self._label)
+        self._notify(change)
+        return True
+
+    def shutdown(self):
+        """Stop, end the scheduler thread and release the output."""
+        with self._lock:
+            self._closed = True
+            self._queue.clear()
+            self._cancel.set()
+            self._wakeup.notify()
+        self._thread.join()
+        self.output.close()
+
+    def _run(self):
+        song_end = None
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    song_end = None
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                messages, label = self._queue.popleft()
+                self._cancel.clear()
+                change = self._set_state(PLAYING, label)
+            self._notify(change)
+
+            # Continue on the previous song's timeline when queued back to back
+            start = time.perf_counter() if song_end is None else max(song_end, time.perf_counter() - 0.05)
+            cancelled = self._play_messages(messages, start)
+            song_end = None if cancelled or not len(messages) else start + float(messages['time'][-1])
+
+            with self._lock:
+                finished = not self._queue or cancelled
+                if finished and self._state != IDLE:
+                    change = self._set_state(IDLE, label)
+                else:
+                    change = None
+            if change is not None:
+                self._notify(change)
+
+    def _play_messages(self, messages, start):
+        send = self.output.send
+        for t, status, data1, data2 in zip(messages['time'].tolist(), messages['status'].tolist(),
+                                           messages['data1'].tolist(), messages['data2'].tolist()):
+            delay = start + t - time.perf_counter()
+            if delay > 0 and self._cancel.wait(delay):
+                break
+            if self._cancel.is_set():
+                break
+            send(status, data1, data2)
+        else:
+            return False
+        self.output.all_notes_off()
+        return True
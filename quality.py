@@ -0,0 +1,167 @@
+"""Cheap quality metrics on event arrays and a section reroll gate.
+
+Blocks are scored straight from their event arrays, before grooving or
+MIDI encoding. Metrics run cheapest first and stop at the first limit a
+block breaks, so a typical good block costs a few NumPy reductions:
+
+    density      notes per beat
+    range        highest minus lowest pitch
+    root_ratio   share of notes on the root of the chord sounding at onset
+    entropy      pitch-class entropy in bits (log2(12) = 3.58 at most)
+    repetition   share of repeated interval n-grams
+
+QualityGate rerolls blocks that fail, with a fixed number of attempts per
+block and rerolls per song so that batch throughput stays predictable.
+"""
+import time
+
+import numpy as np
+
+from song_model import derive_seed
+
+NGRAM = 4  # Notes per interval n-gram for the repetition metric
+
+# Limits per role; a missing limit is not checked. A lead line stuck on chord
+# roots, one pitch area or a single repeated figure fails
+LIMITS = {
+    'melody': {'min_density': 0.5, 'max_density': 4.0, 'min_range': 12, 'max_range': 24,
+               'max_root_ratio': 0.45, 'min_entropy': 2.0, 'max_repetition': 0.5},
+    'bass': {'min_density': 0.25, 'max_density': 2.0, 'min_range': 3, 'min_entropy': 1.0},
+}
+
+# Evaluation order (cheapest first) and the limits each metric is held to
+METRICS = (
+    ('density', 'min_density', 'max_density'),
+    ('range', 'min_range', 'max_range'),
+    ('root_ratio', None, 'max_root_ratio'),
+    ('entropy', 'min_entropy', None),
+    ('repetition', None, 'max_repetition'),
+)
+
+
+def _density(events, length, **_):
+    return len(np.unique(events['onset'])) / length if length else 0.0
+
+
+def _range(events, **_):
+    return int(events['pitch'].max() - events['pitch'].min())
+
+
+def _root_ratio(events, start, bar_length, progression, **_):
+    if progression is None:
+        return 0.0
+    bar = ((events['onset'] - start) // bar_length).astype(np.int64)
+    roots = progression.roots[progression.per_bar(int(bar.max()) + 1)[bar]]
+    return float(np.mean(events['pitch'] % 12 == roots))
+
+
+def _entropy(events, **_):
+    counts = np.bincount(events['pitch'] % 12, minlength=12)
+    p = counts[counts > 0] / len(events)
+    return float(-(p * np.log2(p)).sum())
+
+
+def _repetition(events, **_):
+    if len(events) <= NGRAM:
+        return 0.0
+    order = np.argsort(events['onset'], kind='stable')
+    intervals = np.clip(np.diff(events['pitch'][order].astype(np.int64)), -64, 63) + 64
+    grams = np.lib.stride_tricks.sliding_window_view(intervals, NGRAM - 1)
+    codes = grams @ (128 ** np.arange(NGRAM - 1))  # 7 bits per interval
+    return 1.0 - len(np.unique(codes)) / len(codes)
+
+
+_MEASURES = {'density': _density, 'range': _range, 'root_ratio': _root_ratio,
+             'entropy': _entropy, 'repetition': _repetition}
+
+
+def check(events, limits, start=0.0, length=None, bar_length=4.0, progression=None):
+    """Score a block against limits, stopping at the first one it breaks.
+
+    Returns (failed, metrics): failed is None or the name of the broken
+    metric, metrics holds every metric computed so far. start and length
+    place the block on the beat axis; progression (a CompiledProgression)
+    cycles per bar from start and is only needed for root_ratio.
+    """
+    metrics = {}
+    if not len(events):
+        return ('density' if limits.get('min_density') else None), {'density': 0.0}
+    if length is None:
+        length = float((events['onset'] + events['duration']).max() - start)
+    args = dict(start=start, length=length, bar_length=bar_length, progression=progression)
+    for name, low, high in METRICS:
+        if limits.get(low) is None and limits.get(high) is None:
+            continue
+        value = metrics[name] = _MEASURES[name](events, **args)
+        if (low in limits and value < limits[low]) or (high in limits and value > limits[high]):
+            return name, metrics
+    return None, metrics
+
+
+def measure(events, start=0.0, length=None, bar_length=4.0, progression=None):
+    """Every metric of a block, without limits."""
+    no_limits = {(low or high): (-np.inf if low else np.inf) for _, low, high in METRICS}
+    return check(events, no_limits, start, length, bar_length, progression)[1]
+
+
+def _rank(failed):
+    # How far a block got through the checks; passing ranks highest
+    names = [name for name, _, _ in METRICS]
+    return len(names) if failed is None else names.index(failed)
+
+
+class QualityGate:
+    """Reroll the blocks of a SongModel that fail their quality checks.
+
+    checks(section_index) returns [(track name, limits, progression), ...]
+    for a section. Sections sharing a block key are checked and rerolled
+    together, so repeats stay identical. A block gets attempts rerolls, a
+    song at most budget rerolls and max_seconds of rerolling (None = no
+    limit). When all attempts fail, the attempt that passed the most
+    checks is kept. Reroll seeds derive from the song seed.
+    """
+
+    def __init__(self, checks, attempts=3, budget=8, max_seconds=None):
+        self.checks = checks
+        self.attempts = attempts
+        self.budget = budget
+        self.max_seconds = max_seconds
+
+    def _check(self, model, section_index, track, limits, progression):
+        grid = model.grid
+        return check(model.block_events(section_index, track), limits,
+                     start=grid.section_offset(section_index), length=grid.section_length(section_index),
+                     bar_length=float(grid.section_bar_lengths(section_index)[0]),
+                     progression=progression)[0]
+
+    def refine(self, model, executor=None):
+        """Check and reroll blocks in place; returns a report dict."""
+        deadline = None if self.max_seconds is None else time.perf_counter() + self.max_seconds
+        report = {'checked': 0, 'rejected': 0, 'rerolls': 0, 'failed': []}
+        sections = {}
+        for section_index, key in enumerate(model.section_keys):
+            sections.setdefault(key, []).append(section_index)
+        for key, indexes in sections.items():
+            for track, limits, progression in self.checks(indexes[0]):
+                report['checked'] += 1
+                failed = self._check(model, indexes[0], track, limits, progression)
+                if failed is None:
+                    continue
+                report['rejected'] += 1
+                best = (_rank(failed), failed, model.save_blocks(indexes, track))
+                for attempt in range(self.attempts):
+                    if report['rerolls'] >= self.budget or (deadline and time.perf_counter() > deadline):
+                        break
+                    seed = derive_seed(model.seed, 'quality', key, track, attempt)
+                    model.regenerate(indexes, track, seed, executor)
+                    report['rerolls'] += 1
+                    failed = self._check(model, indexes[0], track, limits, progression)
+                    if failed is None:
+                        break
+                    if _rank(failed) > best[0]:
+                        best = (_rank(failed), failed, model.save_blocks(indexes, track))
+                if failed is not None:
+                    if _rank(failed) < best[0]:
+                        model.restore_blocks(best[2])
+                    report['failed'].append((indexes[0], track, best[1]))
+        return report
@@ -0,0 +1,294 @@
+"""Real-time streaming of endlessly generated music to a MIDI output.
+
+A producer thread pulls sections from a source iterator ahead of the
+playhead and appends them, as playback.MESSAGE_DTYPE arrays on one
+continuous timeline, to a bounded ring buffer. A scheduler thread sends due
+messages to the output. Only numpy arrays cross the hot path; music21 may be
+used by the source, which runs on the producer thread.
+
+If the source falls behind (generating a section takes longer than playing
+one), the scheduler counts an underrun and either repeats the last section
+or waits in silence until the next one arrives.
+"""
+import threading
+import time
+
+import numpy as np
+
+from playback import ALL_NOTES_OFF, CONTROL_CHANGE, MESSAGE_DTYPE, PROGRAM_CHANGE, song_messages
+
+DEFAULT_CAPACITY = 1 << 16  # Messages held ahead of the playhead
+START_LEAD = 0.25  # Seconds between queueing a section and its first message
+SPIN_SECONDS = 0.002  # Busy-wait this close to a deadline instead of sleeping
+JITTER_WINDOW = 4096  # Latest send delays kept for the jitter statistics
+
+
+class RingBuffer:
+    """Bounded single-producer, single-consumer queue of timed messages."""
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=MESSAGE_DTYPE)
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self._space = threading.Condition(self._lock)
+
+    def __len__(self):
+        with self._lock:
+            return self._size
+
+    def push(self, messages, stop=None):
+        """Append messages, waiting for space; False if stop was set."""
+        written = 0
+        while written < len(messages):
+            with self._lock:
+                while self._size == self.capacity:
+                    if stop is not None and stop.is_set():
+                        return False
+                    self._space.wait(0.05)
+                count = min(len(messages) - written, self.capacity - self._size)
+                tail = (self._head + self._size) % self.capacity
+                first = min(count, self.capacity - tail)
+                self._data[tail:tail + first] = messages[written:written + first]
+                self._data[:count - first] = messages[written + first:written + count]
+                self._size += count
+            written += count
+        return True
+
+    def peek_time(self):
+        """Time of the next message, None when empty."""
+        with self._lock:
+            return float(self._data['time'][self._head]) if self._size else None
+
+    def pop_until(self, deadline):
+        """Remove and return every leading message due at or before deadline."""
+        with self._lock:
+            first = self._data[self._head:self._head + min(self._size, self.capacity - self._head)]
+            count = int(np.searchsorted(first['time'], deadline, side='right'))
+            out = first[:count].copy()
+            if count == len(first) and count < self._size:
+                second = self._data[:self._size - count]
+                wrapped = int(np.searchsorted(second['time'], deadline, side='right'))
+                out = np.concatenate((out, second[:wrapped]))
+                count += wrapped
+            self._head = (self._head + count) % self.capacity
+            self._size -= count
+            self._space.notify()
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._head = self._size = 0
+            self._space.notify()
+
+
+class LoopbackOutput:
+    """Records what would have been sent; stand-in for tests and benchmarks."""
+
+    def __init__(self):
+        self.sent = []
+        self._clock = time.perf_counter
+
+    def send(self, status, data1, data2):
+        self.sent.append((self._clock(), status, data1, data2))
+
+    def all_notes_off(self):
+        for channel in range(16):
+            self.send(CONTROL_CHANGE | channel, ALL_NOTES_OFF, 0)
+
+    def close(self):
+        pass
+
+
+class RtMidiOutput:
+    """Hardware port or virtual port through python-rtmidi.
+
+    With virtual=True a new port named port_name is created, which on Linux
+    is an ALSA sequencer port other programs can subscribe to. Otherwise the
+    first existing port whose name contains port_name is opened.
+    """
+
+    def __init__(self, port_name='Song Engine', virtual=True):
+        import rtmidi
+
+        self.midi_out = rtmidi.MidiOut()
+        if virtual:
+            self.midi_out.open_virtual_port(port_name)
+        else:
+            ports = self.midi_out.get_ports()
+            matches = [i for i, name in enumerate(ports) if port_name in name]
+            if not matches:
+                raise ValueError(f"No MIDI output port matching {port_name!r}, available: {ports}")
+            self.midi_out.open_port(matches[0])
+
+    def send(self, status, data1, data2):
+        self.midi_out.send_message([status, data1, data2])
+
+    def all_notes_off(self):
+        for channel in range(16):
+            self.send(CONTROL_CHANGE | channel, ALL_NOTES_OFF, 0)
+
+    def close(self):
+        self.all_notes_off()
+        self.midi_out.close_port()
+        del self.midi_out
+
+
+def song_sections(tracks, grid):
+    """Yield (messages, duration) per section of a generated song.
+
+    Message times are seconds from the section start; a note crossing a
+    section boundary is ended by the next section, which follows seamlessly.
+    """
+    tempo_map = grid.tempo_map
+    messages = song_messages(tracks, tempo_map)
+    # song_messages puts the program changes first
+    program_changes = messages[:np.count_nonzero((messages['status'] & 0xF0) == PROGRAM_CHANGE)]
+    messages = messages[len(program_changes):]
+    bounds = tempo_map.seconds_at(grid.section_offsets)
+    cuts = np.searchsorted(messages['time'], bounds[1:-1], side='left')
+    start = 0
+    for i, cut in enumerate(list(cuts) + [len(messages)]):
+        part = messages[start:cut].copy()
+        part['time'] -= bounds[i]
+        # Program changes again at every section so a late joiner gets the right sounds
+        head = program_changes.copy()
+        head['time'] = 0.0
+        yield np.concatenate((head, part)), float(bounds[i + 1] - bounds[i])
+        start = cut
+
+
+class RealtimeStreamer:
+    """Producer and scheduler threads around a RingBuffer.
+
+    source is an iterable of (messages, duration) with times in seconds
+    relative to the start of that section. output needs send(), all_notes_off()
+    and close(). on_underrun is 'repeat' (play the last section again) or
+    'silence' (wait for the source); sections larger than the ring capacity
+    are never repeated.
+    """
+
+    def __init__(self, source, output, capacity=DEFAULT_CAPACITY, on_underrun='repeat'):
+        if on_underrun not in ('repeat', 'silence'):
+            raise ValueError(f"on_underrun must be 'repeat' or 'silence', not {on_underrun!r}")
+        self.source = source
+        self.output = output
+        self.on_underrun = on_underrun
+        self.ring = RingBuffer(capacity)
+        self.underruns = 0
+        self.sections_queued = 0
+        self.messages_sent = 0
+        self._timeline_lock = threading.Lock()
+        self._timeline_end = 0.0
+        self._last_section = None
+        self._starved = False
+        self._delays = np.zeros(JITTER_WINDOW)
+        self._delay_count = 0
+        self._stop = threading.Event()
+        self._source_done = threading.Event()
+        self._t0 = None
+        self._producer = threading.Thread(target=self._produce, name='RealtimeProducer', daemon=True)
+        self._scheduler = threading.Thread(target=self._schedule, name='RealtimeScheduler', daemon=True)
+
+    def now(self):
+        return time.perf_counter() - self._t0
+
+    def start(self):
+        self._t0 = time.perf_counter()
+        self._producer.start()
+        self._scheduler.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Stop both threads, silence the output and release it."""
+        self._stop.set()
+        self.ring.clear()
+        self._producer.join(timeout)
+        self._scheduler.join(timeout)
+        self.output.all_notes_off()
+        self.output.close()
+
+    def wait(self, timeout=None):
+        """Block until a finite source has been played to the end."""
+        self._scheduler.join(timeout)
+        return not self._scheduler.is_alive()
+
+    def _append(self, messages, duration):
+        # Caller holds the timeline lock, so ring order always matches timeline order.
+        # A section never starts earlier than START_LEAD from now.
+        start = max(self._timeline_end, self.now() + START_LEAD)
+        self._timeline_end = start + duration
+        self._last_section = (messages, duration)
+        shifted = messages.copy()
+        shifted['time'] += start
+        return self.ring.push(shifted, self._stop)
+
+    def _produce(self):
+        try:
+            for messages, duration in self.source:
+                if self._stop.is_set():
+                    return
+                with self._timeline_lock:
+                    if not self._append(messages, duration):
+                        return
+                self.sections_queued += 1
+        finally:
+            self._source_done.set()
+
+    def _schedule(self):
+        send = self.output.send
+        while not self._stop.is_set():
+            due = self.ring.peek_time()
+            if due is None:
+                if self._source_done.is_set():
+                    return
+                self._handle_underrun()
+                continue
+            delay = due - self.now()
+            if delay > SPIN_SECONDS and self._stop.wait(delay - SPIN_SECONDS):
+                return
+            while self.now() < due:
+                pass
+            batch = self.ring.pop_until(self.now())
+            sent_at = self.now()
+            for status, data1, data2 in zip(batch['status'].tolist(), batch['data1'].tolist(),
+                                            batch['data2'].tolist()):
+                send(status, data1, data2)
+            self._record_delays(sent_at - batch['time'])
+            self._starved = False
+            self.messages_sent += len(batch)
+
+    def _handle_underrun(self):
+        # Never block here: the producer may hold the lock while waiting for the ring to drain
+        repeated = False
+        if self._timeline_lock.acquire(blocking=False):
+            try:
+                # Late only once a section played out and nothing followed it
+                if self._last_section is not None and not len(self.ring) and self.now() >= self._timeline_end:
+                    if not self._starved:
+                        self._starved = True
+                        self.underruns += 1
+                        self.output.all_notes_off()
+                    # The ring is empty and the producer locked out, so a section that fits never blocks
+                    if self.on_underrun == 'repeat' and len(self._last_section[0]) <= self.ring.capacity:
+                        repeated = self._append(*self._last_section)
+            finally:
+                self._timeline_lock.release()
+        if not repeated:
+            self._stop.wait(SPIN_SECONDS)
+
+    def _record_delays(self, delays):
+        index = (self._delay_count + np.arange(len(delays))) % JITTER_WINDOW
+        self._delays[index] = delays
+        self._delay_count += len(delays)
+
+    def jitter_stats(self):
+        """Send delay statistics in milliseconds over the latest messages."""
+        delays = self._delays[:min(self._delay_count, JITTER_WINDOW)] * 1000.0
+        stats = {'messages': self.messages_sent, 'sections': self.sections_queued,
+                 'underruns': self.underruns}
+        if len(delays):
+            stats.update(mean_ms=float(delays.mean()), p99_ms=float(np.percentile(delays, 99)),
+                         max_ms=float(delays.max()))
+        return stats
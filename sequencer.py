@@ -0,0 +1,167 @@
+"""Step sequencer and arpeggiator for trance and techno lines.
+
+A pattern is 16 or 32 steps (one or two 4/4 bars of 16ths) written as
+text lanes and compiled once into small integer arrays:
+
+    notes    '.' rest, '0'-'9' a tone of the current chord (0 root,
+             1 third, 2 fifth, 3 the root an octave up, ...), 'x' the
+             next arpeggio tone in the pattern's order
+    accents  'x' plays the step at the accent velocity
+    slides   'x' holds the step into the next note (legato)
+
+gate is the sounding part of a step. A pattern restarts every bar (every
+two bars for 32 steps); shorter bars such as 3/4 play its first steps,
+longer bars wrap around into the pattern again.
+sequence() expands a pattern over a whole section in a few array
+operations, so dense 16th lines cost about as much as a single bar.
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+from song_events import empty_events, make_events
+
+STEPS_PER_BAR = 16  # Steps of a 4/4 bar
+STEP_LENGTH = 0.25  # Beats per step
+REST = -1
+ARP = -2
+TONES = 10  # Pool size: chord tones over a bit more than three octaves
+
+# Text lanes of the built-in patterns; missing lanes are empty
+PATTERNS = {
+    # Basslines
+    'rolling': {'notes': '.000.000.000.000', 'accents': '.x...x...x...x..', 'gate': 0.8},
+    'rolling_octave': {'notes': '.030.030.030.030', 'accents': '.x...x...x...x..', 'gate': 0.8},
+    'gallop': {'notes': '..00..00..00..00', 'accents': '..x...x...x...x.', 'gate': 0.7},
+    'offbeat': {'notes': '..0...0...0...0.', 'gate': 0.9},
+    'acid': {'notes': '0.03.02.0.30.2.1' '0.03.0.20.3.1.20',
+             'accents': 'x..x...x..x....x' 'x..x.....x..x...',
+             'slides': '...x......x.....' '...x..x.....x...', 'gate': 0.6},
+    # Leads and arpeggios
+    'arp_up': {'notes': 'xxxxxxxxxxxxxxxx', 'accents': 'x...x...x...x...', 'order': 'up', 'octaves': 2},
+    'arp_updown': {'notes': 'xxxxxxxxxxxxxxxx', 'accents': 'x...x...x...x...', 'order': 'updown', 'octaves': 2},
+    'arp_gated': {'notes': 'xx.xx.xx.xx.xx.x', 'accents': 'x..x..x..x..x..x', 'order': 'up', 'octaves': 2,
+                  'gate': 0.5},
+    'arp_random': {'notes': 'x.xxx.xxx.xxx.xx', 'order': 'random', 'octaves': 2, 'gate': 0.6},
+    'lead_call': {'notes': '0..2..3.2..0....' '0..2..4.3..2.1..',
+                  'accents': 'x.....x.........' 'x.....x.........',
+                  'slides': '......x.........' '......x.x.......', 'gate': 0.9},
+}
+
+ORDERS = ('up', 'down', 'updown', 'random')
+
+# notes holds a pool index, REST or ARP per step; accents and slides are bool arrays
+StepPattern = namedtuple('StepPattern', 'name notes accents slides gate order octaves')
+
+
+def _lane(text, length, name, lane):
+    if len(text) not in (0, length):
+        raise ValueError(f"Pattern {name!r}: {lane} lane has {len(text)} steps, notes have {length}")
+    return np.array([c == 'x' for c in text.ljust(length, '.')], dtype=bool)
+
+
+def compile_pattern(name, lanes):
+    """StepPattern from text lanes as in PATTERNS."""
+    text = lanes['notes']
+    if len(text) not in (STEPS_PER_BAR, 2 * STEPS_PER_BAR):
+        raise ValueError(f"Pattern {name!r} has {len(text)} steps, not 16 or 32")
+    codes = {'.': REST, 'x': ARP, **{str(d): d for d in range(TONES)}}
+    try:
+        notes = np.array([codes[c] for c in text], dtype=np.int8)
+    except KeyError as e:
+        raise ValueError(f"Pattern {name!r}: unknown step {e.args[0]!r}") from None
+    order = lanes.get('order', 'up')
+    if order not in ORDERS:
+        raise ValueError(f"Pattern {name!r}: unknown arpeggio order {order!r}, choose from {ORDERS}")
+    pattern = StepPattern(name, notes, _lane(lanes.get('accents', ''), len(notes), name, 'accents'),
+                          _lane(lanes.get('slides', ''), len(notes), name, 'slides'),
+                          float(lanes.get('gate', 0.8)), order, int(lanes.get('octaves', 1)))
+    for array in pattern[1:4]:
+        array.setflags(write=False)
+    return pattern
+
+
+@lru_cache(maxsize=None)
+def step_pattern(name):
+    """Compiled pattern of PATTERNS, cached."""
+    if name not in PATTERNS:
+        raise ValueError(f"Unknown step pattern {name!r}, choose from {sorted(PATTERNS)}")
+    return compile_pattern(name, PATTERNS[name])
+
+
+@lru_cache(maxsize=256)
+def tone_pool(table, low):
+    """TONES pitches per chord of a ChordTable: root, third, fifth, then an octave up.
+
+    Roots sit between low and low + 11.
+    """
+    pool = np.zeros((len(table.names), TONES), dtype=np.int16)
+    index = np.arange(TONES)
+    for i, root in enumerate(table.progression.roots.tolist()):
+        voicing = table.voicings[i, :min(table.voicing_sizes[i], 3)].astype(np.int16)
+        intervals = voicing - voicing[0]
+        pool[i] = low + (root - low) % 12 + intervals[index % len(intervals)] + 12 * (index // len(intervals))
+    pool.setflags(write=False)
+    return pool
+
+
+def _arp_tones(counter, size, order, rng):
+    # Pool index of the n-th arpeggio step of a bar over size tones
+    if order == 'down':
+        return size - 1 - counter % size
+    if order == 'updown':
+        period = max(2 * size - 2, 1)
+        step = counter % period
+        return np.where(step < size, step, period - step)
+    if order == 'random':
+        return rng.integers(0, size, len(counter))
+    return counter % size
+
+
+def sequence(pattern, table, bar_lengths, low=36, velocity=100, accent=127, rng=None):
+    """Note events of a step pattern played over consecutive bars.
+
+    pattern is a StepPattern or a name of PATTERNS. table is a
+    song_spec.ChordTable with one chord per bar, cycling; bar_lengths holds
+    the length of every bar in beats. Onsets start at 0 for the first bar.
+    """
+    if isinstance(pattern, str):
+        pattern = step_pattern(pattern)
+    bar_lengths = np.atleast_1d(np.asarray(bar_lengths, dtype=np.float64))
+    if not len(bar_lengths):
+        return empty_events()
+    num_measures = len(bar_lengths)
+    pattern_bars = len(pattern.notes) // STEPS_PER_BAR
+    bar_offsets = np.cumsum(bar_lengths) - bar_lengths
+
+    # Step grid of the section: one row per bar, cut at each bar's length
+    steps = np.arange(int(np.ceil(bar_lengths.max() / STEP_LENGTH)))
+    in_bar = steps[None, :] * STEP_LENGTH < bar_lengths[:, None] - 1e-9
+    index = (np.arange(num_measures)[:, None] % pattern_bars) * STEPS_PER_BAR + steps[None, :]
+    index %= len(pattern.notes)
+    notes = pattern.notes[index]
+    keep = in_bar & (notes != REST)
+    bars = np.broadcast_to(np.arange(num_measures)[:, None], keep.shape)[keep]
+    index, notes = index[keep], notes[keep].astype(np.int64)
+    if not len(bars):
+        return empty_events()
+    onsets = bar_offsets[bars] + np.broadcast_to(steps, keep.shape)[keep] * STEP_LENGTH
+
+    chords = table.progression.per_bar(num_measures)[bars]
+    arp = notes == ARP
+    if arp.any():
+        size = min(3 * pattern.octaves, TONES)
+        arp_bars = bars[arp]
+        counter = np.arange(len(arp_bars)) - np.searchsorted(arp_bars, arp_bars)  # Restarts every bar
+        notes[arp] = _arp_tones(counter, size, pattern.order, rng or np.random.default_rng())
+    pitches = tone_pool(table, low)[chords, notes]
+
+    # Gate per step; a slide holds on until the next note starts
+    durations = np.full(len(onsets), pattern.gate * STEP_LENGTH)
+    slides = pattern.slides[index]
+    if slides.any():
+        following = np.append(onsets[1:], bar_offsets[-1] + bar_lengths[-1])
+        durations[slides] = following[slides] - onsets[slides] + 0.1 * STEP_LENGTH
+    velocities = np.where(pattern.accents[index], accent, velocity)
+    return make_events(onsets, durations, pitches, velocities)
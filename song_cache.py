@@ -0,0 +1,175 @@
+"""Content-addressed on-disk cache for generated songs.
+
+Entries are keyed by a hash of every generation parameter plus the engine
+version, so a changed setting or a new engine release never returns stale
+music. Files are written atomically (temp file + os.replace) and eviction
+tolerates files vanishing underneath it, so several worker processes can
+share one cache directory.
+"""
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Mapping
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def _jsonable(value):
+    # Read-only mappings (e.g. a compiled spec's document) hash like the dicts they wrap
+    return dict(value) if isinstance(value, Mapping) else repr(value)
+
+
+def make_key(params, engine_version):
+    """Stable SHA-256 key for a parameter dict and engine version."""
+    payload = json.dumps({'engine': engine_version, 'params': params},
+                         sort_keys=True, separators=(',', ':'), default=_jsonable)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SongCache:
+    """Size and entry bounded cache with least-recently-used eviction.
+
+    Each entry can hold several artefacts ('mid', 'drums_only.mid', 'wav',
+    ...), stored as <root>/<key[:2]>/<key>.<kind>. Reads refresh the file
+    modification time, which is what eviction orders by.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(root, exist_ok=True)
+        self._approx_bytes = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key, kind):
+        return os.path.join(self.root, key[:2], f'{key}.{kind}')
+
+    def _scan(self):
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith('.'):
+                    continue  # In-flight temp file of another writer
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, key, kind='mid'):
+        """Return the cached bytes or None, counting hits and misses."""
+        path = self._path(key, kind)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return data
+
+    def _read_all(self, key, kinds):
+        # {kind: bytes} or None, without counting or refreshing anything
+        found = {}
+        for kind in kinds:
+            try:
+                with open(self._path(key, kind), 'rb') as f:
+                    found[kind] = f.read()
+            except FileNotFoundError:
+                return None
+        return found
+
+    def _lookup(self, key, found):
+        # Count one lookup and refresh the files of a hit
+        if found is None:
+            self.misses += 1
+            return None
+        for kind in found:
+            try:
+                os.utime(self._path(key, kind))
+            except FileNotFoundError:
+                pass
+        self.hits += 1
+        return found
+
+    def get_all(self, key, kinds):
+        """{kind: bytes} if every kind is cached, else None (one miss)."""
+        return self._lookup(key, self._read_all(key, kinds))
+
+    def get_indexed(self, key, index_kind='index.json'):
+        """(index, {kind: bytes}) of an entry listing its kinds in a JSON index.
+
+        index_kind holds a JSON object keyed by kind. Counts one lookup for
+        the index and every file it lists; None if any of them is missing.
+        """
+        found = self._read_all(key, [index_kind])
+        if found is not None:
+            index = json.loads(found[index_kind])
+            found = self._read_all(key, list(index))
+        if self._lookup(key, found) is None:
+            return None
+        try:
+            os.utime(self._path(key, index_kind))
+        except FileNotFoundError:
+            pass
+        return index, found
+
+    def put(self, key, data, kind='mid'):
+        """Atomically store data; concurrent writers of one key are harmless."""
+        path = self._path(key, kind)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        self._approx_bytes += len(data)
+        if self._approx_bytes > self.max_bytes or self.max_entries is not None:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Remove least recently used entries until within the limits."""
+        files = {}
+        for path, size, mtime in self._scan():
+            key = os.path.basename(path).split('.', 1)[0]
+            total, newest, paths = files.get(key, (0, 0.0, []))
+            paths.append(path)
+            files[key] = (total + size, max(newest, mtime), paths)
+        total_bytes = sum(entry[0] for entry in files.values())
+        entries = sorted(files.values(), key=lambda entry: entry[1])
+        removed = 0
+        while entries and (total_bytes > self.max_bytes or
+                           (self.max_entries is not None and len(entries) > self.max_entries)):
+            size, _, paths = entries.pop(0)
+            for path in paths:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+            removed += 1
+        self._approx_bytes = total_bytes
+        return removed
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
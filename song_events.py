@@ -0,0 +1,232 @@
+"""Shared event arrays and chord tables for the song engines.
+
+Generators describe notes as rows of a NumPy structured array instead of
+music21 objects, so whole sections can be built, shifted and merged in
+bulk. Chord names are compiled once into integer pitch classes and cached.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+# One row per note; onset and duration are in quarter-note beats
+EVENT_DTYPE = np.dtype([
+    ('onset', '<f8'),
+    ('duration', '<f8'),
+    ('pitch', '<i2'),
+    ('velocity', '<i2'),
+    ('track', '<i2'),
+])
+
+# Sparse controller changes of a track (CC7 volume, CC11 expression, ...)
+CONTROLLER_DTYPE = np.dtype([
+    ('beat', '<f8'),
+    ('controller', 'u1'),
+    ('value', 'u1'),
+])
+
+# Pitch classes of the note letters, accidentals are added on top
+NOTE_TO_PC = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+ACCIDENTALS = {'#': 1, 'b': -1, '-': -1}
+
+# Chord qualities as semitone intervals above the root
+CHORD_QUALITIES = {
+    '': (0, 4, 7),
+    'M': (0, 4, 7),
+    'maj': (0, 4, 7),
+    'm': (0, 3, 7),
+    'min': (0, 3, 7),
+    'dim': (0, 3, 6),
+    'aug': (0, 4, 8),
+    'sus2': (0, 2, 7),
+    'sus4': (0, 5, 7),
+    '7': (0, 4, 7, 10),
+    'maj7': (0, 4, 7, 11),
+    'm7': (0, 3, 7, 10),
+}
+
+
+def empty_events(n=0):
+    """Return a zeroed event array with n rows."""
+    return np.zeros(n, dtype=EVENT_DTYPE)
+
+
+def make_events(onsets, durations, pitches, velocities, track=0):
+    """Build an event array from parallel sequences (scalars broadcast)."""
+    onsets = np.asarray(onsets, dtype=np.float64)
+    events = empty_events(len(onsets))
+    events['onset'] = onsets
+    events['duration'] = durations
+    events['pitch'] = pitches
+    events['velocity'] = velocities
+    events['track'] = track
+    return events
+
+
+def concat_events(blocks):
+    """Concatenate event arrays, sorted stably by onset."""
+    blocks = [b for b in blocks if len(b)]
+    if not blocks:
+        return empty_events()
+    events = np.concatenate(blocks)
+    return events[np.argsort(events['onset'], kind='stable')]
+
+
+def shift_events(events, offset):
+    """Return a copy of events moved by offset beats."""
+    shifted = events.copy()
+    shifted['onset'] += offset
+    return shifted
+
+
+def _split_letter(name, kind):
+    # Semitones of a leading note letter and its accidentals (not wrapped), and the rest
+    if not name or name[0] not in NOTE_TO_PC:
+        raise ValueError(f"Unknown {kind} name: {name!r}")
+    semitones = NOTE_TO_PC[name[0]]
+    rest = name[1:]
+    while rest and rest[0] in ACCIDENTALS:
+        semitones += ACCIDENTALS[rest[0]]
+        rest = rest[1:]
+    return semitones, rest
+
+
+@lru_cache(maxsize=None)
+def parse_chord(name):
+    """Split a chord name such as 'Bbm' into (root pitch class, intervals)."""
+    root, rest = _split_letter(name, 'chord')
+    if rest not in CHORD_QUALITIES:
+        raise ValueError(f"Unknown chord quality in {name!r}")
+    return root % 12, CHORD_QUALITIES[rest]
+
+
+@lru_cache(maxsize=None)
+def pitch_class(name):
+    """Pitch class of a note name without octave, such as 'F#'."""
+    semitones, rest = _split_letter(name, 'note')
+    if rest:
+        raise ValueError(f"Unexpected {rest!r} in note name {name!r}")
+    return semitones % 12
+
+
+@lru_cache(maxsize=None)
+def note_number(name):
+    """MIDI note number of a note name with octave, such as 'Bb1' (C4 = 60)."""
+    semitones, rest = _split_letter(name, 'note')
+    try:
+        octave = int(rest)
+    except ValueError:
+        raise ValueError(f"Note name {name!r} needs an octave number") from None
+    midi = 12 * (octave + 1) + semitones
+    if not 0 <= midi <= 127:
+        raise ValueError(f"Note {name!r} is outside the MIDI range")
+    return midi
+
+
+@lru_cache(maxsize=None)
+def chord_pitch_classes(name):
+    """Return the pitch classes of a chord name, root first."""
+    root, intervals = parse_chord(name)
+    return tuple((root + i) % 12 for i in intervals)
+
+
+class CompiledProgression:
+    """A chord progression resolved to integer pitch classes.
+
+    roots[i] is the root pitch class of chord i, tone_mask[i, pc] marks its
+    chord tones. Instances are cached and read-only, share them freely.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        if not self.names:
+            raise ValueError("A chord progression needs at least one chord")
+        self.tones = tuple(chord_pitch_classes(n) for n in self.names)
+        self.roots = np.array([t[0] for t in self.tones], dtype=np.int16)
+        self.tone_mask = np.zeros((len(self.names), 12), dtype=bool)
+        for i, tones in enumerate(self.tones):
+            self.tone_mask[i, list(tones)] = True
+        self.roots.setflags(write=False)
+        self.tone_mask.setflags(write=False)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return f"CompiledProgression({list(self.names)!r})"
+
+    def per_bar(self, num_measures):
+        """Chord index for each bar, cycling through the progression."""
+        return np.arange(num_measures) % len(self.names)
+
+
+@lru_cache(maxsize=256)
+def _compile_progression(names):
+    return CompiledProgression(names)
+
+
+def compile_progression(chord_progression):
+    """Compile (or fetch from cache) a progression given as chord names."""
+    if isinstance(chord_progression, CompiledProgression):
+        return chord_progression
+    return _compile_progression(tuple(chord_progression))
+
+
+class Track:
+    """A named event array plus the MIDI settings it is written with.
+
+    controllers is an optional CONTROLLER_DTYPE array of controller changes,
+    port the MIDI port (see midi_writer.assign_channels).
+    """
+
+    def __init__(self, name, events, program=0, channel=0, is_drum=False, controllers=None, port=0):
+        self.name = name
+        self.events = events
+        self.program = program
+        self.channel = 9 if is_drum else channel
+        self.is_drum = is_drum
+        self.controllers = np.zeros(0, dtype=CONTROLLER_DTYPE) if controllers is None else controllers
+        self.port = port
+
+    def __repr__(self):
+        return (f"Track({self.name!r}, {len(self.events)} events, program={self.program}, "
+                f"channel={self.channel}, port={self.port})")
+
+
+def events_from_part(part, track=0, default_velocity=90):
+    """Collect the notes of a music21 Part (or Stream) as an event array.
+
+    Chords and chord symbols contribute one event per pitch, unpitched drum
+    hits use the General MIDI number stored in their ps attribute.
+    """
+    onsets, durations, pitches, velocities = [], [], [], []
+    flat = part.flatten()
+    for n in flat.notes:
+        if n.isChord:
+            midis = [p.midi for p in n.pitches]
+        elif hasattr(n, 'pitch'):
+            midis = [n.pitch.midi]
+        else:
+            midis = [int(getattr(n, 'ps', None) or n.displayPitch().midi)]
+        velocity = n.volume.velocity if n.volume.velocity is not None else default_velocity
+        offset = float(n.getOffsetBySite(flat))
+        for midi in midis:
+            onsets.append(offset)
+            durations.append(float(n.quarterLength))
+            pitches.append(midi)
+            velocities.append(velocity)
+    events = make_events(onsets, durations, pitches, velocities, track)
+    return events[np.argsort(events['onset'], kind='stable')]
+
+
+def events_to_part(events, part=None):
+    """Convert an event array into a music21 Part for writing with music21."""
+    from music21 import note, stream
+
+    if part is None:
+        part = stream.Part()
+    for onset, dur, midi, velocity in zip(events['onset'].tolist(), events['duration'].tolist(),
+                                          events['pitch'].tolist(), events['velocity'].tolist()):
+        n = note.Note(midi, quarterLength=dur)
+        n.volume.velocity = velocity
+        part.insert(onset, n)
+    return part
@@ -0,0 +1,295 @@
+"""Song model with independently regenerable section/track blocks.
+
+A song is a grid of blocks, one per (section, generator). Every block keeps
+its own seed and events, so rerolling the bridge or just the chorus drums
+only reruns that block, and only the tracks it touches are re-encoded.
+Sections with the same key (a repeated chorus) share one generated block.
+"""
+import os
+import random
+import traceback
+
+import numpy as np
+
+from metrics import METRICS, collect_in_worker
+from midi_writer import encode_conductor_track, encode_song_track, midi_file_bytes
+from song_events import Track, concat_events, empty_events
+from tempo_map import TempoMap
+
+
+def derive_seed(*parts):
+    """Stable 32-bit seed from any mix of values (same on every run)."""
+    return random.Random(':'.join(str(p) for p in parts)).getrandbits(32)
+
+
+class BlockError(RuntimeError):
+    """A block generator (or section planning, with no tracks) raised.
+
+    Names the section, tracks and seed of the block plus the original error
+    type, message and location. Only plain values are kept, so the error
+    pickles back from worker processes.
+    """
+
+    def __init__(self, section_index, track_names, seed, error_type, message, location=''):
+        super().__init__(section_index, tuple(track_names), seed, error_type, message, location)
+        self.section_index = section_index
+        self.track_names = tuple(track_names)
+        self.seed = seed
+        self.error_type = error_type
+        self.message = message
+        self.location = location
+
+    @classmethod
+    def wrap(cls, error, section_index, track_names, seed):
+        frame = traceback.extract_tb(error.__traceback__)[-1] if error.__traceback__ else None
+        location = f"{os.path.basename(frame.filename)}:{frame.lineno} in {frame.name}" if frame else ''
+        return cls(section_index, track_names, seed, type(error).__name__, str(error), location)
+
+    def __str__(self):
+        what = f"tracks {', '.join(self.track_names)}" if self.track_names else "section planning"
+        return (f"{self.error_type} in section {self.section_index} ({what}, seed {self.seed}) "
+                f"at {self.location or '?'}: {self.message}")
+
+
+def _generate_block(generate, section_index, context, seed, track_names=()):
+    # Module level so it can run in a worker process
+    random.seed(seed)
+    try:
+        return generate(section_index, context, np.random.default_rng(seed))
+    except Exception as e:
+        raise BlockError.wrap(e, section_index, track_names, seed) from e
+
+
+def _generate_block_in_worker(*task):
+    # Metrics recorded by the generator (block timers, ...) travel back with the block
+    return collect_in_worker(_generate_block, *task)
+
+
+class SongModel:
+    """Per-section, per-track event blocks over a MeasureGrid.
+
+    tracks are song_events.Track templates (name, program, channel). Block
+    generators are registered with add_generator(track_names, generate)
+    and called as generate(section_index, context, rng). They return one
+    event array per track name, with onsets relative to the section start.
+    plan_section(section_index, rng) may return shared per-section context
+    (key, chord progression, ...) handed to every generator of the section.
+    Legacy generators that use the random module are seeded as well.
+    A generator that raises surfaces as a BlockError naming its block.
+    post_process(tracks, rng) may rework reassembled tracks in one pass
+    (groove, humanisation); it only ever sees the tracks that changed.
+    section_keys gives every section a block key; sections with equal keys
+    get equal seeds and context, and their blocks are generated only once.
+    """
+
+    def __init__(self, grid, tracks, seed=None, plan_section=None, post_process=None, section_keys=None):
+        self.grid = grid
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.plan_section = plan_section
+        self.post_process = post_process
+        self.section_keys = list(section_keys) if section_keys is not None else list(range(grid.num_sections))
+        if len(self.section_keys) != grid.num_sections:
+            raise ValueError(f"{len(self.section_keys)} section keys for {grid.num_sections} sections")
+        self._post_rng = np.random.default_rng(derive_seed(self.seed, 'post'))
+        self._templates = {t.name: t for t in tracks}
+        self._track_index = {name: i for i, name in enumerate(self._templates)}
+        self._reroll = random.Random()  # Fresh seeds, independent of the seeded generators
+        self._generators = []
+        self._group_of = {}
+        self._blocks = {}
+        self._contexts = {}
+        self._context_seeds = {}
+        self._tracks = {}
+        self._chunks = {}
+        self._stale = set(self._templates)  # Tracks to reassemble from blocks
+        self._dirty = set(self._templates)  # Tracks to re-encode
+
+    def add_generator(self, track_names, generate):
+        if isinstance(track_names, str):
+            track_names = (track_names,)
+        group = len(self._generators)
+        for name in track_names:
+            if name not in self._templates:
+                raise ValueError(f"Unknown track {name!r}")
+            self._group_of[name] = group
+        self._generators.append((tuple(track_names), generate))
+        return self
+
+    def _seed_rng(self, seed):
+        random.seed(seed)
+        return np.random.default_rng(seed)
+
+    def context(self, section_index):
+        """Shared context of a section (None without plan_section)."""
+        if self.plan_section is None:
+            return None
+        if section_index not in self._contexts:
+            seed = self._context_seeds.setdefault(
+                section_index, derive_seed(self.seed, 'context', self.section_keys[section_index]))
+            try:
+                self._contexts[section_index] = self.plan_section(section_index, self._seed_rng(seed))
+            except Exception as e:
+                raise BlockError.wrap(e, section_index, (), seed) from e
+        return self._contexts[section_index]
+
+    def _render(self, jobs, executor=None):
+        """Generate (section_index, group, seed) jobs, each distinct block once.
+
+        With an executor (e.g. concurrent.futures.ProcessPoolExecutor) the
+        distinct blocks are generated in parallel; generators and contexts
+        must then be picklable. What the workers record in metrics.METRICS
+        is merged into this process.
+        """
+        unique = {}
+        for section_index, group, seed in jobs:
+            unique.setdefault((group, self.section_keys[section_index], seed), section_index)
+        tasks = [(self._generators[group][1], section_index, self.context(section_index), seed,
+                  self._generators[group][0]) for (group, _, seed), section_index in unique.items()]
+        if executor is None:
+            results = [_generate_block(*task) for task in tasks]
+        else:
+            results = []
+            for result, snapshot in executor.map(_generate_block_in_worker, *zip(*tasks)):
+                METRICS.merge(snapshot)
+                results.append(result)
+        generated = dict(zip(unique, results))
+        for section_index, group, seed in jobs:
+            self._place(section_index, group, seed, generated[group, self.section_keys[section_index], seed])
+
+    def _place(self, section_index, group, seed, result):
+        names = self._generators[group][0]
+        if len(names) == 1 and not isinstance(result, (list, tuple)):
+            result = [result]
+        if len(result) != len(names):
+            raise ValueError(f"Generator for {names} returned {len(result)} tracks")
+        offset = self.grid.section_offset(section_index)
+        blocks = []
+        for name, events in zip(names, result):
+            events = events.copy()
+            events['onset'] += offset
+            events['track'] = self._track_index[name]
+            blocks.append(events)
+        self._blocks[section_index, group] = (seed, blocks)
+        self._stale.update(names)
+        self._dirty.update(names)
+
+    def build(self, executor=None):
+        """Generate every block from the song seed."""
+        self._render([(section_index, group, derive_seed(self.seed, key, group))
+                      for section_index, key in enumerate(self.section_keys)
+                      for group in range(len(self._generators))], executor)
+        return self
+
+    def _sections(self, section):
+        if section is None:
+            return list(range(self.grid.num_sections))
+        if isinstance(section, str):
+            found = [i for i, name in enumerate(self.grid.section_names) if name == section]
+            if not found:
+                raise ValueError(f"No section named {section!r}")
+            return found
+        if isinstance(section, (list, tuple)):
+            return list(section)
+        return [section]
+
+    def regenerate(self, section=None, track=None, seed=None, executor=None):
+        """Reroll blocks and return the names of the tracks that changed.
+
+        section is an index, a list of indexes, a section name (all sections
+        of that name) or None for all; track is a track name or None for every track. Without
+        a track the section context (key, progression) is rerolled too.
+        """
+        sections = self._sections(section)
+        if seed is None:
+            seed = self._reroll.getrandbits(32)
+        if track is None:
+            groups = list(range(len(self._generators)))
+            for section_index in sections:
+                self._contexts.pop(section_index, None)
+                self._context_seeds[section_index] = derive_seed(seed, 'context', self.section_keys[section_index])
+        else:
+            if track not in self._group_of:
+                raise ValueError(f"No generator registered for track {track!r}")
+            groups = [self._group_of[track]]
+        jobs = [(section_index, group, derive_seed(seed, self.section_keys[section_index], group))
+                for section_index in sections for group in groups]
+        self._render(jobs, executor)
+        changed = {name for group in groups for name in self._generators[group][0]}
+        return [name for name in self._templates if name in changed]
+
+    def refresh(self, section=None, track=None, executor=None):
+        """Rerun blocks with the seeds they already have; returns the changed track names.
+
+        For blocks that read a neighbouring section's context, e.g. the
+        transition chords into a rerolled section: everything the new context
+        does not touch comes out as before.
+        """
+        sections = self._sections(section)
+        if track is None:
+            groups = list(range(len(self._generators)))
+        else:
+            if track not in self._group_of:
+                raise ValueError(f"No generator registered for track {track!r}")
+            groups = [self._group_of[track]]
+        self._render([(section_index, group, self._blocks[section_index, group][0])
+                      for section_index in sections for group in groups], executor)
+        changed = {name for group in groups for name in self._generators[group][0]}
+        return [name for name in self._templates if name in changed]
+
+    def block_seed(self, section_index, track):
+        return self._blocks[section_index, self._group_of[track]][0]
+
+    def block_events(self, section_index, track):
+        """Events of one track in one section, onsets from the song start."""
+        group = self._group_of[track]
+        return self._blocks[section_index, group][1][self._generators[group][0].index(track)]
+
+    def save_blocks(self, section=None, track=None):
+        """Snapshot of blocks (same arguments as regenerate) for restore_blocks."""
+        groups = range(len(self._generators)) if track is None else [self._group_of[track]]
+        return [(section_index, group, self._blocks[section_index, group])
+                for section_index in self._sections(section) for group in groups]
+
+    def restore_blocks(self, saved):
+        """Put back blocks saved with save_blocks, e.g. after a rejected reroll."""
+        for section_index, group, block in saved:
+            self._blocks[section_index, group] = block
+            names = self._generators[group][0]
+            self._stale.update(names)
+            self._dirty.update(names)
+
+    def _assemble(self, name):
+        group = self._group_of.get(name)
+        position = self._generators[group][0].index(name) if group is not None else 0
+        blocks = [self._blocks[i, group][1][position] for i in range(self.grid.num_sections)
+                  if (i, group) in self._blocks]
+        template = self._templates[name]
+        events = concat_events(blocks) if blocks else empty_events()
+        return Track(name, events, template.program, template.channel, template.is_drum,
+                     port=template.port)
+
+    def tracks(self):
+        """Current tracks; only tracks with changed blocks are reassembled."""
+        changed = [self._assemble(name) for name in self._templates
+                   if name in self._stale or name not in self._tracks]
+        if changed and self.post_process is not None:
+            changed = self.post_process(changed, self._post_rng)
+        for track in changed:
+            self._tracks[track.name] = track
+        self._stale.clear()
+        return [self._tracks[name] for name in self._templates]
+
+    def encode(self):
+        """Encoded chunk per track, re-encoding only changed tracks."""
+        tracks = self.tracks()
+        for track in tracks:
+            if track.name in self._dirty or track.name not in self._chunks:
+                self._chunks[track.name] = encode_song_track(track)
+        self._dirty.clear()
+        return [self._chunks[t.name] for t in tracks]
+
+    def midi_bytes(self, key_signatures=()):
+        """Complete MIDI file of the current state of the song."""
+        tempo_map = self.grid.tempo_map or TempoMap(self.grid.bpm)
+        conductor = encode_conductor_track(tempo_map, self.grid.time_signature_events(), key_signatures)
+        return midi_file_bytes([conductor] + self.encode())
@@ -0,0 +1,295 @@
+"""Song specs: the musical choices of a song engine as a TOML or JSON file.
+
+A spec names the tempo, meter, melody instruments, patterns and, per
+section material, the key, chord progression and bass notes. load_spec()
+parses and validates a file (every problem is reported at once) and
+compile_spec() turns the document into read-only integer tables: scale
+masks, compiled chord progressions, chord voicings, bass pitches and
+rhythm arrays. A CompiledSpec is built once and shared by every song and
+worker; generators never parse a note or chord name again.
+
+    bpm = 120
+    time_signature = "4/4"
+    melody_programs = [0, 24, 40, 73, 71]
+    melodic_patterns = [[0, 2, 4, 5], [0, -2, -4, -5]]
+    rhythmic_patterns = [[1.0, 1.0, 1.0, 1.0], [0.5, 0.5, 1.0, 2.0]]
+
+    [velocities]
+    active = 80
+    inactive = 30
+
+    [sections.verse]
+    key = "C"
+    mode = "major"
+    chords = ["C", "Am", "F", "G"]
+    bass = ["C2", "A1", "F1", "G1"]
+"""
+import copy
+import json
+import os
+from functools import lru_cache
+from types import MappingProxyType
+
+import numpy as np
+
+from melody_voices import SCALE_STEPS, scale_mask
+from song_events import compile_progression, note_number, parse_chord, pitch_class
+
+SPEC_VERSION = 1
+
+# Lowest root of a chord voicing; chords are stacked closed above it (as music21 voices chord symbols)
+VOICING_ROOT_LOW = 45
+
+# Defaults for everything but the sections, which every spec must list
+SPEC_DEFAULTS = {
+    'version': SPEC_VERSION,
+    'bpm': 120,
+    'time_signature': '4/4',
+    'melody_programs': [0, 24, 40, 73, 71],
+    'melodic_patterns': [[0, 2, 4, 5], [0, -2, -4, -5], [0, 2, 0, -2], [0, 3, 5, 7], [0, -3, -5, -7]],
+    'rhythmic_patterns': [[1.0, 1.0, 1.0, 1.0], [0.5, 0.5, 1.0, 2.0], [0.75, 0.75, 0.5, 2.0],
+                          [1.5, 0.5, 1.5, 0.5], [0.5, 1.5, 0.5, 1.5]],
+    'velocities': {'active': 80, 'inactive': 30, 'chords': 90, 'strings': 60, 'bass': 70},
+}
+SECTION_FIELDS = ('key', 'mode', 'chords', 'bass')
+
+
+def _read(path):
+    if os.path.splitext(path)[1].lower() == '.toml':
+        try:
+            import tomllib
+        except ImportError:  # Python < 3.11
+            import tomli as tomllib
+        with open(path, 'rb') as f:
+            return tomllib.load(f)
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_spec(path, materials=()):
+    """Read a .toml or .json spec file and return the validated document."""
+    try:
+        document = _read(path)
+    except ValueError as e:
+        raise ValueError(f"Cannot parse song spec {path}: {e}") from e
+    return validate_spec(document, materials, source=path)
+
+
+def _number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _check_names(errors, where, names, parse):
+    if not isinstance(names, list) or not names:
+        errors.append(f"{where} must be a non-empty list")
+        return
+    for name in names:
+        try:
+            parse(name)
+        except (ValueError, TypeError) as e:
+            errors.append(f"{where}: {e}")
+
+
+def validate_spec(document, materials=(), source='song spec'):
+    """Check a spec document and return a copy with the defaults filled in.
+
+    materials are section names the engine needs (e.g. from its form
+    grammar). Raises ValueError listing every problem found.
+    """
+    if not isinstance(document, dict):
+        raise ValueError(f"{source}: a song spec must be a table/object")
+    spec = copy.deepcopy(SPEC_DEFAULTS)
+    spec['velocities'].update(document.get('velocities') or {})
+    spec.update({k: copy.deepcopy(v) for k, v in document.items() if k != 'velocities'})
+    errors = []
+
+    unknown = set(spec) - set(SPEC_DEFAULTS) - {'sections'}
+    if unknown:
+        errors.append(f"unknown settings {sorted(unknown)}")
+    if spec['version'] != SPEC_VERSION:
+        errors.append(f"version must be {SPEC_VERSION}")
+    if not _number(spec['bpm']) or spec['bpm'] <= 0:
+        errors.append("bpm must be a positive number")
+    numerator, _, denominator = str(spec['time_signature']).partition('/')
+    if not (numerator.isdigit() and denominator.isdigit() and int(numerator) > 0
+            and int(denominator) in (1, 2, 4, 8, 16, 32)):
+        errors.append(f"time_signature {spec['time_signature']!r} is not like '4/4'")
+
+    programs = spec['melody_programs']
+    if (not isinstance(programs, list) or not 1 <= len(programs) <= 5
+            or not all(isinstance(p, int) and 0 <= p <= 127 for p in programs)):
+        errors.append("melody_programs must be 1 to 5 MIDI programs (0-127)")
+    for name, velocity in spec['velocities'].items():
+        if name not in SPEC_DEFAULTS['velocities']:
+            errors.append(f"unknown velocity {name!r}")
+        elif not isinstance(velocity, int) or not 1 <= velocity <= 127:
+            errors.append(f"velocities.{name} must be 1-127")
+
+    melodic = spec['melodic_patterns']
+    if (not isinstance(melodic, list) or not melodic
+            or not all(isinstance(p, list) and p and all(isinstance(s, int) for s in p) for p in melodic)):
+        errors.append("melodic_patterns must be a non-empty list of lists of semitone steps")
+    elif len({len(p) for p in melodic}) != 1:
+        errors.append("melodic_patterns must all have the same length")
+    rhythmic = spec['rhythmic_patterns']
+    if (not isinstance(rhythmic, list) or not rhythmic
+            or not all(isinstance(p, list) and p and all(_number(d) and d > 0 for d in p) for p in rhythmic)):
+        errors.append("rhythmic_patterns must be a non-empty list of lists of positive beat lengths")
+
+    sections = spec.get('sections')
+    if not isinstance(sections, dict) or not sections:
+        errors.append("sections must be a table of section materials")
+        sections = {}
+    missing = [m for m in materials if m not in sections]
+    if missing:
+        errors.append(f"sections {missing} are required")
+    for name, section in sections.items():
+        where = f"sections.{name}"
+        if not isinstance(section, dict):
+            errors.append(f"{where} must be a table")
+            continue
+        section.setdefault('mode', 'major')
+        unknown = set(section) - set(SECTION_FIELDS)
+        if unknown:
+            errors.append(f"{where}: unknown fields {sorted(unknown)}")
+        absent = [f for f in SECTION_FIELDS if f not in section]
+        if absent:
+            errors.append(f"{where}: missing {absent}")
+            continue
+        try:
+            pitch_class(section['key'])
+        except (ValueError, TypeError) as e:
+            errors.append(f"{where}.key: {e}")
+        if section['mode'] not in SCALE_STEPS:
+            errors.append(f"{where}.mode must be one of {sorted(SCALE_STEPS)}")
+        _check_names(errors, f"{where}.chords", section['chords'], parse_chord)
+        _check_names(errors, f"{where}.bass", section['bass'], note_number)
+
+    if errors:
+        raise ValueError(f"Invalid {source}:\n  " + "\n  ".join(errors))
+    return spec
+
+
+def chord_voicing(name):
+    """MIDI pitches of a chord in close position, root between A2 and G#3."""
+    root, intervals = parse_chord(name)
+    return VOICING_ROOT_LOW + (root - VOICING_ROOT_LOW) % 12 + np.array(intervals, dtype=np.int16)
+
+
+def _frozen(array):
+    array.setflags(write=False)
+    return array
+
+
+class ChordTable:
+    """A chord progression with its voicings; build with chord_table().
+
+    voicings[i, :voicing_sizes[i]] are the MIDI pitches of chord i of the
+    progression, the rest of the row is padding.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.progression = compile_progression(self.names)
+        voicings = [chord_voicing(c) for c in self.names]
+        self.voicing_sizes = _frozen(np.array([len(v) for v in voicings], dtype=np.intp))
+        table = np.zeros((len(voicings), self.voicing_sizes.max()), dtype=np.int16)
+        for i, voicing in enumerate(voicings):
+            table[i, :len(voicing)] = voicing
+        self.voicings = _frozen(table)
+
+    def __repr__(self):
+        return f"ChordTable({list(self.names)!r})"
+
+
+@lru_cache(maxsize=256)
+def chord_table(names):
+    """Cached ChordTable for a tuple of chord names."""
+    return ChordTable(names)
+
+
+class CompiledSection:
+    """Integer tables of one section material."""
+
+    def __init__(self, name, key, mode, chords, bass):
+        self.name = name
+        self.tonic = pitch_class(key)
+        self.mode = mode
+        self.key = (self.tonic, mode)
+        self.scale = scale_mask(self.tonic, mode)
+        self.chords = chord_table(tuple(chords))
+        self.progression = self.chords.progression
+        self.bass = _frozen(np.array([note_number(n) for n in bass], dtype=np.int16))
+
+    def __repr__(self):
+        return f"CompiledSection({self.name!r}, {list(self.chords.names)!r})"
+
+
+def _freeze(value):
+    # Read-only copy of a document: dicts become mapping proxies, lists tuples
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    # Plain dicts and lists again, e.g. for pickling (mapping proxies cannot be pickled)
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class CompiledSpec:
+    """A validated spec as read-only lookup tables; build with compile_spec().
+
+    document, velocities and sections are read-only mappings, so a spec
+    cached and shared by every song cannot be changed in place.
+    """
+
+    def __init__(self, document):
+        document = _freeze(document)
+        self.document = document
+        self.bpm = document['bpm']
+        self.time_signature = document['time_signature']
+        numerator, denominator = (int(x) for x in self.time_signature.split('/'))
+        self.beat_length = 4.0 / denominator
+        self.beats_per_bar = numerator
+        self.bar_length = numerator * self.beat_length
+        self.melody_programs = tuple(document['melody_programs'])
+        self.velocities = document['velocities']
+        self.melodic_patterns = _frozen(np.array(document['melodic_patterns'], dtype=np.int64))
+        self.rhythmic_patterns = tuple(_frozen(np.array(p, dtype=np.float64))
+                                       for p in document['rhythmic_patterns'])
+        self.sections = MappingProxyType({name: CompiledSection(name, **fields)
+                                          for name, fields in document['sections'].items()})
+
+    def __getstate__(self):
+        # Specs travel to worker processes with the block contexts
+        state = dict(self.__dict__, document=_thaw(self.document), sections=dict(self.sections))
+        del state['velocities']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.document = _freeze(state['document'])
+        self.velocities = self.document['velocities']
+        self.sections = MappingProxyType(state['sections'])
+
+    def __getitem__(self, material):
+        return self.sections[material]
+
+    def __repr__(self):
+        return f"CompiledSpec({self.time_signature} at {self.bpm} BPM, sections {sorted(self.sections)})"
+
+
+def compile_spec(document, materials=()):
+    """Validate (if needed) and compile a spec document or file path."""
+    if isinstance(document, str):
+        document = load_spec(document, materials)
+    else:
+        document = validate_spec(document, materials)
+    return CompiledSpec(document)
@@ -0,0 +1,215 @@
+"""Packed, append-only binary store for large corpora of generated songs.
+
+A store is a directory of three files instead of one .mid file per song:
+
+    events.bin  fixed-width song_events.EVENT_DTYPE records of all songs
+    meta.bin    one small JSON document per song (tracks, tempo, meter)
+    index.bin   16-byte header, then one fixed-width INDEX_DTYPE record per song
+
+Reading song i costs one index record and one contiguous slice of the
+memory-mapped event file, however many songs the store holds. A song only
+becomes visible once its index record is written, so a crash mid-append
+leaves the store readable. One writer at a time; readers call refresh() to
+see songs appended after they opened the store.
+"""
+import json
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from midi_writer import TICKS_PER_QUARTER, encode_conductor_track, encode_song_track, midi_file_bytes
+from song_events import CONTROLLER_DTYPE, EVENT_DTYPE, Track
+from tempo_map import TempoMap
+
+MAGIC = b'SONGSTOR'
+VERSION = 1
+HEADER = struct.Struct('<8sII')  # magic, version, event record size
+
+INDEX_DTYPE = np.dtype([
+    ('event_start', '<u8'),  # In records
+    ('event_count', '<u8'),
+    ('meta_start', '<u8'),  # In bytes
+    ('meta_length', '<u8'),
+])
+
+StoredSong = namedtuple('StoredSong', 'tracks tempo_map time_signatures key_signatures meta')
+
+
+class SongStore:
+    """Append songs with append(), read them back by index.
+
+    mode is 'r' (read only) or 'a' (read and append; the store is created
+    if missing). Tracks are song_events.Track objects; their events are
+    stored back to back, so every track of a stored song is one slice.
+    """
+
+    def __init__(self, root, mode='r'):
+        if mode not in ('r', 'a'):
+            raise ValueError(f"mode must be 'r' or 'a', not {mode!r}")
+        self.root = root
+        self.mode = mode
+        self._events_path = os.path.join(root, 'events.bin')
+        self._meta_path = os.path.join(root, 'meta.bin')
+        self._index_path = os.path.join(root, 'index.bin')
+        if mode == 'a' and not os.path.exists(self._index_path):
+            os.makedirs(root, exist_ok=True)
+            for path in (self._events_path, self._meta_path):
+                open(path, 'wb').close()
+            with open(self._index_path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, EVENT_DTYPE.itemsize))
+        self._check_header()
+        self._index = None
+        self._events = None
+        self.refresh()
+        self._writers = None
+        if mode == 'a':
+            self._open_writers()
+
+    def _check_header(self):
+        with open(self._index_path, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise ValueError(f"{self._index_path} is not a song store index")
+        magic, version, record_size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION or record_size != EVENT_DTYPE.itemsize:
+            raise ValueError(f"{self.root} is not a version {VERSION} song store")
+
+    def refresh(self):
+        """Map songs appended since opening (a torn last index record is ignored)."""
+        count = (os.path.getsize(self._index_path) - HEADER.size) // INDEX_DTYPE.itemsize
+        self._index = (np.memmap(self._index_path, dtype=INDEX_DTYPE, mode='r', offset=HEADER.size,
+                                 shape=(count,)) if count else np.zeros(0, dtype=INDEX_DTYPE))
+        self._events = None  # Remapped on the next read
+        return count
+
+    def _open_writers(self):
+        # Drop whatever a crashed writer left behind its last complete song
+        if len(self._index):
+            last = self._index[-1]
+            event_end = int(last['event_start'] + last['event_count'])
+            meta_end = int(last['meta_start'] + last['meta_length'])
+        else:
+            event_end = meta_end = 0
+        for path, end in ((self._events_path, event_end * EVENT_DTYPE.itemsize), (self._meta_path, meta_end)):
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+        with open(self._index_path, 'r+b') as f:
+            f.truncate(HEADER.size + len(self._index) * INDEX_DTYPE.itemsize)
+        self._writers = (open(self._events_path, 'ab'), open(self._meta_path, 'ab'),
+                         open(self._index_path, 'ab'))
+        self._event_end = event_end
+        self._meta_end = meta_end
+        self.bytes_written = 0
+
+    def __len__(self):
+        return len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._writers is not None:
+            for f in self._writers:
+                f.close()
+            self._writers = None
+        self._index = self._events = None
+
+    def append(self, tracks, tempo_map=None, time_signatures=(), key_signatures=(), meta=None, durable=False):
+        """Store one song and return its index.
+
+        time_signatures are (beat, numerator, denominator), key_signatures
+        (beat, sharps, is_minor) as for the conductor track. meta is any JSON
+        serialisable value (seed, parameters, ...). With durable=True the
+        files are fsynced before the song is committed to the index.
+        """
+        if self._writers is None:
+            raise ValueError("Song store is not open for appending")
+        events_file, meta_file, index_file = self._writers
+        tracks = list(tracks)
+        blocks = []
+        for i, track in enumerate(tracks):
+            block = np.asarray(track.events, dtype=EVENT_DTYPE).copy()
+            block['track'] = i
+            blocks.append(block)
+        events = np.concatenate(blocks) if blocks else np.zeros(0, dtype=EVENT_DTYPE)
+        document = {
+            'tracks': [{'name': t.name, 'program': t.program, 'channel': t.channel,
+                        'port': t.port, 'is_drum': t.is_drum, 'count': len(t.events),
+                        'controllers': t.controllers.tolist()} for t in tracks],
+            'tempo': (tempo_map or TempoMap()).changes(),
+            'time_signatures': [list(ts) for ts in time_signatures],
+            'key_signatures': [list(ks) for ks in key_signatures],
+            'meta': meta,
+        }
+        meta_bytes = json.dumps(document, separators=(',', ':')).encode('utf-8')
+
+        events_file.write(events.tobytes())
+        meta_file.write(meta_bytes)
+        for f in (events_file, meta_file):
+            f.flush()
+            if durable:
+                os.fsync(f.fileno())
+        record = np.array([(self._event_end, len(events), self._meta_end, len(meta_bytes))], dtype=INDEX_DTYPE)
+        index_file.write(record.tobytes())
+        index_file.flush()
+        if durable:
+            os.fsync(index_file.fileno())
+        self._event_end += len(events)
+        self._meta_end += len(meta_bytes)
+        self.bytes_written += events.nbytes + len(meta_bytes) + record.nbytes
+        return self.refresh() - 1
+
+    def _record(self, song_id):
+        if not -len(self._index) <= song_id < len(self._index):
+            raise IndexError(f"Song {song_id} not in store of {len(self._index)} songs")
+        return self._index[song_id]
+
+    def events(self, song_id):
+        """Read-only view of all events of a song, straight from the mapping."""
+        record = self._record(song_id)
+        start, count = int(record['event_start']), int(record['event_count'])
+        if self._events is None or len(self._events) < start + count:
+            size = os.path.getsize(self._events_path) // EVENT_DTYPE.itemsize
+            self._events = np.memmap(self._events_path, dtype=EVENT_DTYPE, mode='r', shape=(size,))
+        return self._events[start:start + count]
+
+    def meta(self, song_id):
+        record = self._record(song_id)
+        with open(self._meta_path, 'rb') as f:
+            f.seek(int(record['meta_start']))
+            return json.loads(f.read(int(record['meta_length'])))
+
+    def song(self, song_id):
+        """StoredSong with Track objects whose events are views into the store."""
+        document = self.meta(song_id)
+        events = self.events(song_id)
+        tracks, start = [], 0
+        for info in document['tracks']:
+            count = info['count']
+            controllers = np.array([tuple(c) for c in info.get('controllers', ())], dtype=CONTROLLER_DTYPE)
+            tracks.append(Track(info['name'], events[start:start + count], info['program'],
+                                info['channel'], info['is_drum'], controllers, info.get('port', 0)))
+            start += count
+        changes = document['tempo']
+        tempo_map = TempoMap(changes[0][1] if changes else 120)
+        for beat, bpm in changes[1:]:
+            tempo_map.set_tempo(beat, bpm)
+        return StoredSong(tracks, tempo_map, [tuple(ts) for ts in document['time_signatures']],
+                          [tuple(ks) for ks in document['key_signatures']], document['meta'])
+
+    def midi_bytes(self, song_id, tpq=TICKS_PER_QUARTER):
+        song = self.song(song_id)
+        conductor = encode_conductor_track(song.tempo_map, song.time_signatures, song.key_signatures, tpq)
+        return midi_file_bytes([conductor] + [encode_song_track(t, tpq) for t in song.tracks], tpq)
+
+    def export_midi(self, song_id, path, tpq=TICKS_PER_QUARTER):
+        """Write one stored song as a .mid file."""
+        data = self.midi_bytes(song_id, tpq)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
@@ -0,0 +1,120 @@
+"""Tempo maps written as a separate conductor track.
+
+Note data stays in beats, the tempo only lives in the conductor track. A
+new tempo variant of a song therefore only re-encodes the handful of tempo
+events, the already encoded note tracks are reused byte for byte.
+"""
+import os
+
+import numpy as np
+
+from midi_writer import TICKS_PER_QUARTER, encode_conductor_track, write_midi_file
+
+
+class TempoMap:
+    """Piecewise constant tempo changes at beat positions.
+
+    Ramps are expanded into small steps so that every consumer (MIDI
+    conductor track, seconds lookups, playback) sees the same events.
+    """
+
+    def __init__(self, bpm=120):
+        if bpm <= 0:
+            raise ValueError(f"Tempo must be positive, got {bpm}")
+        self._changes = {0.0: float(bpm)}
+        self._compiled = None
+
+    @classmethod
+    def from_sections(cls, grid, section_bpms, ramp_beats=0.0, ramp_steps_per_beat=1):
+        """Tempo map with one tempo per section of a MeasureGrid.
+
+        With ramp_beats > 0 the tempo glides from the previous section's tempo
+        into the next one over the last ramp_beats before the section starts.
+        """
+        section_bpms = list(section_bpms)
+        if len(section_bpms) != grid.num_sections:
+            raise ValueError("Need exactly one tempo per section")
+        tempo_map = cls(section_bpms[0] if section_bpms else 120)
+        for i in range(1, grid.num_sections):
+            start = grid.section_offset(i)
+            previous, bpm = section_bpms[i - 1], section_bpms[i]
+            if bpm == previous:
+                continue
+            if ramp_beats > 0:
+                ramp_start = max(start - ramp_beats, grid.section_offset(i - 1))
+                tempo_map.add_ramp(ramp_start, start, previous, bpm, ramp_steps_per_beat)
+            else:
+                tempo_map.set_tempo(start, bpm)
+        return tempo_map
+
+    def set_tempo(self, beat, bpm):
+        if bpm <= 0:
+            raise ValueError(f"Tempo must be positive, got {bpm}")
+        self._changes[float(beat)] = float(bpm)
+        self._compiled = None
+        return self
+
+    def add_ramp(self, start_beat, end_beat, start_bpm, end_bpm, steps_per_beat=1):
+        """Linear accelerando/ritardando, reaching end_bpm at end_beat."""
+        if end_beat <= start_beat:
+            raise ValueError("A tempo ramp needs end_beat > start_beat")
+        steps = max(int(round((end_beat - start_beat) * steps_per_beat)), 1)
+        beats = np.linspace(start_beat, end_beat, steps + 1)
+        bpms = np.linspace(start_bpm, end_bpm, steps + 1)
+        for beat, bpm in zip(beats.tolist(), bpms.tolist()):
+            self._changes[beat] = bpm
+        self._compiled = None
+        return self
+
+    def scaled(self, factor):
+        """Copy of the map with every tempo multiplied by factor."""
+        scaled = TempoMap()
+        scaled._changes = {beat: bpm * factor for beat, bpm in self._changes.items()}
+        return scaled
+
+    def _compile(self):
+        if self._compiled is None:
+            beats = np.array(sorted(self._changes), dtype=np.float64)
+            bpms = np.array([self._changes[b] for b in beats.tolist()], dtype=np.float64)
+            # Seconds elapsed at each change point
+            seconds = np.concatenate(([0.0], np.cumsum(np.diff(beats) * 60.0 / bpms[:-1])))
+            self._compiled = beats, bpms, seconds
+        return self._compiled
+
+    def __len__(self):
+        return len(self._changes)
+
+    def changes(self):
+        """List of (beat, bpm) tempo events in order."""
+        beats, bpms, _ = self._compile()
+        return list(zip(beats.tolist(), bpms.tolist()))
+
+    def bpm_at(self, beat):
+        beats, bpms, _ = self._compile()
+        return float(bpms[max(np.searchsorted(beats, beat, side='right') - 1, 0)])
+
+    def seconds_at(self, beat):
+        """Seconds at beat position(s); accepts scalars or arrays."""
+        beats, bpms, seconds = self._compile()
+        beat = np.asarray(beat, dtype=np.float64)
+        index = np.maximum(np.searchsorted(beats, beat, side='right') - 1, 0)
+        result = seconds[index] + (beat - beats[index]) * 60.0 / bpms[index]
+        return float(result) if result.ndim == 0 else result
+
+
+def write_tempo_variants(note_chunks, tempo_maps, path_pattern, time_signatures=(),
+                         key_signatures=(), tpq=TICKS_PER_QUARTER):
+    """Write one MIDI file per tempo map, reusing the encoded note tracks.
+
+    note_chunks are already encoded track chunks (see midi_writer), tempo_maps
+    maps a variant name to a TempoMap and path_pattern is formatted with
+    {name}. Only the conductor track is encoded per variant.
+    """
+    paths = []
+    for name, tempo_map in tempo_maps.items():
+        conductor = encode_conductor_track(tempo_map, time_signatures, key_signatures, tpq)
+        path = path_pattern.format(name=name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_midi_file(path, [conductor] + list(note_chunks), tpq)
+        paths.append(path)
+    return paths